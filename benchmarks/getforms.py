@@ -0,0 +1,76 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Measure the time and peak memory of extracting forms from a large page.  Each
+case runs in its own process so that peak RSS can be compared.
+
+    python benchmarks/getforms.py [megabytes]
+"""
+
+import resource
+import subprocess
+import sys
+import time
+
+from lxml.html import fromstring, tostring
+
+from webpath import http
+from webpath.runner import Context
+
+
+def makePage(megabytes):
+    row = ('<tr><td class="date">2014-06-01</td><td class="desc">COFFEE SHOP '
+           '#1234 ANYTOWN</td><td class="amount">-3.50</td></tr>\n')
+    rows = row * (megabytes * 1024 * 1024 // len(row))
+    form = ('<form name="search" method="post" action="/search">'
+            '<input type="hidden" name="token" value="abc123">'
+            '<input name="q" value=""><select name="range">'
+            '<option value="30" selected>30 days</option></select></form>')
+    return ('<html><head><meta charset="utf-8"></head><body>' + form +
+            '<table>' + rows + '</table>' + form + '</body></html>')
+
+
+def fullParse(content):
+    """
+    Extraction as it used to be done: parse everything, serialize each form.
+    """
+    forms = fromstring(content.decode('utf-8')).forms
+    return [{'html': tostring(form), 'form': dict(form.attrib),
+             'data': dict(form.fields)} for form in forms]
+
+
+CASES = {
+    'full parse (before)': lambda content: fullParse(content),
+    'streaming, text': lambda content: http.getForms(
+        {'html': content.decode('utf-8')}, Context()),
+    'streaming, bytes': lambda content: http.getForms(
+        {'content': content}, Context()),
+    'streaming, bytes, no html': lambda content: http.getForms(
+        {'content': content, 'include_html': False}, Context()),
+}
+
+
+def runCase(name, megabytes):
+    content = makePage(megabytes)
+    start = time.time()
+    forms = CASES[name](content)
+    elapsed = time.time() - start
+    assert len(forms) == 2
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%-27s %8.3f s %8d KB peak RSS' % (name, elapsed, peak))
+
+
+def main(megabytes):
+    print('%d MB page' % (megabytes,))
+    for name in sorted(CASES):
+        subprocess.check_call([sys.executable, __file__, str(megabytes),
+                               name])
+
+
+if __name__ == '__main__':
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if len(sys.argv) > 2:
+        runCase(sys.argv[2], megabytes)
+    else:
+        main(megabytes)
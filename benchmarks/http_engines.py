@@ -0,0 +1,80 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Compare the throughput and latency of the HTTP engines for the C{http} action
+against a local Twisted web server.
+
+    python benchmarks/http_engines.py [requests] [concurrency]
+"""
+
+import sys
+import time
+
+from twisted.internet import task, defer
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from webpath import http
+from webpath.httpagent import AgentEngine
+from webpath.runner import Context
+
+
+class Page(Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        return 'x' * 4096
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+@defer.inlineCallbacks
+def measure(handler, url, total, concurrency):
+    context = Context()
+    latencies = []
+    params = {'kwargs': {'method': 'get', 'url': url}}
+
+    @defer.inlineCallbacks
+    def work(count):
+        for i in xrange(count):
+            start = time.time()
+            response = yield handler(params, context)
+            assert response.status_code == 200
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    yield defer.gatherResults([work(total // concurrency)
+                               for i in xrange(concurrency)])
+    elapsed = time.time() - start
+    defer.returnValue((len(latencies) / elapsed, latencies))
+
+
+@defer.inlineCallbacks
+def main(reactor, total=2000, concurrency=10):
+    port = reactor.listenTCP(0, Site(Page()), interface='127.0.0.1')
+    url = 'http://127.0.0.1:%d/' % (port.getHost().port,)
+    agent = AgentEngine(reactor)
+    agent.pool.maxPersistentPerHost = concurrency
+
+    print('%d requests, %d at a time' % (total, concurrency))
+    print('%-10s %10s %8s %8s %8s' % ('engine', 'req/s', 'p50 ms', 'p90 ms',
+                                      'p99 ms'))
+    for name, handler in [('requests', http.request),
+                          ('agent', agent.request)]:
+        rate, latencies = yield measure(handler, url, total, concurrency)
+        print('%-10s %10.1f %8.2f %8.2f %8.2f' % (
+            name, rate,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 90) * 1000,
+            percentile(latencies, 99) * 1000))
+    yield agent.close()
+    yield port.stopListening()
+
+
+if __name__ == '__main__':
+    task.react(main, [int(x) for x in sys.argv[1:]])
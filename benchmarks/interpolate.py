@@ -0,0 +1,67 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Measure the per-action cost of interpolating a loop body over many items.
+
+    python benchmarks/interpolate.py [iterations]
+"""
+
+import sys
+import timeit
+
+from webpath.runner import interpolate, Template
+
+
+ACTION = {
+    'action': 'http',
+    'name': 'fetch',
+    'kwargs': {
+        'method': 'get',
+        'url': '$"https://example.com/accounts/%s" % (item["id"],)',
+        'params': {
+            'page': '$item["page"]',
+            'size': 100,
+        },
+        'headers': {'Accept': 'text/html'},
+    },
+    'tags': ['$item["name"]', 'static'],
+}
+
+
+def uncached(params, variables):
+    """
+    Interpolation as it used to be done: C{eval} of the raw source string.
+    """
+    def item(x):
+        if type(x) in (str, unicode):
+            if x.startswith('$'):
+                return eval(x[1:], {"__builtins__": None}, variables)
+        elif type(x) is dict:
+            return uncached(x, variables)
+        elif type(x) in (tuple, list):
+            return [item(y) for y in x]
+        return x
+    return dict([(k, item(v)) for k, v in params.items()])
+
+
+def run(iterations):
+    variables = {'item': {'id': 1234, 'page': 3, 'name': 'checking'}}
+    template = Template(ACTION)
+    expected = uncached(ACTION, variables)
+    assert interpolate(ACTION, variables) == expected
+    assert interpolate(template, variables) == expected
+
+    cases = [
+        ('eval source (before)', lambda: uncached(ACTION, variables)),
+        ('cached code', lambda: interpolate(ACTION, variables)),
+        ('precompiled template', lambda: interpolate(template, variables)),
+    ]
+    for label, func in cases:
+        elapsed = min(timeit.repeat(func, number=iterations, repeat=3))
+        print('%-22s %8.2f us/action' % (label,
+                                           elapsed / iterations * 1000000))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,43 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Measure what keeping metrics costs per action, by running the same cheap
+actions with no observers, with a L{RunnerMetrics} and with a L{Profile}.
+
+    python benchmarks/metrics_overhead.py [actions]
+"""
+
+import sys
+import time
+
+from webpath.metrics import Registry, RunnerMetrics
+from webpath.runner import basicRunner, Context
+from webpath.trace import Profile
+
+
+def run(n):
+    print('%d actions' % (n,))
+    steps = [{'action': 'loop', 'iterable': range(n), 'actions': [
+        {'action': 'noop', 'value': '$item'},
+    ]}]
+    noop = lambda params, context: None
+    for label, observer in [
+            ('none', None),
+            ('metrics', lambda: RunnerMetrics(Registry()).observe),
+            ('profile', lambda: Profile().observe)]:
+        runner = basicRunner({'noop': noop})
+        if observer is not None:
+            runner.addObserver(observer())
+        start = time.time()
+        d = runner.runActions(steps, Context(retention='none'))
+        failures = []
+        d.addErrback(failures.append)
+        assert d.called and not failures, failures
+        elapsed = time.time() - start
+        print('%-10s %8.3f s %8.2f us/action' % (label, elapsed,
+                                                  elapsed / n * 1000000))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,66 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Measure nested loops with loop bodies interpolated lazily (only when they're
+run) and eagerly (along with the loop action, as they used to be).
+
+    python benchmarks/nested_loops.py [outer] [inner]
+"""
+
+import sys
+import time
+
+from webpath.runner import basicRunner, Context, _trampoline
+
+
+def eagerLoop(params, context):
+    """
+    The loop as it was before its C{actions} were deferred: they arrive
+    interpolated along with the rest of its params, and each is interpolated
+    again from its dict for every item, without being precompiled.
+    """
+    runActions = context.runner.runActionsInline
+    variables = context.variables
+    def run(item):
+        variables['item'] = item
+        return runActions(params['actions'], context)
+    return _trampoline(run(item) for item in params['iterable'])
+
+
+def steps(outer, inner):
+    # The body only uses $base so that eager interpolation doesn't fail.
+    body = [
+        {'action': 'set', 'key': 'url', 'value': '$base + "/accounts"'},
+        {'action': 'set', 'key': 'params', 'value': {
+            'page': '$base[8:]', 'size': 100, 'sort': ['$base', 'date']}},
+        {'action': 'noop', 'kwargs': {'url': '$base + "/transactions"',
+                                      'params': {'q': '$base[:5]'}}},
+    ]
+    return [{'action': 'loop', 'iterable': range(outer), 'actions': [
+        {'action': 'loop', 'iterable': range(inner), 'actions': body},
+        {'action': 'loop', 'iterable': range(inner), 'actions': body},
+    ]}]
+
+
+def run(outer, inner):
+    print('%d x %d iterations' % (outer, 2 * inner))
+    noop = lambda params, context: None
+    for label, loop in [('eager (before)', eagerLoop), ('lazy', None)]:
+        runner = basicRunner({'noop': noop})
+        if loop is not None:
+            runner.registerHandler('loop', loop)
+        context = Context()
+        context.variables['base'] = 'https://example.com'
+        start = time.time()
+        d = runner.runActions(steps(outer, inner), context)
+        failures = []
+        d.addErrback(failures.append)
+        assert d.called and not failures, failures
+        print('%-15s %8.3f s' % (label, time.time() - start))
+
+
+if __name__ == '__main__':
+    outer = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    inner = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    run(outer, inner)
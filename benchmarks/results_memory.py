@@ -0,0 +1,71 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Measure the peak memory of a long loop of HTTP-like results under each result
+retention policy.  Each policy runs in its own process so that peak RSS can
+be compared.
+
+    python benchmarks/results_memory.py [iterations] [kilobytes]
+"""
+
+import resource
+import subprocess
+import sys
+import time
+
+from requests.models import Response
+
+from webpath.runner import basicRunner, Context
+
+
+POLICIES = ['all', 'all+summarize', '100', 'named', 'none']
+
+
+def fakeRequest(size):
+    """
+    Make an action handler which returns a Response with a C{size} byte body.
+    """
+    def request(params, context):
+        response = Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = 'http://example.com/%d' % (context.variables['item'],)
+        response.headers['Content-Type'] = 'text/html'
+        response._content = 'x' * size
+        return response
+    return request
+
+
+def runPolicy(policy, iterations, kilobytes):
+    retention, _, summarize = policy.partition('+')
+    if retention.isdigit():
+        retention = int(retention)
+    runner = basicRunner({'fake.http': fakeRequest(kilobytes * 1024)})
+    context = Context(retention=retention, summarize=bool(summarize))
+    start = time.time()
+    d = runner.runSingleAction('loop', {
+        'iterable': xrange(iterations),
+        'actions': [{'action': 'fake.http'}],
+    }, context)
+    assert d.called
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%-15s %8.3f s %8d KB peak RSS %6d results kept'
+          % (policy, elapsed, peak, len(context.results)))
+
+
+def main(iterations, kilobytes):
+    print('%d iterations, %d KB responses' % (iterations, kilobytes))
+    for policy in POLICIES:
+        subprocess.check_call([sys.executable, __file__, str(iterations),
+                               str(kilobytes), policy])
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    kilobytes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    if len(sys.argv) > 3:
+        runPolicy(sys.argv[3], iterations, kilobytes)
+    else:
+        main(iterations, kilobytes)
@@ -0,0 +1,98 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Compare loading a large step list and dumping a large result the way
+Serializer used to (pure-Python YAML, whole strings) with how it does now.
+Each case runs in its own process so that peak RSS can be compared.
+
+    python benchmarks/serializer.py [steps] [transactions]
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from webpath.script import Serializer
+
+
+def makeSteps(count):
+    return [{'action': 'http', 'name': 'step %d' % (i,), 'kwargs': {
+        'method': 'get',
+        'url': 'https://bank.example.com/accounts/%d' % (i,),
+        'params': {'page': '$page', 'size': 100},
+    }} for i in xrange(count)]
+
+
+def makeResult(count):
+    return [{'id': i, 'date': '2014-06-%02d' % (i % 30 + 1,),
+             'amount': '%d.%02d' % (i % 500, i % 100),
+             'memo': 'COFFEE SHOP #%d ANYTOWN' % (i,)} for i in xrange(count)]
+
+
+def oldLoadYaml(fh):
+    return yaml.load(fh.read(), Loader=yaml.Loader)
+
+
+def oldDumpYaml(data, fh):
+    fh.write(yaml.dump(data, Dumper=yaml.Dumper, default_flow_style=False))
+
+
+def oldDumpJson(data, fh):
+    fh.write(json.dumps(data, indent=2))
+
+
+CASES = {
+    'load yaml (before)': ('load', 'yaml', oldLoadYaml),
+    'load yaml': ('load', 'yaml', Serializer().load_yaml),
+    'dump yaml (before)': ('dump', None, oldDumpYaml),
+    'dump yaml': ('dump', None, Serializer().dump_yaml),
+    'dump json (before)': ('dump', None, oldDumpJson),
+    'dump json': ('dump', None, Serializer().dump_json),
+    'dump jsonl': ('dump', None, Serializer().dump_jsonl),
+}
+
+
+def runCase(name, steps, transactions):
+    kind, fmt, func = CASES[name]
+    if kind == 'load':
+        path = os.path.join(tempfile.gettempdir(),
+                            'webpath-steps-%d.%s' % (steps, fmt))
+        if not os.path.exists(path):
+            fh = open(path, 'wb')
+            yaml.dump(makeSteps(steps), fh, default_flow_style=False)
+            fh.close()
+        fh = open(path, 'rb')
+        start = time.time()
+        func(fh)
+    else:
+        data = makeResult(transactions)
+        fh = open(os.devnull, 'wb')
+        start = time.time()
+        func(data, fh)
+    elapsed = time.time() - start
+    fh.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%-20s %8.3f s %8d KB peak RSS' % (name, elapsed, peak))
+
+
+def main(steps, transactions):
+    print('%d steps, %d transactions' % (steps, transactions))
+    for name in sorted(CASES):
+        subprocess.check_call([sys.executable, __file__, str(steps),
+                               str(transactions), name])
+
+
+if __name__ == '__main__':
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    transactions = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    if len(sys.argv) > 3:
+        runCase(sys.argv[3], steps, transactions)
+    else:
+        main(steps, transactions)
@@ -0,0 +1,88 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Measure how long C{webpath run} takes on a trivial script, and which imports
+that time goes to, like C{python -X importtime} (which Python 2 hasn't got).
+
+    python benchmarks/startup.py [runs]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+# Run in a fresh interpreter for each run: times every import that loads
+# something new (cumulative and excluding nested imports) and writes them as
+# JSON to the file named by the last argument.
+CHILD = r'''
+import __builtin__, atexit, json, sys, time
+_import = __builtin__.__import__
+times = {}
+nested = []
+def timedImport(name, globals=None, locals=None, fromlist=None, level=-1):
+    before = len(sys.modules)
+    start = time.time()
+    nested.append(0.0)
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        inner = nested.pop()
+        if nested:
+            nested[-1] += elapsed
+        if len(sys.modules) > before:
+            total, own = times.get(name, (0.0, 0.0))
+            times[name] = (total + elapsed, own + elapsed - inner)
+__builtin__.__import__ = timedImport
+report = sys.argv.pop()
+def write():
+    with open(report, 'w') as fh:
+        json.dump({'times': times, 'modules': sorted(sys.modules)}, fh)
+atexit.register(write)
+sys.argv = ['webpath'] + sys.argv[1:]
+from webpath.script import run
+run()
+'''
+
+
+def run(runs):
+    script = tempfile.NamedTemporaryFile(suffix='.yaml')
+    script.write('- action: set\n  key: a\n  value: 1\n')
+    script.flush()
+    report = tempfile.mktemp()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        env.get('PYTHONPATH', '').split(os.pathsep))
+    walls = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', CHILD, 'run', '-i',
+                               script.name, '-o', os.devnull, report],
+                              env=env)
+        walls.append(time.time() - start)
+    with open(report) as fh:
+        data = json.load(fh)
+    os.remove(report)
+
+    walls.sort()
+    print('webpath run (trivial script), best of %d: %.3f s (median %.3f s)'
+          % (runs, walls[0], walls[len(walls) // 2]))
+    loaded = set(data['modules'])
+    for name in ['requests', 'lxml', 'twisted.web', 'multiprocessing',
+                 'yaml', 'pkg_resources']:
+        print('  %-16s %s' % (name, 'imported' if name in loaded
+                              else 'not imported'))
+    print('\n%10s %10s  import' % ('cumulative', 'self'))
+    rows = sorted(data['times'].items(), key=lambda item: -item[1][0])
+    for name, (total, own) in rows[:20]:
+        print('%8.1f ms %7.1f ms  %s' % (total * 1000, own * 1000, name))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,41 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Measure how many steps per second the runner gets through when every
+handler is synchronous: a long C{loop} of C{set} and C{append}.
+
+    python benchmarks/sync_steps.py [iterations]
+"""
+
+import sys
+import time
+
+from webpath.runner import basicRunner, Context
+
+
+def steps(iterations):
+    return [{'action': 'loop', 'iterable': xrange(iterations), 'actions': [
+        {'action': 'set', 'key': 'total', 'value': '$total + item'},
+        {'action': 'append', 'key': 'items', 'value': '$item'},
+    ]}]
+
+
+def run(iterations):
+    runner = basicRunner()
+    context = Context(retention='none')
+    context.variables['total'] = 0
+    start = time.time()
+    d = runner.runActions(steps(iterations), context)
+    failures = []
+    d.addErrback(failures.append)
+    elapsed = time.time() - start
+    assert d.called and not failures, failures
+    assert len(context.variables['items']) == iterations
+    count = 2 * iterations
+    print('%d steps in %.3f s: %d steps/s' % (count, elapsed,
+                                              count / elapsed))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
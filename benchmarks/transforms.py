@@ -0,0 +1,75 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Measure how long it takes to total the debits of a list of transactions and
+list their payees: with a C{loop} of C{set} and C{append} per transaction,
+with C{filter}, C{map} and C{sum}, and with C{columns} and C{sum}.
+
+    python benchmarks/transforms.py [transactions]
+"""
+
+import sys
+import time
+
+from webpath.runner import basicRunner, Context
+
+
+LOOP = [
+    {'action': 'loop', 'iterable': '$txns', 'actions': [
+        {'action': 'set', 'key': 'debits',
+         'value': '$debits + (item["amount"] if item["amount"] < 0 else 0)'},
+        {'action': 'append', 'key': 'payees', 'value': '$item["payee"]'},
+    ]},
+]
+
+TRANSFORMS = [
+    {'action': 'filter', 'iterable': '$txns', 'where': '$item["amount"] < 0'},
+    {'action': 'map', 'iterable': '$_', 'value': '$item["amount"]'},
+    {'action': 'sum', 'iterable': '$_'},
+    {'action': 'set', 'key': 'debits', 'value': '$_'},
+    {'action': 'map', 'iterable': '$txns', 'value': '$item["payee"]'},
+    {'action': 'set', 'key': 'payees', 'value': '$_'},
+]
+
+COLUMNS = [
+    {'action': 'columns', 'iterable': '$txns', 'numeric': ['amount']},
+    {'action': 'set', 'key': 'columns', 'value': '$_'},
+    {'action': 'set', 'key': 'payees', 'value': '$columns["payee"]'},
+    {'action': 'filter', 'iterable': '$columns["amount"]',
+     'where': '$item < 0'},
+    {'action': 'sum', 'iterable': '$_'},
+    {'action': 'set', 'key': 'debits', 'value': '$_'},
+]
+
+
+def transactions(count):
+    return [{'date': '2014-06-%02d' % (i % 30 + 1),
+             'payee': 'Payee %d' % (i % 50),
+             'amount': float(i % 7 - 4)} for i in xrange(count)]
+
+
+def run(count):
+    runner = basicRunner()
+    txns = transactions(count)
+    expected = None
+    for name, steps in [('loop', LOOP), ('filter/map/sum', TRANSFORMS),
+                        ('columns/sum', COLUMNS)]:
+        context = Context(retention='none')
+        context.variables.update({'txns': txns, 'debits': 0})
+        steps = runner.compile(steps)
+        start = time.time()
+        d = runner.runActions(steps, context)
+        failures = []
+        d.addErrback(failures.append)
+        elapsed = time.time() - start
+        assert d.called and not failures, failures
+        got = (context.variables['debits'], list(context.variables['payees']))
+        assert expected is None or got == expected, name
+        expected = got
+        print('%-15s %d transactions in %.3f s: %.2f us each'
+              % (name, count, elapsed, elapsed / count * 1e6))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,156 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+import os
+
+from webpath.runner import precompile
+
+
+class ScriptCache(object):
+    """
+    I load step lists from files, keeping the compiled steps around until
+    the file changes.
+    """
+
+    def __init__(self, load, compile=precompile):
+        """
+        @param load: Function that accepts a filename and returns the list
+            of steps in it.
+        @param compile: Function that accepts a list of steps and compiles
+            it, like L{webpath.runner.Runner.compile}.
+        """
+        self._load = load
+        self._compile = compile
+        self._scripts = {}
+
+
+    def get(self, path):
+        """
+        Get the compiled steps in the file at C{path}.
+        """
+        mtime = os.stat(path).st_mtime
+        cached = self._scripts.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, self._compile(self._load(path)))
+            self._scripts[path] = cached
+        return cached[1]
+
+
+
+class Batch(object):
+    """
+    I run many jobs concurrently on one reactor.  A job is a dict with:
+
+        - C{steps}: a list of steps, or C{script}: the filename of one,
+        - C{variables}: (optional) dict of initial variables,
+        - C{input}: (optional) dict of answers to C{ask} actions by key,
+        - C{id}: (optional) identifier to report the job's outcome with,
+        - C{timeout}: (optional) seconds the job may take.
+    """
+
+    def __init__(self, runner, contextFactory, scripts, concurrency=4,
+                 timeout=None):
+        """
+        @param runner: The L{webpath.runner.Runner} to run every job with.
+        @param contextFactory: Function that accepts a C{user_input_func} and
+            returns a new L{webpath.runner.Context}.
+        @param scripts: A L{ScriptCache} for jobs given as a C{script}.
+        @param concurrency: Maximum number of jobs to run at once.
+        @param timeout: Seconds each job may take unless it says otherwise,
+            or C{None} for no limit.
+        """
+        self.runner = runner
+        self.contextFactory = contextFactory
+        self.scripts = scripts
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+
+    def run(self, jobs, report, parse=None):
+        """
+        Run some jobs.
+
+        @param jobs: An iterable of jobs.  It's only consumed as fast as jobs
+            can be started.
+        @param report: Function called with each job's outcome (a dict with
+            C{id} and either C{result} or C{error}) as soon as it's done.
+        @param parse: (Optional) Function that turns each item of C{jobs}
+            into a job, such as C{json.loads}.  If it fails, that job's
+            outcome is the error and the other jobs carry on.
+
+        @return: A Deferred which fires when all the jobs are done.
+        """
+        jobs = enumerate(jobs)
+
+        @defer.inlineCallbacks
+        def work():
+            for index, job in jobs:
+                outcome = yield self.runJob(job, index, parse)
+                report(outcome)
+
+        return defer.gatherResults([work() for i in xrange(self.concurrency)],
+                                   consumeErrors=True)
+
+
+    def runJob(self, job, id, parse=None):
+        """
+        Run a single job.
+
+        @param id: Identifier to report the outcome with if the job doesn't
+            give an C{id}.
+        @param parse: (Optional) Function to turn C{job} into a job first.
+
+        @return: A Deferred outcome dict for the job.  It never errbacks.
+        """
+        def failed(err):
+            return {'id': id, 'error': '%s: %s' % (err.type.__name__,
+                                                   err.getErrorMessage())}
+
+        try:
+            if parse is not None:
+                job = parse(job)
+            if not isinstance(job, dict):
+                raise TypeError('Job should be a dict, not %r' % (job,))
+        except Exception:
+            return defer.succeed(failed(Failure()))
+        id = job.get('id', id)
+
+        answers = job.get('input', {})
+        def getUserInput(key, prompt, kwargs):
+            if key not in answers:
+                raise KeyError('No input given for %r' % (key,))
+            return answers[key]
+
+        def done(result):
+            return {'id': id, 'result': result}
+
+        d = defer.maybeDeferred(startJob, self.runner, self.contextFactory,
+                                self.scripts, job, getUserInput,
+                                self.timeout)
+        d.addCallbacks(done, failed)
+        return d
+
+
+
+def startJob(runner, contextFactory, scripts, job, getUserInput,
+             timeout=None):
+    """
+    Start running a job (see L{Batch}).  Steps given in the job are checked
+    with L{webpath.runner.Runner.compile} before any are run.
+
+    @param getUserInput: The C{user_input_func} for the job's context.
+    @param timeout: Seconds the job may take if it doesn't say.
+
+    @return: A Deferred result of the job.
+    """
+    steps = job.get('steps')
+    if steps is None:
+        steps = scripts.get(job['script'])
+    else:
+        steps = runner.compile(steps)
+    context = contextFactory(getUserInput)
+    context.variables.update(job.get('variables', {}))
+    return runner.runActions(steps, context, job.get('timeout', timeout))
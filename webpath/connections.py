@@ -0,0 +1,116 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+The C{requests} adapter and Twisted connection pool behind
+L{webpath.pool.ConnectionPool}, apart from it so that making one doesn't
+import C{requests} or C{twisted.web} until they're needed.
+"""
+
+from twisted.web.client import HTTPConnectionPool
+
+from requests.adapters import HTTPAdapter
+
+import threading
+import time
+
+
+class PoolingAdapter(HTTPAdapter):
+    """
+    I am a C{requests} transport adapter that closes idle connections and
+    remembers how many connections were made by pools I've discarded.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._lastUsed = {}
+        self._lock = threading.Lock()
+        self._retiredRequests = 0
+        self._retiredConnections = 0
+        HTTPAdapter.__init__(self,
+                             pool_connections=config.maxHosts,
+                             pool_maxsize=config.maxPerHost,
+                             max_retries=config.retries,
+                             pool_block=config.block)
+
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pools.dispose_func = self._retire
+
+
+    def _retire(self, pool):
+        with self._lock:
+            self._lastUsed.pop(pool, None)
+            self._retiredRequests += pool.num_requests
+            self._retiredConnections += pool.num_connections
+        pool.close()
+
+
+    def get_connection(self, url, proxies=None):
+        conn = HTTPAdapter.get_connection(self, url, proxies)
+        timeout = self._config.idleTimeout
+        if timeout is None:
+            return conn
+        now = time.time()
+        with self._lock:
+            last = self._lastUsed.get(conn)
+            self._lastUsed[conn] = now
+        if last is not None and now - last > timeout:
+            self._discard(conn)
+            conn = HTTPAdapter.get_connection(self, url, proxies)
+            with self._lock:
+                self._lastUsed[conn] = now
+        return conn
+
+
+    def _discard(self, pool):
+        """
+        Remove C{pool} from the pool manager, which retires it.
+        """
+        # found by identity: urllib3's keys for pools differ between versions
+        pools = self.poolmanager.pools
+        with pools.lock:
+            keys = [key for key, value in pools._container.items()
+                    if value is pool]
+        for key in keys:
+            try:
+                del pools[key]
+            except KeyError:
+                pass
+
+
+    def counts(self):
+        """
+        @return: The number of requests made and connections opened.
+        """
+        pools = self.poolmanager.pools
+        with pools.lock:
+            current = list(pools._container.values())
+        with self._lock:
+            requests = self._retiredRequests
+            opened = self._retiredConnections
+        for pool in current:
+            requests += pool.num_requests
+            opened += pool.num_connections
+        return requests, opened
+
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """
+    I am an L{HTTPConnectionPool} that counts requests and new connections.
+    """
+
+    requests = 0
+    opened = 0
+
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+
+    def _newConnection(self, key, endpoint):
+        self.opened += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
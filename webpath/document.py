@@ -0,0 +1,193 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from lxml.html import HTMLParser, document_fromstring, tostring
+
+from collections import OrderedDict
+
+from webpath.trace import clock
+
+
+class DocumentCache(object):
+    """
+    I hold parsed HTML documents so that actions working on the same document
+    don't each parse it again.
+
+    Documents are given as strings or as C{requests} Responses.  Strings are
+    cached by value and Responses by identity.  The least recently used
+    documents are evicted when there are more than C{maxsize} of them or when
+    the total length of their source is more than C{maxbytes}.
+    """
+
+    def __init__(self, maxsize=8, maxbytes=32 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._entries = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _key(self, source):
+        if hasattr(source, 'content'):
+            return ('response', id(source))
+        return ('string', hash(source))
+
+
+    def peek(self, source):
+        """
+        Get the parsed document for C{source} if it has already been parsed.
+
+        @return: The root element of the document or C{None}.
+        """
+        key = self._key(source)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] is not source and entry[0] != source:
+            return None
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry[1]
+
+
+    def parse(self, source, encoding=None):
+        """
+        Get the parsed document for C{source}, parsing it if needed.
+
+        @param source: An HTML string or a C{requests} Response.
+        @param encoding: Encoding of C{source} if it's an undecoded string.
+
+        @return: The root element of the document.
+        """
+        root = self.peek(source)
+        if root is not None:
+            self.hits += 1
+            return root
+        self.misses += 1
+
+        if hasattr(source, 'content'):
+            text = source.content
+            encoding = encoding or source.encoding
+        else:
+            text = source
+        parser = None
+        if isinstance(text, str):
+            parser = HTMLParser(encoding=encoding)
+        root = document_fromstring(text, parser=parser)
+
+        key = self._key(source)
+        self.evict(source)
+        self._entries[key] = (source, root, len(text))
+        self._size += len(text)
+        while self._entries and (len(self._entries) > self.maxsize or
+                                 self._size > self.maxbytes):
+            self._size -= self._entries.popitem(last=False)[1][2]
+        return root
+
+
+    def evict(self, source=None):
+        """
+        Forget the parsed document for C{source} or, if C{source} isn't
+        given, all parsed documents.
+        """
+        if source is None:
+            self._entries.clear()
+            self._size = 0
+            return
+        entry = self._entries.pop(self._key(source), None)
+        if entry is not None:
+            self._size -= entry[2]
+
+
+
+def documentSource(params):
+    """
+    Get the document an HTML action should work on: a C{response}, undecoded
+    C{content} or an C{html} string.
+    """
+    for key in ('response', 'content', 'html'):
+        if key in params:
+            return params[key]
+    raise KeyError('Expected one of response, content or html')
+
+
+def parse(params, context):
+    """
+    Get the parsed document for an HTML action, using the context's
+    L{DocumentCache}.
+    """
+    start = clock()
+    root = context.documents.parse(documentSource(params),
+                                   params.get('encoding'))
+    context.trace.add('parse', clock() - start)
+    return root
+
+
+def _output(value, output):
+    """
+    Convert the result of an XPath expression or CSS selector to something
+    that can be serialized.
+    """
+    if not hasattr(value, 'tag'):
+        if isinstance(value, basestring):
+            return unicode(value)
+        return value
+    if output == 'html':
+        return tostring(value, with_tail=False)
+    elif output == 'attrib':
+        return dict(value.attrib)
+    # text_content() is a "smart" string which keeps a reference to the
+    # element, and which YAML can only dump as a Python object
+    return unicode(value.text_content())
+
+
+def xpath(params, context):
+    """
+    Select things from an HTML document with an XPath expression.
+    """
+    output = params.get('output', 'text')
+    result = parse(params, context).xpath(params['path'])
+    if not isinstance(result, list):
+        return _output(result, output)
+    return [_output(x, output) for x in result]
+
+
+def css(params, context):
+    """
+    Select elements from an HTML document with a CSS selector.  This requires
+    the C{cssselect} package.
+    """
+    from lxml.cssselect import CSSSelector
+    output = params.get('output', 'text')
+    selector = CSSSelector(params['selector'])
+    return [_output(x, output) for x in selector(parse(params, context))]
+
+
+def table(params, context):
+    """
+    Get the rows of an HTML table as lists of cell text, or as dicts keyed by
+    the first row if C{header} is true.
+    """
+    tables = parse(params, context).xpath(params.get('path', '//table'))
+    rows = []
+    for tr in tables[params.get('index', 0)].xpath('tr|*/tr'):
+        rows.append([cell.text_content().strip()
+                     for cell in tr.xpath('th|td')])
+    if params.get('header') and rows:
+        header = rows.pop(0)
+        rows = [dict(zip(header, row)) for row in rows]
+    return rows
+
+
+def evict(params, context):
+    """
+    Forget a parsed document, or all of them.
+    """
+    try:
+        source = documentSource(params)
+    except KeyError:
+        source = None
+    context.documents.evict(source)
@@ -0,0 +1,167 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Running handlers off the reactor thread: in a pool of threads for those that
+block on I/O, or in a pool of processes for those that need the CPU (which
+threads would share one core of, because of the GIL).
+
+See L{webpath.runner.Runner.registerHandler}.
+"""
+
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+import cPickle as pickle
+import multiprocessing
+import signal
+
+
+class ThreadExecutor(object):
+    """
+    I call functions in a pool of threads of my own, sized apart from the
+    reactor's.
+    """
+
+    def __init__(self, size=10, reactor=None):
+        """
+        @param size: Most threads to run at once.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.size = size
+        self.reactor = reactor
+        self._pool = None
+
+
+    def submit(self, f, *args):
+        """
+        Call C{f(*args)} in a thread.
+
+        @return: A Deferred result.
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(0, self.size, 'webpath-io')
+            self._pool.start()
+        return threads.deferToThreadPool(self.reactor, self._pool, f, *args)
+
+
+    def stop(self):
+        """
+        Wait for the functions running to finish and stop my threads.
+        """
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
+
+
+
+class ProcessExecutor(object):
+    """
+    I call functions in a pool of worker processes.  Functions must be
+    importable by name (not lambdas or methods) and their arguments and
+    results picklable.
+
+    The processes are started when I'm first used.
+    """
+
+    def __init__(self, size=None, reactor=None):
+        """
+        @param size: Number of processes, or C{None} for as many as there are
+            CPUs.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.size = size
+        self.reactor = reactor
+        self._pool = None
+
+
+    def submit(self, f, *args):
+        """
+        Call C{f(*args)} in a worker process.
+
+        @return: A Deferred result.  It fails with the exception C{f}
+            raised, or with L{ExecutorError} if that can't be pickled.
+        @raise pickle.PicklingError: If C{f} or C{args} can't be pickled.
+        """
+        # pickled here so that unpicklable arguments fail now rather than in
+        # the pool's thread, which would never call us back
+        call = pickle.dumps((f, args), pickle.HIGHEST_PROTOCOL)
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.size, _startWorker)
+        d = defer.Deferred()
+        def done(result):
+            self.reactor.callFromThread(_deliver, d, result)
+        self._pool.apply_async(_call, (call,), callback=done)
+        return d
+
+
+    def stop(self):
+        """
+        Stop my processes, abandoning any calls they haven't finished.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+
+class ExecutorError(Exception):
+    """
+    A function run by a L{ProcessExecutor} failed or returned something
+    which couldn't be sent back.
+    """
+
+
+
+def _startWorker():
+    """
+    Undo the reactor's signal handling in a worker process, which it's
+    forked with, so that L{ProcessExecutor.stop} can terminate it and an
+    interrupt is left to the parent.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.set_wakeup_fd(-1)
+
+
+def _call(call):
+    """
+    Call a function pickled by L{ProcessExecutor.submit} in a worker process.
+
+    @return: A pickled C{(ok, result or exception)}.
+    """
+    # BaseException too: the pool only sends back Exceptions, and without
+    # an error callback in 2.7 anything else would leave the caller waiting
+    try:
+        f, args = pickle.loads(call)
+        outcome = (True, f(*args))
+    except BaseException as e:
+        outcome = (False, e)
+    try:
+        result = pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)
+        # some exceptions pickle but can't be rebuilt from what they pickle
+        pickle.loads(result)
+        return result
+    except Exception as e:
+        if outcome[0]:
+            error = ExecutorError("Can't send the result of %s back: %s"
+                                  % (f.__name__, e))
+        else:
+            error = ExecutorError(repr(outcome[1]))
+        return pickle.dumps((False, error), pickle.HIGHEST_PROTOCOL)
+
+
+def _deliver(d, result):
+    try:
+        ok, value = pickle.loads(result)
+    except Exception as e:
+        d.errback(ExecutorError("Can't load the result sent back: %r" % (e,)))
+        return
+    if ok:
+        d.callback(value)
+    else:
+        d.errback(value)
@@ -1,40 +1,757 @@
 # Copyright (c) The SimpleFIN Team
 # See LICENSE for details.
 
-from twisted.internet import threads
-from lxml.html import fromstring, tostring
+from twisted.internet import defer, threads
+from lxml.html import HTMLParser, document_fromstring, tostring
 
+import codecs
+import collections
+import io
+import itertools
+import mmap
+import re
+import socket
+import tempfile
+import threading
+import urlparse
 
-def installHTTPHandlers(runner):
+from webpath import document
+from webpath.document import documentSource
+from webpath.runner import Scope, deferredParams, evaluate
+from webpath.trace import clock
+
+
+CHUNK_SIZE = 64 * 1024
+
+# Shortest timeout to give requests, since 0 would make sockets non-blocking.
+MIN_TIMEOUT = 0.01
+
+# Longest form (in characters) for iterForms to find the end of itself; the
+# rest of a document with a longer one is left to lxml to parse.
+FORM_LIMIT = 1024 * 1024
+
+_OPENER = re.compile(r'<(?:!--|script\b|style\b|form\b)', re.I)
+_IN_FORM = re.compile(r'<(?:!--|script\b|style\b)|</form\s*>', re.I)
+_CLOSERS = {
+    '<!--': re.compile(r'-->'),
+    '<script': re.compile(r'</script\s*>', re.I),
+    '<style': re.compile(r'</style\s*>', re.I),
+}
+# How much of the end of a chunk to scan again with the next one, in case a
+# tag is split between them.
+_OVERLAP = 64
+_META_CHARSET = re.compile(r'<meta[^>]+charset=["\']?([-\w.:]+)', re.I)
+
+
+def installHTTPHandlers(runner, engine='requests', cache=None,
+                        scheduler=None):
     """
     Install HTTP functions on a runner.
+
+    @param engine: Which engine the C{http} action will use: C{'requests'} to
+        run C{requests} in a thread, C{'agent'} to use a new
+        L{webpath.httpagent.AgentEngine} or an engine instance (anything with
+        a C{request(params, context)} method).
+    @param cache: A L{webpath.httpcache.HTTPCache} for the C{http} action to
+        use, if any.
+    @param scheduler: A L{webpath.schedule.HostScheduler} to pace the
+        requests of the C{http} and C{http.download} actions with, if any.
+        Requests answered by C{cache} skip it.
     """
-    # XXX not covered by unit tests
+    if engine == 'requests':
+        handler = request
+    elif engine == 'agent':
+        from webpath.httpagent import AgentEngine
+        handler = AgentEngine().request
+    elif hasattr(engine, 'request'):
+        handler = engine.request
+    else:
+        raise ValueError('Unknown HTTP engine: %r' % (engine,))
+    downloader = download
+    if scheduler is not None:
+        handler = scheduler.wrap(handler)
+        downloader = scheduler.wrap(downloader)
+    if cache is not None:
+        handler = cache.wrap(handler)
     runner.registerHandlers({
-        'http': request,
+        'http': handler,
+        'http.download': downloader,
+        'http.paginate': paginate,
         'http.getForms': getForms,
+        'html.xpath': document.xpath,
+        'html.css': document.css,
+        'html.table': document.table,
+        'html.evict': document.evict,
     })
 
 
 def request(params, context):
     """
     Make an HTTP request.
+
+    @return: A Deferred response.  Cancelling it (as a timeout does) stops
+        reading the body, even in the middle of a read, and closes its
+        connection.
+    """
+    trace = context.trace
+    stop = _Stop()
+    d = defer.Deferred(lambda ignored: stop.set())
+    requesting = inThread(context, _request, context.requests,
+                          limitTimeout(params['kwargs'], context), stop)
+    def done(result):
+        if not d.called:
+            d.callback(result)
+        elif hasattr(result, 'close'):
+            result.close()
+    requesting.addBoth(done)
+    return d.addCallback(traceResponse, trace)
+
+
+def _request(session, kwargs, stop):
+    """
+    Make a request with C{requests}, reading the body a chunk at a time
+    (unless it's to be streamed) so it can be abandoned once C{stop} is set.
+    """
+    if stop.is_set():
+        raise defer.CancelledError()
+    if kwargs.get('stream'):
+        return session.request(**kwargs)
+    response = session.request(**dict(kwargs, stream=True))
+    try:
+        response._content = ''.join(_iterBody(response, CHUNK_SIZE, stop))
+    except:
+        response.close()
+        raise
+    response._content_consumed = True
+    return response
+
+
+def _iterBody(response, chunk_size, stop):
+    """
+    Generate the chunks of C{response}'s body until C{stop} is set, when
+    its connection is closed and L{defer.CancelledError} raised.
+    """
+    stop.reading(response)
+    try:
+        for chunk in response.iter_content(chunk_size):
+            if stop.is_set():
+                break
+            yield chunk
+    except Exception:
+        if not stop.is_set():
+            raise
+    if stop.is_set():
+        # don't hand the rest of the body back to the pool
+        connection = getattr(response.raw, '_connection', None)
+        if connection is not None:
+            connection.close()
+        raise defer.CancelledError()
+
+
+
+class _Stop(object):
+    """
+    I tell a thread reading a response body to stop, interrupting a read
+    that's waiting for a slow server by shutting its socket down.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._response = None
+
+
+    def is_set(self):
+        return self._event.is_set()
+
+
+    def set(self):
+        """
+        Stop, from any thread.
+        """
+        self._event.set()
+        self._shutdown(self._response)
+
+
+    def reading(self, response):
+        """
+        Say which response is being read, from the thread reading it.
+        """
+        self._response = response
+        if self._event.is_set():
+            self._shutdown(response)
+
+
+    def _shutdown(self, response):
+        connection = getattr(getattr(response, 'raw', None), '_connection',
+                             None)
+        sock = getattr(connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+def limitTimeout(kwargs, context):
+    """
+    Make sure the C{timeout} in C{kwargs} for C{requests.request} isn't
+    longer than the time left for the action (see L{Context.timeLeft}), so a
+    request running in a thread gives up (and frees the thread) once the
+    action has timed out.
+
+    @return: C{kwargs} or an updated copy.
+    """
+    left = context.timeLeft()
+    if left is None:
+        return kwargs
+    left = max(left, MIN_TIMEOUT)
+    timeout = kwargs.get('timeout')
+    if timeout is None or timeout > left:
+        kwargs = dict(kwargs, timeout=left)
+    return kwargs
+
+
+def inThread(context, f, *args, **kwargs):
+    """
+    Call C{f} in a thread of the runner's C{'io'} executor (or else of the
+    reactor's thread pool), adding the time it waited for a free thread to
+    C{context.trace} as C{thread_wait}.
+
+    @return: A Deferred result of C{f}.
+    """
+    trace = context.trace
+    queued = clock()
+    def run():
+        trace.add('thread_wait', clock() - queued)
+        return f(*args, **kwargs)
+    if context.runner is None:
+        return threads.deferToThread(run)
+    return context.runner.execute('io', run)
+
+
+def traceResponse(response, trace):
+    """
+    Add the length of C{response}'s body to C{trace} as C{bytes} and tag it
+    with the response's C{host} and C{status}.
+    """
+    content = getattr(response, 'content', None)
+    if content is not None:
+        trace.count('bytes', len(content))
+    traceStatus(response, trace)
+    return response
+
+
+def traceStatus(response, trace):
+    """
+    Tag C{trace} with the C{host} and C{status} of C{response}.
+    """
+    url = getattr(response, 'url', None)
+    if isinstance(url, basestring):
+        trace.tag('host', urlparse.urlsplit(url).netloc)
+    trace.tag('status', getattr(response, 'status_code', None))
+
+
+def download(params, context):
+    """
+    Make an HTTP request with C{requests}, streaming the body to a file
+    instead of keeping it in memory.
+
+    The body is written to C{path} if given or else to a temporary file which
+    is deleted once the result is closed or garbage collected.
+
+    @return: A Deferred L{Download}.  Cancelling it stops the download, even
+        in the middle of a read, and closes its connection.
+    """
+    trace = context.trace
+    stop = _Stop()
+    d = defer.Deferred(lambda ignored: stop.set())
+    downloading = inThread(context, _download, context.requests,
+                           params.get('path'),
+                           params.get('chunk_size', CHUNK_SIZE),
+                           limitTimeout(params['kwargs'], context), stop)
+    def done(result):
+        if not d.called:
+            d.callback(result)
+        elif isinstance(result, Download):
+            result.close()
+    downloading.addBoth(done)
+    def counted(result):
+        trace.count('bytes', result.size)
+        traceStatus(result, trace)
+        return result
+    return d.addCallback(counted)
+
+
+def _download(session, path, chunk_size, kwargs, stop):
+    if path is None:
+        fh = tempfile.NamedTemporaryFile(prefix='webpath-')
+    else:
+        fh = open(path, 'w+b')
+    try:
+        response = session.request(**dict(kwargs, stream=True))
+        try:
+            size = 0
+            for chunk in _iterBody(response, chunk_size, stop):
+                fh.write(chunk)
+                size += len(chunk)
+        finally:
+            response.close()
+        fh.flush()
+    except:
+        fh.close()
+        raise
+    return Download(response, fh, size)
+
+
+
+class Download(object):
+    """
+    I am the response to an C{http.download} action, with the body in a file
+    rather than in memory.
+
+    @ivar url: The final URL of the response.
+    @ivar status_code: The HTTP status code.
+    @ivar reason: The HTTP reason phrase.
+    @ivar headers: The response headers.
+    @ivar encoding: The encoding of the body according to the headers.
+    @ivar path: The name of the file holding the body.
+    @ivar size: The length of the (decompressed) body.
+    """
+
+    def __init__(self, response, fh, size):
+        self.url = response.url
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = response.headers
+        self.encoding = response.encoding
+        self.path = fh.name
+        self.size = size
+        self._file = fh
+
+
+    def __repr__(self):
+        return '<Download [%s] %s (%d bytes)>' % (self.status_code,
+                                                  self.path, self.size)
+
+
+    def open(self):
+        """
+        Open the body for reading.
+
+        @return: A new file object positioned at the start of the body.
+        """
+        return open(self.path, 'rb')
+
+
+    def mmap(self):
+        """
+        Map the body into memory, so it can be sliced and searched like a
+        string without being read.  An empty body can't be mapped.
+
+        @return: A read-only C{mmap.mmap}.
+        """
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def lines(self, encoding=None):
+        """
+        Generate the lines of the body one at a time, without line endings.
+
+        @param encoding: Decode the lines with this encoding instead of the
+            one from the headers.  If neither is known, the lines are not
+            decoded.
+        """
+        encoding = encoding or self.encoding
+        if encoding:
+            fh = io.open(self.path, 'r', encoding=encoding, newline='')
+        else:
+            fh = self.open()
+        with fh:
+            for line in fh:
+                yield line.rstrip('\r\n')
+
+
+    def close(self):
+        """
+        Close the body's file, deleting it if it's temporary.
+        """
+        self._file.close()
+
+
+@deferredParams('next')
+def paginate(params, context):
+    """
+    Get the pages of a paginated resource, for C{loop} to go through as it
+    needs them.  The first page is requested with C{kwargs}; each following
+    one with what C{next} makes of the page before (as C{$page}):
+
+        - a URL (relative to the page's) to get instead, dropping C{params};
+        - a dict to update the request's C{kwargs} with, where C{params} is
+          merged rather than replaced, e.g. to move an offset along;
+        - or nothing to stop.
+
+    C{next} must be an C{$expression}.  Without it, the C{Link} header's
+    C{rel="next"} URL is followed.
+    Pages are fetched with the C{http} action (so through its cache and
+    scheduler) without being kept in the results, at most C{max_pages} of
+    them, and no more than C{prefetch} (by default 1) ahead of the loop.
+
+    @return: A L{Pages} iterator.
     """
-    requests = context.requests
-    return threads.deferToThread(requests.request, **params['kwargs'])
+    scope = context.scope({})
+    scope.retention = 'none'
+    def fetch(kwargs):
+        return scope.runner.runSingleAction(
+            'http', {'action': 'http', 'kwargs': kwargs}, scope)
+    source = params.get('next')
+    if source is None:
+        following = nextLink
+    elif not (isinstance(source, basestring) and source.startswith('$')):
+        raise ValueError('next should be an $expression, not %r' % (source,))
+    else:
+        def following(page, kwargs):
+            found = evaluate(source[1:], Scope(context.variables,
+                                               {'page': page}))
+            return nextRequest(found, page, kwargs)
+    return Pages(fetch, params['kwargs'], following,
+                 params.get('max_pages'), params.get('prefetch', 1))
+
+
+def nextLink(page, kwargs):
+    """
+    Get the C{kwargs} for the page after C{page} from its C{Link} header.
+
+    @return: The C{kwargs}, or C{None} if C{page} is the last.
+    """
+    link = page.links.get('next', {}).get('url')
+    return nextRequest(link, page, kwargs)
+
+
+def nextRequest(found, page, kwargs):
+    """
+    Make the C{kwargs} for the page after C{page} from C{found}, a URL or
+    dict as described by L{paginate}.
+
+    @return: The C{kwargs}, or C{None} if C{found} is empty.
+    """
+    if not found:
+        return None
+    if isinstance(found, basestring):
+        kwargs = dict(kwargs, url=urlparse.urljoin(page.url, found))
+        kwargs.pop('params', None)
+        return kwargs
+    merged = dict(kwargs)
+    for key, value in found.items():
+        if isinstance(value, dict) and isinstance(kwargs.get(key), dict):
+            value = dict(kwargs[key], **value)
+        merged[key] = value
+    return merged
+
+
+
+class Pages(object):
+    """
+    I am an iterator of the pages of a paginated resource, each a Deferred
+    response, made by L{paginate}.
+
+    Which page follows is only known once the one before has arrived, so a
+    page asked for before then is a Deferred which fails with
+    C{StopIteration} if there turns out to be none.  Once it's known that
+    there are no more, I stop like any iterator.
+    """
+
+    def __init__(self, fetch, kwargs, following, maxPages=None, prefetch=1):
+        """
+        @param fetch: Function to request a page given its C{kwargs},
+            returning a Deferred response.
+        @param kwargs: The C{kwargs} of the first page.
+        @param following: Function given a page and its C{kwargs} which
+            returns the C{kwargs} of the next page, or C{None}.
+        @param maxPages: Most pages to fetch, or C{None} for no limit.
+        @param prefetch: Most pages to fetch before they're asked for.
+        """
+        self.fetched = 0
+        self._fetch = fetch
+        self._following = following
+        self._maxPages = maxPages
+        self._prefetch = prefetch
+        self._kwargs = kwargs
+        self._ended = False
+        self._pages = collections.deque()
+        self._waiting = collections.deque()
+
+
+    def __iter__(self):
+        return self
+
+
+    def next(self):
+        """
+        @return: A Deferred of the next page.
+        """
+        if not (self._pages or self._ended or self._kwargs is None):
+            self._start()
+        if self._pages and not self._waiting:
+            page = self._pages.popleft()
+            self._fill()
+            return page
+        if self._ended and not self._pages:
+            raise StopIteration()
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+
+    def _start(self):
+        """
+        Start fetching the page whose C{kwargs} are known.
+        """
+        kwargs, self._kwargs = self._kwargs, None
+        self.fetched += 1
+        d = defer.maybeDeferred(self._fetch, kwargs)
+        self._pages.append(d)
+        d.addCallbacks(self._got, self._failed, (kwargs,))
+
+
+    def _got(self, page, kwargs):
+        try:
+            following = self._following(page, kwargs)
+        except:
+            following = None
+            self._pages.append(defer.fail())
+        if following is None or self.fetched == self._maxPages:
+            self._ended = True
+        else:
+            self._kwargs = following
+        self._wake()
+        return page
+
+
+    def _failed(self, failure):
+        self._ended = True
+        self._wake()
+        return failure
+
+
+    def _wake(self):
+        """
+        Give those waiting the pages they're waiting for, as far as they're
+        known.
+        """
+        while self._waiting:
+            if self._pages:
+                self._pages.popleft().chainDeferred(self._waiting.popleft())
+            elif self._ended:
+                self._waiting.popleft().errback(StopIteration())
+            elif self._kwargs is not None:
+                self._start()
+            else:
+                break
+        self._fill()
+
+
+    def _fill(self):
+        """
+        Start fetching the next page ahead of time if I may.
+        """
+        if self._kwargs is not None and len(self._pages) < self._prefetch:
+            self._start()
 
 
 def getForms(params, context):
     """
     Extract all forms from html.
+
+    The document is given as C{html} (a string), C{content} (the undecoded
+    bytes of a response or a file-like object), in which case C{encoding}
+    may also be given, or C{response}.  Unless C{include_html} is false, each
+    form's HTML is included in the result.
+
+    If the document has been parsed by another HTML action its parsed form is
+    used.  Otherwise, only the forms are parsed unless C{cache} is true, in
+    which case the whole document is parsed and kept for other actions.
+    Only the forms are parsed in the runner's C{'cpu'} executor, if it has
+    one (see L{webpath.runner.Runner.execute}).
+    """
+    start = clock()
+    source = documentSource(params)
+    encoding = params.get('encoding')
+    include_html = params.get('include_html', True)
+    if params.get('cache'):
+        root = context.documents.parse(source, encoding)
+    else:
+        root = context.documents.peek(source)
+    if root is not None:
+        ret = [formData(form, include_html) for form in root.forms]
+    else:
+        if hasattr(source, 'content'):
+            source, encoding = source.content, encoding or source.encoding
+        if isinstance(source, basestring) and context.runner is not None:
+            ret = context.runner.execute('cpu', extractForms, source,
+                                         encoding, include_html)
+        else:
+            ret = extractForms(source, encoding, include_html)
+    def parsed(ret):
+        context.trace.add('parse', clock() - start)
+        return ret
+    if isinstance(ret, defer.Deferred):
+        return ret.addCallback(parsed)
+    return parsed(ret)
+
+
+def extractForms(source, encoding=None, include_html=True):
+    """
+    Get a dict describing each form in an HTML document (see L{iterForms}
+    and L{formData}).
+    """
+    return [formData(form, include_html)
+            for form in iterForms(source, encoding)]
+
+
+def formData(form, include_html=True):
+    """
+    Get a dict describing an C{lxml.html.FormElement}.
+    """
+    ret = {
+        'form': dict(form.attrib),
+        'data': dict(form.fields),
+    }
+    if include_html:
+        ret['html'] = tostring(form, with_tail=False)
+    return ret
+
+
+def iterForms(source, encoding=None, chunk_size=CHUNK_SIZE):
+    """
+    Generate the form elements in an HTML document without parsing the whole
+    document: the source is scanned for C{<form>...</form>} blocks (skipping
+    comments, scripts and styles, inside forms too) a chunk at a time and
+    only those blocks are parsed.  Once a form grows past L{FORM_LIMIT}, the
+    rest of the document is parsed by lxml in one go instead.
+
+    @param source: A string or file-like object.
+    @param encoding: Encoding of C{source} if it is not already decoded.  If
+        not given, it is taken from the document's C{<meta>} tags.
+    """
+    parser = None
+    decoder = None
+    started = False
+    form = None     # the parts of the form we're in, if any
+    size = 0        # and their length
+    closer = None   # what ends the comment, script or style we're in
+    carry = ''
+    chunks = itertools.chain(_chunks(source, chunk_size), [None])
+    for chunk in chunks:
+        final = chunk is None
+        if final:
+            chunk = decoder.decode('', True) if decoder is not None else ''
+        else:
+            if not started and isinstance(chunk, str):
+                encoding = encoding or _sniffEncoding(chunk)
+                if encoding:
+                    try:
+                        codecs.lookup(encoding)
+                    except LookupError:
+                        encoding = None
+                if encoding and u'<form'.encode(encoding) != '<form':
+                    # not ASCII-compatible, so it can't be scanned as is
+                    decoder = codecs.getincrementaldecoder(encoding)()
+                else:
+                    parser = HTMLParser(encoding=encoding)
+            started = True
+            if decoder is not None:
+                chunk = decoder.decode(chunk)
+        text = carry + chunk
+        pos = 0     # where to scan from
+        start = 0   # where the part of the form in text starts
+        while True:
+            if closer is not None:
+                pattern = closer
+            elif form is not None:
+                pattern = _IN_FORM
+            else:
+                pattern = _OPENER
+            m = pattern.search(text, pos)
+            if m is None or (m.end() == len(text) and not final):
+                # a tag at the very end may go on in the next chunk
+                break
+            token, pos = m.group().lower(), m.end()
+            if closer is not None:
+                closer = None
+            elif token.startswith('</'):
+                form.append(text[start:pos])
+                for element in _parseForm(form, parser):
+                    yield element
+                form = None
+            elif token == '<form':
+                form, size, start = [], 0, m.start()
+            else:
+                closer = _CLOSERS[token]
+        if final:
+            if form is not None:
+                # a form that's never closed ends with the document
+                form.append(text[start:])
+                for element in _parseForm(form, parser):
+                    yield element
+            break
+        cut = max(pos, len(text) - _OVERLAP)
+        carry = text[cut:]
+        if form is not None:
+            form.append(text[start:cut])
+            size += cut - start
+            if size > FORM_LIMIT:
+                form.append(carry)
+                for element in _parseRest(form, chunks, decoder, parser):
+                    yield element
+                break
+
+
+def _parseForm(parts, parser):
+    """
+    Parse the parts of a form (or more) found by L{iterForms}.
+
+    @return: The form elements in them.
+    """
+    return document_fromstring(''.join(parts), parser=parser).forms
+
+
+def _parseRest(parts, chunks, decoder, parser):
+    """
+    Parse the rest of a document with lxml, starting with C{parts} and going
+    on with what's left of C{chunks}.  (Not with lxml's feed parser, which
+    can miss the end of a script split between two feeds.)
+
+    @return: The form elements in it.
+    """
+    for chunk in chunks:
+        if chunk is None:
+            break
+        if decoder is not None:
+            chunk = decoder.decode(chunk)
+        parts.append(chunk)
+    if decoder is not None:
+        parts.append(decoder.decode('', True))
+    return _parseForm(parts, parser)
+
+
+def _sniffEncoding(chunk):
+    """
+    Find the encoding declared in the C{<meta>} tags of an HTML document.
+    """
+    m = _META_CHARSET.search(chunk, 0, 4096)
+    if m:
+        return m.group(1)
+
+
+def _chunks(source, chunk_size):
+    """
+    Generate the chunks of a file-like object (or a string, all at once).
     """
-    x = fromstring(params['html'])
-    forms = x.forms
-    ret = []
-    for form in forms:
-        ret.append({
-            'html': tostring(form),
-            'form': dict(form.attrib),
-            'data': dict(form.fields),
-        })
-    return ret
\ No newline at end of file
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    elif source:
+        yield source
@@ -0,0 +1,189 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.internet import defer
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, HTTPConnectionPool, CookieAgent
+from twisted.web.client import BrowserLikeRedirectAgent, ContentDecoderAgent
+from twisted.web.client import GzipDecoder, FileBodyProducer, ResponseDone
+from twisted.web.client import _FakeUrllib2Request, _FakeUrllib2Response
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+
+from StringIO import StringIO
+
+import requests
+from requests.cookies import RequestsCookieJar
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from webpath.http import traceResponse, limitTimeout
+
+
+SUPPORTED_KWARGS = frozenset([
+    'method', 'url', 'params', 'data', 'headers', 'cookies', 'auth',
+    'allow_redirects', 'timeout',
+])
+
+# Headers that Agent writes itself from the body producer and URL.  Copying
+# them from the prepared request would send them twice, and would keep a
+# stale Content-Length on the GET that follows a 303.
+AGENT_HEADERS = frozenset(['content-length', 'transfer-encoding', 'host'])
+
+
+class AgentEngine(object):
+    """
+    I make requests for the C{http} action using Twisted's non-blocking
+    L{Agent} and a persistent connection pool instead of running C{requests}
+    in a thread.
+
+    Cookies and default headers come from the C{requests.Session} passed to
+    L{send} so that I can be swapped in for the default engine, and I return
+    C{requests} Response objects.
+    """
+
+    def __init__(self, reactor=None, pool=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if pool is None:
+            pool = HTTPConnectionPool(reactor)
+        self.pool = pool
+        self._agent = Agent(reactor, pool=self.pool)
+
+
+    def request(self, params, context):
+        """
+        Make an HTTP request (the C{http} action).
+        """
+        d = self.send(context.requests,
+                      **limitTimeout(params['kwargs'], context))
+        return d.addCallback(traceResponse, context.trace)
+
+
+    def send(self, session, method, url, allow_redirects=True, timeout=None,
+             **kwargs):
+        """
+        Make an HTTP request.
+
+        @param session: A C{requests.Session} whose cookies and headers will
+            be used (and whose cookies will be updated).
+        @param kwargs: The same arguments as C{requests.request} accepts,
+            limited to L{SUPPORTED_KWARGS}.
+
+        @return: A Deferred C{requests.models.Response}.
+        """
+        unsupported = set(kwargs) - SUPPORTED_KWARGS
+        if unsupported:
+            raise TypeError('Unsupported arguments for the agent engine: %s'
+                            % (', '.join(sorted(unsupported)),))
+        prepared = requests.Request(method.upper(), url, **kwargs).prepare()
+
+        headers = Headers()
+        for name, value in session.headers.items():
+            if name.lower() != 'accept-encoding':
+                headers.setRawHeaders(name, [value])
+        for name, value in prepared.headers.items():
+            if name.lower() not in AGENT_HEADERS:
+                headers.setRawHeaders(name, [value])
+
+        body = None
+        if prepared.body:
+            body = FileBodyProducer(StringIO(prepared.body))
+
+        agent = CookieAgent(self._agent, session.cookies)
+        if allow_redirects:
+            agent = BrowserLikeRedirectAgent(agent)
+        agent = ContentDecoderAgent(agent, [('gzip', GzipDecoder)])
+
+        d = agent.request(prepared.method, prepared.url, headers, body)
+        d.addCallback(self._readResponse, prepared.url, session.cookies)
+        if timeout is not None:
+            # like requests' timeout, this covers reading the body too
+            call = self.reactor.callLater(timeout, d.cancel)
+            def stopTimer(result):
+                if call.active():
+                    call.cancel()
+                return result
+            d.addBoth(stopTimer)
+        return d
+
+
+    def _readResponse(self, response, url, jar):
+        reader = _BodyReader()
+        response.deliverBody(reader)
+        d = reader.finished
+        d.addCallback(lambda body: _makeResponse(response, body, url, jar))
+        return d
+
+
+    def close(self):
+        """
+        Close all the persistent connections.
+        """
+        return self.pool.closeCachedConnections()
+
+
+
+class _BodyReader(Protocol):
+    """
+    I collect the body of a response, like L{twisted.web.client.readBody},
+    but can be cancelled, which drops the connection.
+
+    @ivar finished: A Deferred of the body.
+    """
+
+    def __init__(self):
+        self.finished = defer.Deferred(self._cancel)
+        self._parts = []
+
+
+    def _cancel(self, d):
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+
+    def dataReceived(self, data):
+        self._parts.append(data)
+
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self._parts))
+        else:
+            self.finished.errback(reason)
+
+
+
+def _makeResponse(response, body, url, jar):
+    """
+    Make a C{requests} Response from a Twisted response.
+
+    @param response: The Twisted L{IResponse}.
+    @param body: The body of the response.
+    @param url: The URL that was originally requested.
+    @param jar: The cookie jar to use as a policy for parsing cookies.
+    """
+    request = getattr(response, 'request', None)
+    if request is not None:
+        url = request.absoluteURI
+
+    ret = requests.models.Response()
+    ret.status_code = response.code
+    ret.reason = response.phrase
+    ret.headers = CaseInsensitiveDict()
+    for name, values in response.headers.getAllRawHeaders():
+        ret.headers[name] = ', '.join(values)
+    ret.url = url
+    ret.encoding = get_encoding_from_headers(ret.headers)
+    ret._content = body
+    ret._content_consumed = True
+
+    ret.cookies = RequestsCookieJar()
+    cookies = jar.make_cookies(_FakeUrllib2Response(response),
+                               _FakeUrllib2Request(url))
+    for cookie in cookies:
+        ret.cookies.set_cookie(cookie)
+    return ret
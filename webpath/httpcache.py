@@ -0,0 +1,381 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+A private cache of HTTP responses for the C{http} action, which honours
+C{Cache-Control}, C{Expires}, C{ETag} and C{Last-Modified} and revalidates
+stale responses with conditional requests.
+"""
+
+from twisted.internet import defer
+
+from email.utils import parsedate_tz, mktime_tz
+
+import hashlib
+import marshal
+import os
+import tempfile
+import time
+
+import requests
+from requests.cookies import RequestsCookieJar, merge_cookies
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from webpath.lru import LRUCache
+
+
+FORMAT = 1
+
+CACHEABLE_STATUS = frozenset([200, 203, 300, 301, 410])
+
+# Headers of a 304 response which don't describe the stored body.
+_NOT_UPDATED = frozenset(['content-length', 'content-encoding',
+                          'transfer-encoding', 'content-range'])
+
+
+class HTTPCache(object):
+    """
+    I keep the responses to C{GET} requests in memory (the most recently used
+    C{maxsize} of them) and, if given a C{directory}, on disk.
+
+    Only responses that say they may be stored (or which a step forces to be)
+    are kept.  Because I may be shared by many runs, responses which are
+    C{private}, set cookies or vary on cookies or credentials are never kept,
+    requests with credentials or bodies are never answered from the cache,
+    and responses are only reused for requests sending the same cookies.
+
+    Wrap an C{http} handler with L{wrap} to use me.  A step can choose how
+    it's cached with a C{cache} param: C{false} or C{0} to skip me, or a
+    number of seconds to treat the response as fresh for, whatever its
+    headers say.
+
+    @ivar hits: Requests answered without asking the server.
+    @ivar misses: Requests which had to be sent in full.
+    @ivar revalidated: Requests answered from the cache after the server
+        said (with a 304) that the stored response was still good.
+    @ivar stored: Responses stored.
+    """
+
+    def __init__(self, maxsize=256, directory=None, clock=time.time):
+        self.memory = LRUCache(maxsize)
+        self.disk = None if directory is None else DiskStore(directory)
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stored = 0
+
+
+    def stats(self):
+        """
+        Get my hit and miss counts as a dict.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'stored': self.stored,
+        }
+
+
+    def wrap(self, handler):
+        """
+        Make an C{http} handler which uses me in front of C{handler}.
+        """
+        def request(params, context):
+            return self.request(handler, params, context)
+        return request
+
+
+    def request(self, handler, params, context):
+        """
+        Answer an C{http} action from the cache if possible, or else with
+        C{handler}.
+        """
+        option = params.get('cache', True)
+        kwargs = params['kwargs']
+        key = option and cacheKey(kwargs, context.requests)
+        if not key:
+            return handler(params, context)
+
+        trace = context.trace
+        headers = _requestHeaders(context.requests, kwargs)
+        entry = self._get(key)
+        if entry is not None and not _varyMatches(entry, headers):
+            entry = None
+        if entry is not None and entry['expires'] > self.clock():
+            self.hits += 1
+            trace.tag('cache', 'hit')
+            return makeResponse(entry)
+
+        conditional = entry is not None and _validators(entry)
+        if conditional:
+            kwargs = dict(kwargs)
+            kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                     **conditional)
+            params = dict(params, kwargs=kwargs)
+
+        def received(response):
+            if conditional and response.status_code == 304:
+                self.revalidated += 1
+                trace.tag('cache', 'revalidated')
+                _update(entry, response.headers)
+                self._set(key, entry, option, self.clock())
+                return makeResponse(entry)
+            self.misses += 1
+            trace.tag('cache', 'miss')
+            self._store(key, response, headers, option)
+            return response
+        d = defer.maybeDeferred(handler, params, context)
+        return d.addCallback(received)
+
+
+    def _get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory[key] = entry
+        return entry
+
+
+    def _store(self, key, response, requestHeaders, option):
+        """
+        Store C{response} if it may be.
+        """
+        if response.status_code not in CACHEABLE_STATUS:
+            return
+        headers = response.headers
+        if 'set-cookie' in headers:
+            return
+        vary = [name.strip().lower()
+                for name in headers.get('vary', '').split(',') if name.strip()]
+        if set(vary) & set(['*', 'cookie', 'authorization']):
+            return
+        directives = cacheControl(headers)
+        forced = option is not True
+        if not forced and ('no-store' in directives or
+                           'private' in directives):
+            return
+        entry = {
+            'format': FORMAT,
+            'url': response.url,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'headers': dict(headers.items()),
+            'content': response.content,
+            'vary': dict((name, requestHeaders.get(name)) for name in vary),
+        }
+        self._set(key, entry, option, self.clock())
+
+
+    def _set(self, key, entry, option, now):
+        """
+        Work out how long C{entry} is fresh for and save it, unless it's
+        neither fresh nor able to be revalidated.
+        """
+        if option is not True:
+            entry['expires'] = now + option
+        else:
+            entry['expires'] = now + freshness(
+                CaseInsensitiveDict(entry['headers']), now)
+        if entry['expires'] <= now and not _validators(entry):
+            return
+        self.stored += 1
+        self.memory[key] = entry
+        if self.disk is not None:
+            self.disk[key] = entry
+
+
+
+class DiskStore(object):
+    """
+    I keep cache entries in a directory, one file per entry.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + '.http')
+
+
+    def get(self, key, default=None):
+        try:
+            fh = open(self._path(key), 'rb')
+        except IOError:
+            return default
+        try:
+            stored_key, entry = marshal.load(fh)
+        except (EOFError, ValueError, TypeError):
+            return default
+        finally:
+            fh.close()
+        if stored_key != key or entry.get('format') != FORMAT:
+            return default
+        return entry
+
+
+    def __setitem__(self, key, entry):
+        try:
+            data = marshal.dumps((key, entry))
+        except ValueError:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        fh = os.fdopen(fd, 'wb')
+        try:
+            fh.write(data)
+        finally:
+            fh.close()
+        os.rename(tmp, self._path(key))
+
+
+
+def cacheKey(kwargs, session=None):
+    """
+    Get the cache key for a request made with C{requests.request(**kwargs)},
+    or with C{session.request(**kwargs)} if C{session} is given.  The
+    cookies sent with the request are part of the key, so a response is
+    only reused for requests with the same cookies.
+
+    @return: A string, or C{None} if the request may not be answered from a
+        cache.
+    """
+    method = kwargs.get('method', 'get').upper()
+    if method != 'GET':
+        return None
+    for name in ('data', 'files', 'json', 'auth'):
+        if kwargs.get(name):
+            return None
+    headers = kwargs.get('headers') or {}
+    cookies = kwargs.get('cookies')
+    if session is not None:
+        if session.auth:
+            return None
+        headers = _requestHeaders(session, kwargs)
+        cookies = merge_cookies(merge_cookies(RequestsCookieJar(),
+                                              session.cookies), cookies)
+    for name in headers:
+        if name.lower() == 'authorization':
+            return None
+    request = requests.Request(method, kwargs['url'],
+                               params=kwargs.get('params'),
+                               cookies=cookies).prepare()
+    key = '%s %s' % (method, request.url)
+    cookie = request.headers.get('cookie')
+    if cookie:
+        key += ' cookie=' + hashlib.sha1(cookie).hexdigest()
+    return key
+
+
+def cacheControl(headers):
+    """
+    Parse the C{Cache-Control} header in C{headers} (a case-insensitive
+    dict).
+
+    @return: A dict of lowercase directives to their values (or C{None}).
+    """
+    directives = {}
+    for part in headers.get('cache-control', '').split(','):
+        name, _, value = part.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = value.strip().strip('"') or None
+    return directives
+
+
+def freshness(headers, now):
+    """
+    Get the number of seconds a response with C{headers} (a case-insensitive
+    dict) stays fresh for, from its C{s-maxage}, C{max-age} or C{Expires},
+    less its C{Age}.  It's 0 for responses which must be revalidated or don't
+    say.
+    """
+    directives = cacheControl(headers)
+    if 'no-cache' in directives:
+        return 0
+    lifetime = None
+    for name in ('s-maxage', 'max-age'):
+        try:
+            lifetime = int(directives[name])
+            break
+        except (KeyError, TypeError, ValueError):
+            pass
+    if lifetime is None and 'expires' in headers:
+        expires = _parseDate(headers['expires'])
+        if expires is None:
+            return 0
+        lifetime = expires - (_parseDate(headers.get('date', '')) or now)
+    if lifetime is None:
+        return 0
+    try:
+        age = int(headers.get('age', 0))
+    except ValueError:
+        age = 0
+    return max(lifetime - age, 0)
+
+
+def makeResponse(entry):
+    """
+    Make a C{requests} Response from a cache entry.
+    """
+    ret = requests.models.Response()
+    ret.url = entry['url']
+    ret.status_code = entry['status_code']
+    ret.reason = entry['reason']
+    ret.headers = CaseInsensitiveDict(entry['headers'])
+    ret.encoding = get_encoding_from_headers(ret.headers)
+    ret._content = entry['content']
+    ret._content_consumed = True
+    ret.cookies = RequestsCookieJar()
+    ret.from_cache = True
+    return ret
+
+
+def _requestHeaders(session, kwargs):
+    headers = CaseInsensitiveDict(session.headers)
+    headers.update(kwargs.get('headers') or {})
+    return headers
+
+
+def _varyMatches(entry, headers):
+    for name, value in entry['vary'].items():
+        if headers.get(name) != value:
+            return False
+    return True
+
+
+def _validators(entry):
+    """
+    Get the headers for a conditional request to revalidate C{entry}.
+    """
+    headers = {}
+    stored = CaseInsensitiveDict(entry['headers'])
+    if 'etag' in stored:
+        headers['If-None-Match'] = stored['etag']
+    if 'last-modified' in stored:
+        headers['If-Modified-Since'] = stored['last-modified']
+    return headers
+
+
+def _update(entry, headers):
+    """
+    Update the stored headers of C{entry} with those of a 304 response.
+    """
+    stored = CaseInsensitiveDict(entry['headers'])
+    for name, value in headers.items():
+        if name.lower() not in _NOT_UPDATED:
+            stored[name] = value
+    entry['headers'] = dict(stored.items())
+
+
+def _parseDate(value):
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
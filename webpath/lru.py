@@ -0,0 +1,50 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    I am a dict-like container that holds at most C{maxsize} items,
+    discarding the least recently used ones first.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+
+    def __len__(self):
+        return len(self._data)
+
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+    def get(self, key, default=None):
+        """
+        Get an item, marking it as the most recently used.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+
+    def clear(self):
+        self._data.clear()
@@ -0,0 +1,233 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Counters, gauges and histograms which a long-running process can expose in
+the Prometheus text format.
+
+Metrics are updated from the reactor thread, so they're plain dicts with no
+locks.  Each one maps a tuple of label values to a number.
+"""
+
+from bisect import bisect_left
+import math
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+class Counter(object):
+    """
+    I count things that only ever go up.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+
+    def inc(self, labels=(), n=1):
+        """
+        Add C{n} to the count for the tuple of label values C{labels}.
+        """
+        self.values[labels] = self.values.get(labels, 0) + n
+
+
+    def samples(self):
+        """
+        Generate C{(suffix, labels, value)} for each of my values, where
+        C{labels} is a list of C{(name, value)}.
+        """
+        for key, value in sorted(self.values.items()):
+            yield '', zip(self.labels, key), value
+
+
+
+class Gauge(Counter):
+    """
+    I measure something that goes up and down.
+    """
+
+    type = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+
+    def dec(self, labels=(), n=1):
+        self.inc(labels, -n)
+
+
+
+class Callback(object):
+    """
+    I'm a counter or gauge whose values are only found out when they're
+    exposed, by calling a function.
+    """
+
+    def __init__(self, name, help, type, func, labels=()):
+        """
+        @param type: C{'counter'} or C{'gauge'}.
+        @param func: Function that returns a number, or a dict of tuples of
+            label values to numbers.
+        """
+        self.name = name
+        self.help = help
+        self.type = type
+        self.labels = tuple(labels)
+        self.func = func
+
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in sorted(values.items()):
+            yield '', zip(self.labels, key), value
+
+
+
+class Histogram(object):
+    """
+    I count observations (like latencies) in buckets.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+
+
+    def observe(self, value, labels=()):
+        """
+        Count C{value} for the tuple of label values C{labels}.
+        """
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            labels = zip(self.labels, key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield '_bucket', labels + [('le', _formatValue(bound))], \
+                    cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+
+class Registry(object):
+    """
+    I hold a set of metrics and expose them.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def add(self, metric):
+        """
+        Add a metric.
+
+        @return: C{metric}
+        """
+        self.metrics.append(metric)
+        return metric
+
+
+    def expose(self):
+        """
+        Get all my metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (
+                metric.name,
+                metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    lines.append('%s%s{%s} %s' % (
+                        metric.name, suffix,
+                        ','.join('%s="%s"' % (k, _escapeLabel(v))
+                                 for k, v in labels),
+                        _formatValue(value)))
+                else:
+                    lines.append('%s%s %s' % (metric.name, suffix,
+                                              _formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+
+class RunnerMetrics(object):
+    """
+    I keep metrics about the actions a L{webpath.runner.Runner} runs.  Add me
+    to a runner with C{runner.addObserver(metrics.observe)}.
+    """
+
+    def __init__(self, registry):
+        self.actions = registry.add(Counter(
+            'webpath_actions_total', 'Actions run.', ['action']))
+        self.errors = registry.add(Counter(
+            'webpath_action_errors_total', 'Actions that failed.',
+            ['action', 'error']))
+        self.duration = registry.add(Histogram(
+            'webpath_action_duration_seconds', 'Time taken by actions.',
+            ['action']))
+        self.http = registry.add(Histogram(
+            'webpath_http_request_duration_seconds',
+            'Time taken by HTTP requests, not counting time queued.',
+            ['host', 'status']))
+        self.retries = registry.add(Counter(
+            'webpath_http_retries_total', 'HTTP requests retried.',
+            ['host']))
+
+
+    def observe(self, trace):
+        action = (trace.action,)
+        duration = trace.end - trace.start
+        self.actions.inc(action)
+        self.duration.observe(duration, action)
+        if trace.error is not None:
+            self.errors.inc((trace.action, trace.error))
+        tags = trace.tags
+        if 'host' in tags:
+            host = tags['host']
+            self.http.observe(duration - trace.timings.get('queue_wait', 0),
+                              (host, str(tags.get('status'))))
+            retries = trace.counts.get('retries')
+            if retries:
+                self.retries.inc((host,), retries)
+
+
+
+def _escapeLabel(value):
+    return unicode(value).encode('utf-8').replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _formatValue(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if value == int(value) and abs(value) < 1e15:
+            return '%d.0' % (value,)
+        return repr(value)
+    return str(value)
@@ -0,0 +1,104 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from StringIO import StringIO
+
+import hashlib
+import imp
+import marshal
+import os
+import tempfile
+
+from webpath.version import __version__
+
+
+FORMAT = 1
+
+
+class PlanCache(object):
+    """
+    I keep compiled L{webpath.runner.Plan}s in a directory so that running a
+    script again skips parsing, checking and compiling it.
+
+    Plans are keyed by a hash of the script's source, the names of the
+    runner's handlers and the versions of webpath and Python, so a cached
+    plan is only used when compiling the script again would give the same
+    result.  Each file holds the parsed steps and the code objects of their
+    $expressions.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+
+
+    def key(self, source, runner):
+        """
+        Get the key of the plan for the script C{source} run by C{runner}.
+        """
+        h = hashlib.sha1()
+        for part in [str(FORMAT), __version__, imp.get_magic(),
+                     '\0'.join(sorted(runner.actions())), source]:
+            h.update(part)
+            h.update('\0')
+        return h.hexdigest()
+
+
+    def get(self, source, parse, runner):
+        """
+        Get the plan for a script, compiling and saving it if it isn't
+        cached.
+
+        @param source: The contents of the script.
+        @param parse: Function that accepts a file-like object and returns
+            the list of steps in it.
+        @param runner: The L{webpath.runner.Runner} to compile the plan with.
+
+        @raise webpath.runner.PlanError: If the script isn't valid.
+        """
+        path = os.path.join(self.directory,
+                            self.key(source, runner) + '.plan')
+        cached = self._read(path)
+        if cached is not None:
+            self.hits += 1
+            steps, codes = cached
+            return runner.compile(steps, codes)
+        self.misses += 1
+        plan = runner.compile(parse(StringIO(source)))
+        self._write(path, (plan.actions, plan.expressions))
+        return plan
+
+
+    def _read(self, path):
+        try:
+            fh = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            return marshal.load(fh)
+        except (EOFError, ValueError, TypeError):
+            return None
+        finally:
+            fh.close()
+
+
+    def _write(self, path, data):
+        """
+        Write C{data} to C{path} so that readers never see a partial file.
+        Steps with values C{marshal} can't handle (like YAML dates) aren't
+        cached.
+        """
+        try:
+            data = marshal.dumps(data)
+        except ValueError:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        fh = os.fdopen(fd, 'wb')
+        try:
+            fh.write(data)
+        finally:
+            fh.close()
+        os.rename(tmp, path)
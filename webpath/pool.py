@@ -0,0 +1,85 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+
+class ConnectionPool(object):
+    """
+    I am a configurable set of persistent HTTP connections which can be shared
+    by many L{webpath.runner.Context}s (and the agent engine) in one process.
+
+    @ivar maxPerHost: Maximum number of connections kept open per host.
+    @ivar block: If C{True}, requests wait for a free connection instead of
+        opening connections beyond C{maxPerHost}.  This only applies to the
+        C{requests} engine.
+    @ivar idleTimeout: Seconds a host's connections may sit unused before
+        they are closed rather than reused, or C{None} to keep them forever
+        (or, for the agent engine, for Twisted's default of 240 seconds).
+    @ivar retries: Number of times to retry failed connections.  This only
+        applies to the C{requests} engine.
+    @ivar maxHosts: Maximum number of hosts to keep connections open to.
+    """
+
+    def __init__(self, maxPerHost=10, block=False, idleTimeout=None,
+                 retries=0, maxHosts=10):
+        self.maxPerHost = maxPerHost
+        self.block = block
+        self.idleTimeout = idleTimeout
+        self.retries = retries
+        self.maxHosts = maxHosts
+        self._adapter = None
+        self._agentPool = None
+
+
+    @property
+    def adapter(self):
+        """
+        The C{requests} transport adapter which holds my connections.
+        """
+        if self._adapter is None:
+            from webpath.connections import PoolingAdapter
+            self._adapter = PoolingAdapter(self)
+        return self._adapter
+
+
+    def mount(self, session):
+        """
+        Make a C{requests.Session} use my connections.
+        """
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+
+
+    def agentPool(self, reactor):
+        """
+        Get a Twisted L{HTTPConnectionPool} configured like me for use by
+        L{webpath.httpagent.AgentEngine}.
+        """
+        if self._agentPool is None:
+            from webpath.connections import CountingHTTPConnectionPool
+            pool = CountingHTTPConnectionPool(reactor)
+            pool.maxPersistentPerHost = self.maxPerHost
+            if self.idleTimeout is not None:
+                pool.cachedConnectionTimeout = self.idleTimeout
+            self._agentPool = pool
+        return self._agentPool
+
+
+    def stats(self):
+        """
+        Get statistics about how well connections are being reused.
+
+        @return: A dict with the number of C{requests} made, the number of
+            connections C{opened} and the number of requests which C{reused}
+            a connection.
+        """
+        requests = opened = 0
+        if self._adapter is not None:
+            requests, opened = self._adapter.counts()
+        if self._agentPool is not None:
+            requests += self._agentPool.requests
+            opened += self._agentPool.opened
+        return {
+            'requests': requests,
+            'opened': opened,
+            'reused': max(requests - opened, 0),
+        }
@@ -0,0 +1,196 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Recording the HTTP traffic of C{Context.requests} to an archive and playing
+it back, so that scripts can be run (and benchmarked) without a network.
+
+An archive is a gzipped file with one line of JSON per response.
+"""
+
+from StringIO import StringIO
+
+import base64
+import gzip
+import hashlib
+import httplib
+import json
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError
+from requests.packages.urllib3.response import HTTPResponse
+
+
+class _ArchiveAdapter(HTTPAdapter):
+    """
+    I am a C{requests} transport adapter that makes responses from archive
+    entries.
+    """
+
+    def mount(self, session):
+        """
+        Make a C{requests.Session} use me.
+        """
+        session.mount('http://', self)
+        session.mount('https://', self)
+
+
+    def respond(self, request, entry, stream):
+        headers = httplib.HTTPMessage(StringIO(
+            entry['headers'].encode('latin-1')))
+        raw = HTTPResponse(body=StringIO(entry['content']),
+                           headers=headers.items(),
+                           status=entry['status'],
+                           reason=entry['reason'].encode('latin-1'),
+                           preload_content=False,
+                           original_response=_OriginalResponse(headers))
+        response = self.build_response(request, raw)
+        if not stream:
+            response.content
+        return response
+
+
+
+class RecordingAdapter(_ArchiveAdapter):
+    """
+    I send requests with another adapter and write every response to an
+    archive.
+    """
+
+    def __init__(self, path, adapter=None):
+        """
+        @param path: Filename of the archive to write.
+        @param adapter: The adapter to send requests with (like the
+            C{adapter} of a L{webpath.pool.ConnectionPool}).  By default, a
+            new C{HTTPAdapter}.
+        """
+        HTTPAdapter.__init__(self)
+        self.adapter = adapter or HTTPAdapter()
+        self.recorded = 0
+        self._file = gzip.open(path, 'wb')
+        self._lock = threading.Lock()
+
+
+    def send(self, request, stream=False, **kwargs):
+        start = time.time()
+        response = self.adapter.send(request, stream=True, **kwargs)
+        content = response.raw.read(decode_content=False)
+        original = getattr(response.raw, '_original_response', None)
+        if original is not None:
+            headers = ''.join(original.msg.headers)
+        else:
+            headers = ''.join('%s: %s\r\n' % item
+                              for item in response.raw.headers.items())
+        entry = {
+            'method': request.method,
+            'url': request.url,
+            'body': _bodyHash(request.body),
+            'status': response.status_code,
+            'reason': (response.reason or '').decode('latin-1'),
+            'headers': headers.decode('latin-1'),
+            'content': content,
+            'elapsed': time.time() - start,
+        }
+        line = json.dumps(dict(entry, content=base64.b64encode(content)),
+                          sort_keys=True) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self.recorded += 1
+        return self.respond(request, entry, stream)
+
+
+    def close(self):
+        self.adapter.close()
+
+
+    def finish(self):
+        """
+        Finish writing the archive.  (Closing sessions I'm mounted on
+        doesn't, since many sessions may share me.)
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+
+class ReplayAdapter(_ArchiveAdapter):
+    """
+    I answer requests from an archive written by L{RecordingAdapter} instead
+    of sending them.  Requests are matched by method, URL and body, and a
+    request made more often than it was recorded gets the recorded responses
+    again in turn.
+    """
+
+    def __init__(self, path, latency=0.0, bandwidth=None, sleep=time.sleep):
+        """
+        @param latency: Seconds to wait before each response, or
+            C{'recorded'} to wait as long as the response originally took.
+        @param bandwidth: If given, bytes per second to deliver bodies at.
+        @param sleep: The function to wait with.
+        """
+        HTTPAdapter.__init__(self)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sleep = sleep
+        self.replayed = 0
+        self._entries = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        fh = gzip.open(path, 'rb')
+        try:
+            for line in fh:
+                entry = json.loads(line)
+                entry['content'] = base64.b64decode(entry['content'])
+                key = (entry['method'], entry['url'], entry['body'])
+                self._entries.setdefault(key, []).append(entry)
+        finally:
+            fh.close()
+
+
+    def send(self, request, stream=False, **kwargs):
+        key = (request.method, request.url, _bodyHash(request.body))
+        entries = self._entries.get(key)
+        if not entries:
+            raise ConnectionError('No recorded response for %s %s' % (
+                request.method, request.url), request=request)
+        with self._lock:
+            n = self._counts.get(key, 0)
+            self._counts[key] = n + 1
+            self.replayed += 1
+        entry = entries[n % len(entries)]
+        delay = entry['elapsed'] if self.latency == 'recorded' \
+            else self.latency
+        if self.bandwidth:
+            delay += len(entry['content']) / float(self.bandwidth)
+        if delay > 0:
+            self.sleep(delay)
+        return self.respond(request, entry, stream)
+
+
+
+class _OriginalResponse(object):
+    """
+    I stand in for the C{httplib} response that C{requests} reads cookies
+    from.
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+
+
+    def isclosed(self):
+        return True
+
+
+
+def _bodyHash(body):
+    if not body:
+        return None
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    elif not isinstance(body, str):
+        return None
+    return hashlib.sha1(body).hexdigest()
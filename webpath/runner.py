@@ -1,7 +1,68 @@
 # Copyright (c) The SimpleFIN Team
 # See LICENSE for details.
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+
+import collections
+import copy
+import functools
+
+from webpath.lru import LRUCache
+from webpath import trace as _trace
+
+
+class Waiting(object):
+    """
+    I am what a L{cancellable} generator is waiting on.
+    """
+
+    deferred = None
+    cancelled = False
+
+
+    def on(self, d):
+        """
+        Note that the generator is about to wait on C{d}.
+
+        @return: C{d}
+        """
+        self.deferred = d
+        return d
+
+
+    def check(self):
+        """
+        @raise defer.CancelledError: If the generator has been cancelled.
+        """
+        if self.cancelled:
+            raise defer.CancelledError()
+
+
+    def cancel(self, ignored=None):
+        self.cancelled = True
+        if self.deferred is not None:
+            self.deferred.cancel()
+
+
+
+def cancellable(f):
+    """
+    Like L{defer.inlineCallbacks}, for generator functions whose last
+    argument is a L{Waiting}: they should yield C{waiting.on(d)} and call
+    C{waiting.check()} before starting anything new.  Cancelling the returned
+    Deferred cancels the Deferred the generator is waiting on, which Twisted's
+    inlineCallbacks doesn't do.
+    """
+    f = defer.inlineCallbacks(f)
+    @functools.wraps(f)
+    def wrapper(*args):
+        waiting = Waiting()
+        d = defer.Deferred(waiting.cancel)
+        f(*(args + (waiting,))).chainDeferred(d)
+        return d
+    return wrapper
+
 
 
 class Runner(object):
@@ -9,65 +70,783 @@ class Runner(object):
     I run a set of steps.
     """
 
-    def __init__(self, handlers=None):
-        self._handlers = {}
+    def __init__(self, handlers=None, reactor=None, executors=None):
+        """
+        @param reactor: Provider of C{IReactorTime} to enforce timeouts with.
+        @param executors: (Optional) Dict of C{'io'} and C{'cpu'} to what
+            handlers registered for them are run with (see
+            L{registerHandler}): anything with a C{submit(f, *args)} method
+            returning a Deferred, like a L{webpath.executor.ThreadExecutor}
+            or L{webpath.executor.ProcessExecutor}.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.executors = dict(executors or {})
+        self._handlers = Handlers()
+        self._observers = []
         if handlers:
             self.registerHandlers(handlers)
 
 
-    def registerHandler(self, action, handler_fn):
+    def addObserver(self, observer):
+        """
+        Trace every action I run from now on.
+
+        @param observer: Function called with the
+            L{webpath.trace.ActionTrace} of each action when it's done.
+        """
+        self._observers.append(observer)
+
+
+    def removeObserver(self, observer):
+        self._observers.remove(observer)
+
+
+    def registerHandler(self, action, handler_fn, executor=None):
         """
         @param action: String name of action to handle.
         @param handler_fn: Function to handle a particular action.  This
             function should accept two arguments: C{params} and C{context}.
+            It can also be given as the C{'module:name'} of the function, so
+            that C{module} is only imported if a script uses the action.
+        @param executor: (Optional) C{'io'} if the handler blocks on I/O, so
+            that it's called in a thread, or C{'cpu'} if it's CPU-bound, so
+            that it's called in a process of my C{'cpu'} executor (see
+            L{execute}).  CPU-bound handlers can't be given the context
+            (which can't be sent to another process), so they should accept
+            only C{params}, and both the params and the result should be
+            picklable.
         """
+        if isinstance(handler_fn, basestring):
+            self._handlers.lazy(action, handler_fn, executor)
+            return
+        if executor is not None:
+            handler_fn = _offload(handler_fn, executor)
         self._handlers[action] = handler_fn
 
 
-    def registerHandlers(self, handlers):
+    def registerHandlers(self, handlers, executor=None):
         """
         Register multiple handlers.
 
         @param handlers: Dict of handler names to handler functions.
+        @param executor: (Optional) What the handlers are run with (see
+            L{registerHandler}).
         """
-        self._handlers.update(handlers)
+        for action, handler_fn in handlers.items():
+            self.registerHandler(action, handler_fn, executor)
 
 
-    @defer.inlineCallbacks
-    def runActions(self, actions, context):
+    def registerLazyHandlers(self, actions, install):
         """
-        Run a set of actions.
+        Register handlers which can't be named by module, because they need
+        setting up, without setting them up until a script uses them.
+
+        @param actions: The names of the actions.
+        @param install: Function called with no arguments the first time any
+            of C{actions} is looked up, which should register handlers for
+            all of them.
         """
         for action in actions:
-            params = interpolate(action, context.variables)
-            result = yield self.runSingleAction(
-                params['action'], params, context)
-        defer.returnValue(result)
+            self._handlers.lazy(action, install)
+
+
+    def actions(self):
+        """
+        Get the names of the actions I can run (not counting those of
+        plugins I haven't loaded yet).
+        """
+        return self._handlers.names()
+
+
+    def execute(self, executor, f, *args):
+        """
+        Call C{f(*args)} with my executor called C{executor} (C{'io'} or
+        C{'cpu'}).  If I haven't got that one, I/O-bound functions are called
+        in the reactor's thread pool and CPU-bound ones right away.
+
+        @return: The result, or a Deferred of it if it isn't called right
+            away.
+        """
+        name = executor
+        executor = self.executors.get(name)
+        if executor is not None:
+            return executor.submit(f, *args)
+        if name == 'io':
+            return threads.deferToThread(f, *args)
+        return f(*args)
+
+
+    def compile(self, actions, codes=None):
+        """
+        Check a list of actions and compile it into a L{Plan}.  Every action,
+        including those nested in other actions' params (like C{loop}'s
+        C{actions}), must have a registered handler and valid $expressions.
+
+        @param codes: (Optional) Dict of expression source to code object,
+            as in L{Plan.expressions}, to use instead of compiling again.
+
+        @raise PlanError: If any action is invalid.  Nothing is run.
+        """
+        if isinstance(actions, Plan) and codes is None:
+            return actions
+        errors = []
+        expressions = dict(codes or {})
+        def compileSource(source):
+            code = expressions.get(source)
+            if code is None:
+                code = expressions[source] = compileExpression(source)
+            return code
+        plan = Plan(self._compileSteps(actions, 'steps', compileSource,
+                                       errors), actions, expressions)
+        if errors:
+            raise PlanError(errors)
+        return plan
+
+
+    def _compileSteps(self, actions, where, compileSource, errors):
+        steps = []
+        for i, action in enumerate(actions):
+            here = '%s[%d]' % (where, i)
+            if not isinstance(action, dict) or 'action' not in action:
+                errors.append('%s: not an action: %r' % (here, action))
+                continue
+            handler = self._handlers.get(action['action'])
+            if handler is None:
+                errors.append('%s: unknown action %r' % (here,
+                                                         action['action']))
+            deferred = getattr(handler, 'deferredParams', ())
+            params = dict([(k, self._compileParam(v, '%s.%s' % (here, k),
+                                                  compileSource, errors,
+                                                  k in deferred))
+                           for k, v in action.items()])
+            if not errors:
+                steps.append(Step(params, handler, compileSource))
+        return steps
+
+
+    def _compileParam(self, value, where, compileSource, errors,
+                      steps=False):
+        """
+        Check the $expressions in C{value} and, if it's a param the handler
+        has deferred (like C{loop}'s C{actions}), compile any lists of
+        actions in it into lists of L{Step}s.  Other params are data, even
+        if they look like actions.
+        """
+        if steps and _isSteps(value):
+            return self._compileSteps(value, where, compileSource, errors)
+        elif type(value) in (dict,):
+            return dict([(k, self._compileParam(v, '%s.%s' % (where, k),
+                                                compileSource, errors, steps))
+                         for k, v in value.items()])
+        elif type(value) in (tuple, list):
+            return [self._compileParam(v, '%s[%d]' % (where, i),
+                                       compileSource, errors, steps)
+                    for i, v in enumerate(value)]
+        elif type(value) in (str, unicode) and value.startswith('$'):
+            try:
+                compileSource(value[1:])
+            except SyntaxError as e:
+                errors.append('%s: invalid expression %r: %s'
+                              % (where, value, e.msg))
+        return value
+
+
+    def runActions(self, actions, context, timeout=None):
+        """
+        Run a set of actions (dicts, L{Template}s or a L{Plan}).  Params the
+        handler has deferred (see L{deferredParams}) aren't interpolated.
+
+        @param timeout: (Optional) Seconds the actions may take in all.
+
+        @return: A Deferred result of the last action.  Cancelling it
+            cancels the action that's running and runs no more.  It fails
+            with L{Timeout} if the actions take longer than C{timeout}.
+        """
+        if timeout is None:
+            return defer.maybeDeferred(self.runActionsInline, actions,
+                                       context)
+        outer = context.deadline
+        context.deadline = _earliest(outer, self.reactor.seconds() + timeout)
+        d = defer.maybeDeferred(self.runActionsInline, actions, context)
+        def restore(result):
+            context.deadline = outer
+            return result
+        d.addBoth(restore)
+        if d.called:
+            return d
+        return self._timeLimit(d, timeout, 'run')
 
 
-    def runSingleAction(self, action, params, context):
+    def runActionsInline(self, actions, context):
+        """
+        Run a set of actions like L{runActions}, calling each handler as soon
+        as the last one is done.  Handlers which don't return a Deferred (or
+        return one which has already fired) cost no Deferreds at all.
+
+        Control actions should run their nested actions with me so that a
+        long loop of synchronous actions runs in a single stack frame.
+
+        @return: The result of the last action if they all finished
+            synchronously, or else a cancellable Deferred of it.
+        @raise: Whatever a handler raised synchronously.
+        """
+        return _trampoline(self._runAction(action, context)
+                           for action in actions)
+
+
+    def _runAction(self, action, context):
+        handler = getattr(action, 'handler', None)
+        if handler is None:
+            handler = self._handlers[action['action']]
+        deferred = getattr(handler, 'deferredParams', ())
+        trace = None
+        if self._observers:
+            start = _trace.clock()
+            params = interpolate(action, context.variables, deferred)
+            trace = _trace.ActionTrace(params['action'], params.get('name'),
+                                       _trace.clock() - start)
+        else:
+            params = interpolate(action, context.variables, deferred)
+        return self._callHandler(params['action'], params, context, handler,
+                                 trace)
+
+
+    def runSingleAction(self, action, params, context, handler=None,
+                        trace=None):
         """
         Run the handler for an action.
 
         @param action: String name of action.
         @param params: Dict of parameters to the handler.
         @param context: A L{Context} for the handler.
+        @param handler: (Optional) The handler, if it has already been looked
+            up.
+        @param trace: (Optional) The action's L{webpath.trace.ActionTrace},
+            if it has already been started.  One is made if I'm observed.
+
+        @return: A Deferred result.
+        """
+        return defer.maybeDeferred(self._callHandler, action, params, context,
+                                   handler, trace)
+
+
+    def _callHandler(self, action, params, context, handler=None,
+                     trace=None):
+        """
+        Run the handler for an action (see L{runSingleAction}).
+
+        @return: The result, or a Deferred of it if the handler returned a
+            Deferred or the action has a C{timeout}.
         """
         context.runner = self
-        d = defer.maybeDeferred(self._handlers[action], params, context)
+        if handler is None:
+            handler = self._handlers[action]
+        if trace is None and self._observers:
+            trace = _trace.ActionTrace(action, params.get('name'))
+        context.trace = trace or _trace.NO_TRACE
+        timeout = params.get('timeout')
+        if timeout is None:
+            try:
+                result = handler(params, context)
+            except:
+                if trace is None:
+                    raise
+                failure = Failure()
+                self._finishTrace(failure, trace)
+                failure.raiseException()
+            if not isinstance(result, defer.Deferred):
+                if trace is not None:
+                    self._finishTrace(result, trace)
+                return context.saveResult(result, name=params.get('name'))
+            d = result
+        else:
+            d = self._runWithTimeout(handler, params, context, timeout)
+        if trace is not None:
+            d.addBoth(self._finishTrace, trace)
         d.addCallback(context.saveResult, name=params.get('name'))
         return d
 
 
-@defer.inlineCallbacks
+    def _runWithTimeout(self, handler, params, context, timeout):
+        """
+        Run C{handler}, cancelling it if it takes longer than C{timeout}.
+        Actions it runs (and HTTP requests it makes) have to be done by then
+        too.
+        """
+        outer = context.deadline
+        context.deadline = _earliest(outer, self.reactor.seconds() + timeout)
+        d = defer.maybeDeferred(handler, params, context)
+        def restore(result):
+            context.deadline = outer
+            return result
+        d.addBoth(restore)
+        return self._timeLimit(d, timeout, 'action %r' % (params['action'],))
+
+
+    def _timeLimit(self, d, timeout, what):
+        """
+        Cancel C{d} if it hasn't fired in C{timeout} seconds.
+
+        @return: C{d}, which then fails with L{Timeout}.
+        """
+        expired = []
+        def expire():
+            expired.append(True)
+            d.cancel()
+        call = self.reactor.callLater(timeout, expire)
+        def done(result):
+            if call.active():
+                call.cancel()
+            if expired and isinstance(result, Failure) and \
+                    result.check(defer.CancelledError):
+                return Failure(Timeout('%s timed out after %s seconds'
+                                       % (what, timeout)))
+            return result
+        return d.addBoth(done)
+
+
+    def _finishTrace(self, result, trace):
+        if isinstance(result, Failure):
+            trace.finish(result.type.__name__)
+        else:
+            trace.finish()
+        for observer in self._observers:
+            observer(trace)
+        return result
+
+
+def _trampoline(results):
+    """
+    Advance C{results}, an iterator which does a step of work each time it's
+    advanced and gives its result, until it's exhausted.  Results which are
+    Deferreds that haven't fired yet are waited for, without recursing, so
+    any number of synchronous steps runs in constant stack space.
+
+    @return: The last result if no step had to be waited for, or else a
+        Deferred of it.  Cancelling the Deferred cancels the step being
+        waited for and advances C{results} no more.
+    @raise: Whatever a step raised before one had to be waited for.
+    """
+    return _Trampoline(results).run()
+
+
+
+class _Trampoline(object):
+    """
+    I advance an iterator of results for L{_trampoline}.
+    """
+
+    deferred = None
+    waitingOn = None
+    cancelled = False
+
+
+    def __init__(self, results):
+        self.results = results
+
+
+    def run(self, result=None):
+        """
+        Advance my results until they're exhausted or one must be waited for.
+
+        @param result: The result so far.
+        @return: The last result, or my Deferred if I'm waiting.
+        """
+        for result in self.results:
+            if isinstance(result, defer.Deferred):
+                fired = self._wait(result)
+                if not fired:
+                    return self.deferred
+                result = fired[0]
+                if isinstance(result, Failure):
+                    result.raiseException()
+            if self.cancelled:
+                raise defer.CancelledError()
+        return result
+
+
+    def _wait(self, d):
+        """
+        Get the result of C{d} if it has fired, or else arrange to resume
+        when it does.
+
+        @return: A list of the result, or an empty list if I'm waiting.
+        """
+        fired = []
+        def got(result):
+            if self.waitingOn is d:
+                self.waitingOn = None
+                self._resume(result)
+            else:
+                fired.append(result)
+        d.addBoth(got)
+        if not fired:
+            if self.deferred is None:
+                self.deferred = defer.Deferred(self._cancel)
+            self.waitingOn = d
+        return fired
+
+
+    def _resume(self, result):
+        if not isinstance(result, Failure):
+            try:
+                if self.cancelled:
+                    raise defer.CancelledError()
+                result = self.run(result)
+            except:
+                result = Failure()
+            else:
+                if result is self.deferred:
+                    return
+                self.deferred.callback(result)
+                return
+        self.deferred.errback(result)
+
+
+    def _cancel(self, ignored):
+        self.cancelled = True
+        if self.waitingOn is not None:
+            self.waitingOn.cancel()
+
+
+
+class Handlers(dict):
+    """
+    I am a dict of action names to handlers, some of which aren't imported
+    (or set up) until they're first looked up.  Actions I don't know of are
+    looked for among the C{webpath.actions} entry points of installed
+    distributions, like this one in a plugin's C{setup.py}::
+
+        entry_points={'webpath.actions': [
+            'ofx.parse = webpath_ofx.actions:parse',
+        ]}
+    """
+
+    def __init__(self, handlers=()):
+        dict.__init__(self, handlers)
+        self._lazy = {}
+
+
+    def __setitem__(self, action, handler):
+        self._lazy.pop(action, None)
+        dict.__setitem__(self, action, handler)
+
+
+    def update(self, handlers):
+        for action, handler in dict(handlers).items():
+            self[action] = handler
+
+
+    def lazy(self, action, spec, executor=None):
+        """
+        Load the handler for C{action} when it's first looked up.
+
+        @param spec: The C{'module:name'} of the handler, or a function which
+            registers it when called with no arguments.
+        @param executor: What the handler is run with (see
+            L{Runner.registerHandler}).
+        """
+        dict.pop(self, action, None)
+        self._lazy[action] = (spec, executor)
+
+
+    def names(self):
+        """
+        Get the names of the actions I know of, loaded or not.
+        """
+        return set(self) | set(self._lazy)
+
+
+    def __missing__(self, action):
+        spec, executor = self._lazy.get(action, (None, None))
+        if spec is None:
+            spec = _entryPoints().get(action)
+            if spec is None:
+                raise KeyError(action)
+        if callable(spec):
+            spec()
+            if dict.__contains__(self, action):
+                return dict.__getitem__(self, action)
+            raise KeyError(action)
+        handler = _load(spec)
+        if executor is not None:
+            handler = _offload(handler, executor)
+        self[action] = handler
+        return handler
+
+
+    def get(self, action, default=None):
+        try:
+            return self[action]
+        except KeyError:
+            return default
+
+
+    def __contains__(self, action):
+        return self.get(action) is not None
+
+
+
+_ENTRY_POINTS = None
+
+
+def _entryPoints():
+    """
+    Get the C{'module:name'} of the handler of every action in the
+    C{webpath.actions} entry points, scanning them only once.
+    """
+    global _ENTRY_POINTS
+    if _ENTRY_POINTS is None:
+        import pkg_resources
+        _ENTRY_POINTS = dict(
+            (ep.name, '%s:%s' % (ep.module_name, '.'.join(ep.attrs)))
+            for ep in pkg_resources.iter_entry_points('webpath.actions'))
+    return _ENTRY_POINTS
+
+
+def _load(spec):
+    """
+    Import the object named by C{'module:name'}.
+    """
+    module, name = spec.split(':')
+    obj = __import__(module, fromlist=['__name__'])
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+
+def _earliest(deadline, other):
+    if deadline is None or other < deadline:
+        return other
+    return deadline
+
+
+
+class Timeout(Exception):
+    """
+    An action or a run took longer than it was allowed to.
+    """
+
+
+
+def _offload(handler, executor):
+    """
+    Wrap C{handler} so that it's called with the runner's C{executor}.
+    """
+    if executor == 'cpu':
+        def offloaded(params, context):
+            return context.runner.execute(executor, handler, params)
+    elif executor == 'io':
+        def offloaded(params, context):
+            return context.runner.execute(executor, handler, params, context)
+    else:
+        raise ValueError('Unknown executor: %r' % (executor,))
+    if hasattr(handler, 'deferredParams'):
+        offloaded.deferredParams = handler.deferredParams
+    return offloaded
+
+
+def deferredParams(*names):
+    """
+    Decorate a handler to say that the params C{names} should be passed to
+    it as they were written, without being interpolated.  Control actions
+    use this for nested actions, which they run (and so interpolate) later.
+    """
+    def decorate(handler):
+        handler.deferredParams = frozenset(names)
+        return handler
+    return decorate
+
+
+def _deferredValue(value, context):
+    """
+    Evaluate a deferred param that's a bare C{$expression} (like C{actions:
+    $steps}), which would have been interpolated had it not been deferred.
+    """
+    if isinstance(value, basestring) and value.startswith('$'):
+        return evaluate(value[1:], context.variables)
+    return value
+
+
+def _body(actions, context):
+    """
+    Precompile nested actions that will be run many times, unless they
+    already are.  They may be given as a C{$expression} of a list of actions.
+    """
+    actions = _deferredValue(actions, context)
+    if all(isinstance(action, Template) for action in actions):
+        return actions
+    return precompile(actions)
+
+
+@deferredParams('actions')
 def _loop(params, context):
     """
     Loop through some actions in the context of a L{Runner} run.
+
+    C{iterable} needn't be a list: it's only advanced as the loop gets to
+    each item, so a generator can make items as they're needed.  Items which
+    are Deferreds (like the pages of C{http.paginate}) are waited for and
+    the loop runs with their results; one which fails with C{StopIteration}
+    ends the loop.
+    """
+    concurrency = params.get('concurrency')
+    if concurrency:
+        return _concurrentLoop(params, context, int(concurrency))
+    return _sequentialLoop(params, context)
+
+
+def _sequentialLoop(params, context):
+    """
+    Loop through some actions one item at a time.
+    """
+    actions = _body(params['actions'], context)
+    runActions = context.runner.runActionsInline
+    variables = context.variables
+    def run(item):
+        variables['item'] = item
+        return runActions(actions, context)
+    return _trampoline(_eachItem(params['iterable'], run))
+
+
+def _eachItem(iterable, f):
     """
-    for item in params['iterable']:
-        context.variables['item'] = item
-        result = yield context.runner.runActions(params['actions'], context)
-    defer.returnValue(result)
+    Generate C{f(item)} for each item of C{iterable}, for L{_trampoline}.
+    An item which is a Deferred is generated first, to be waited for, and
+    then C{f} of its result; if it fails with C{StopIteration} it's the last
+    thing generated and its result is the last result of C{f}.
+    """
+    items = iter(iterable)
+    last = [None]
+    box = []
+    ended = []
+    def remember(result):
+        last[0] = result
+        return result
+    def end(failure):
+        failure.trap(StopIteration)
+        ended.append(True)
+        return last[0]
+    def got(item):
+        box[:] = [item]
+    while not ended:
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        if isinstance(item, defer.Deferred):
+            yield item.addCallbacks(got, end)
+            if ended:
+                return
+            item = box[0]
+        result = f(item)
+        if isinstance(result, defer.Deferred):
+            result.addCallback(remember)
+        else:
+            last[0] = result
+        yield result
+
+
+def _concurrentLoop(params, context, concurrency):
+    """
+    Loop through some actions for up to C{concurrency} items at a time, each
+    in its own L{Context.scope}.  Unless C{errors} is C{collect}, the first
+    item to fail cancels the others still running.
+
+    @return: A Deferred list of each item's result in the order of the items.
+    """
+    collect = params.get('errors', 'fail') == 'collect'
+    actions = _body(params['actions'], context)
+    items = enumerate(params['iterable'])
+    results = {}
+    running = {}
+    failed = []
+
+    @cancellable
+    def work(waiting):
+        for index, item in items:
+            if failed:
+                break
+            if isinstance(item, defer.Deferred):
+                try:
+                    item = yield waiting.on(item)
+                except StopIteration:
+                    break
+            waiting.check()
+            scope = context.scope({'item': item})
+            d = running[index] = context.runner.runActions(actions, scope)
+            try:
+                result = yield waiting.on(d)
+            except Exception as e:
+                if not collect:
+                    if not failed:
+                        failed.append(Failure())
+                        for other in running.values():
+                            if other is not d:
+                                other.cancel()
+                    raise
+                result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            finally:
+                del running[index]
+            results[index] = result
+
+    d = defer.gatherResults([work() for i in xrange(concurrency)],
+                            consumeErrors=True)
+    d.addCallbacks(lambda _: [results[i] for i in xrange(len(results))],
+                   lambda err: failed[0] if failed else err.value.subFailure)
+    return d
+
+
+@deferredParams('branches')
+def _parallel(params, context):
+    """
+    Run some named lists of actions at the same time, each in its own
+    L{Context.scope} with a local C{$item} (so that loops in different
+    branches don't share it), at most C{concurrency} at once.  If one fails,
+    the others are cancelled.
+
+    @return: A Deferred dict of each branch's last result by name.  They're
+        also put in C{$_R} by name.
+    """
+    branches = _deferredValue(params['branches'], context)
+    concurrency = int(params.get('concurrency') or len(branches) or 1)
+    names = iter(sorted(branches))
+    results = {}
+    running = {}
+    failed = []
+
+    @cancellable
+    def work(waiting):
+        for name in names:
+            if failed:
+                break
+            waiting.check()
+            scope = context.scope({'item': context.variables.get('item')})
+            d = running[name] = context.runner.runActions(
+                _body(branches[name], context), scope)
+            try:
+                results[name] = yield waiting.on(d)
+            except Exception:
+                if not failed:
+                    failed.append(Failure())
+                    for other in running.values():
+                        if other is not d:
+                            other.cancel()
+                raise
+            finally:
+                del running[name]
+
+    def joined(ignored):
+        context.named_results.update(results)
+        return results
+
+    d = defer.gatherResults([work() for i in xrange(concurrency)],
+                            consumeErrors=True)
+    d.addCallbacks(joined, lambda err: failed[0] if failed else err)
+    return d
 
 
 def _set(params, context):
@@ -117,15 +896,91 @@ def basicRunner(handlers=None):
     handlers = handlers or {}
     handlers.update({
         'loop': _loop,
+        'parallel': _parallel,
         'set': _set,
         'ask': _ask,
         'dump': _dump,
         'append': _append,
+        'map': 'webpath.transform:mapItems',
+        'filter': 'webpath.transform:filterItems',
+        'sort': 'webpath.transform:sortItems',
+        'group': 'webpath.transform:groupItems',
+        'sum': 'webpath.transform:sumItems',
+        'columns': 'webpath.transform:columns',
     })
     return Runner(handlers)
 
 
 
+_GLOBALS = {"__builtins__": None}
+_expressions = LRUCache(1024)
+
+
+def compileExpression(source):
+    """
+    Compile the source of a C{$expression} (without the C{$}), reusing a
+    previously compiled code object if there is one.
+
+    @type source: str
+    @return: A code object suitable for C{eval}.
+    """
+    code = _expressions.get(source)
+    if code is None:
+        code = compile(source, '<webpath>', 'eval')
+        _expressions[source] = code
+    return code
+
+
+def evaluate(source, variables):
+    """
+    Evaluate the source of a C{$expression} against C{variables}.
+    """
+    return eval(compileExpression(source), _GLOBALS, variables)
+
+
+def evaluator(source, variables, name='item'):
+    """
+    Make a function which evaluates the source of a C{$expression} against
+    C{variables} with its argument as the variable C{name}, for evaluating
+    the same expression for many values.  The expression is compiled into
+    the function, reading the other variables as they are now, so each call
+    costs about as much as calling a function written in Python.
+    """
+    namespace = _flatten(variables)
+    namespace.update(_GLOBALS)
+    code = compileExpression('lambda %s: (\n%s\n)' % (name, source))
+    return eval(code, namespace)
+
+
+def renderer(item, variables, name='item'):
+    """
+    Make a function which renders C{item}, a dict or list which may contain
+    C{$expressions}, against C{variables} with its argument as the variable
+    C{name}, like L{evaluator} does for a single expression.
+    """
+    node = _compileItem(item)
+    namespace = _flatten(variables)
+    def render(value):
+        namespace[name] = value
+        return node(namespace)
+    return render
+
+
+def _flatten(variables):
+    """
+    Get a dict of all the variables visible in C{variables}, a dict or
+    L{Scope}.
+    """
+    scopes = []
+    while isinstance(variables, Scope):
+        scopes.append(variables)
+        variables = variables.parent
+    flat = dict(variables)
+    for scope in reversed(scopes):
+        flat.update(scope)
+    return flat
+
+
 def _interpolateItem(item, variables):
     """
     Replace all occurrences of $vars in C{item} with value from C{variables}.
@@ -135,8 +990,7 @@ def _interpolateItem(item, variables):
     """
     if type(item) in (str, unicode):
         if item.startswith('$'):
-            var_name = item[1:]
-            item = eval(var_name, {"__builtins__":None}, variables)
+            item = evaluate(item[1:], variables)
     elif type(item) in (dict,):
         item = interpolate(item, variables)
     elif type(item) in (tuple, list):
@@ -144,19 +998,227 @@ def _interpolateItem(item, variables):
     return item
 
 
-def interpolate(params, variables):
+def interpolate(params, variables, deferred=()):
     """
     Replace all occurrences of $vars in C{params} with value from C{variables}.
 
-    @type params: dict
+    @type params: dict or L{Template}
     @type variables: dict
+    @param deferred: Names of params to leave as they are.
     """
+    if isinstance(params, Template):
+        return params.render(variables, deferred)
     result = {}
     for k, v in params.items():
-        result[k] = _interpolateItem(v, variables)
+        if k in deferred:
+            result[k] = v
+        else:
+            result[k] = _interpolateItem(v, variables)
     return result
 
 
+def _compileItem(item, compileSource=compileExpression):
+    """
+    Compile C{item} into a function that accepts C{variables} and returns
+    C{item} with all its $vars replaced.  L{Template}s within C{item} are
+    left for whoever gets them to render.
+    """
+    if type(item) in (str, unicode):
+        if item.startswith('$'):
+            code = compileSource(item[1:])
+            return lambda variables: eval(code, _GLOBALS, variables)
+    elif type(item) in (dict,):
+        static, nodes = _compileDict(item, compileSource)
+        def render(variables):
+            ret = dict(static)
+            for k, n in nodes:
+                ret[k] = n(variables)
+            return ret
+        return render
+    elif type(item) in (tuple, list):
+        nodes = [_compileItem(x, compileSource) for x in item]
+        return lambda variables: [n(variables) for n in nodes]
+    return lambda variables: item
+
+
+def _compileDict(item, compileSource):
+    """
+    Split a dict into a dict of the values that never change and a list of
+    C{(key, function)} for the rest (see L{_compileItem}).
+    """
+    static = {}
+    nodes = []
+    for k, v in item.items():
+        if type(v) in (dict, tuple, list) or \
+                type(v) in (str, unicode) and v.startswith('$'):
+            nodes.append((k, _compileItem(v, compileSource)))
+        else:
+            static[k] = v
+    return static, nodes
+
+
+def _isSteps(item):
+    """
+    Whether C{item} is a (non-empty) list of actions.
+    """
+    return (type(item) in (tuple, list) and len(item) > 0 and
+            all(isinstance(x, dict) and 'action' in x for x in item))
+
+
+class Template(object):
+    """
+    I am a dict of params (usually an action) whose $vars have been compiled
+    ahead of time so that I can be rendered over and over cheaply.
+    """
+
+    def __init__(self, params, compileSource=compileExpression):
+        self.params = params
+        self._static, self._nodes = _compileDict(params, compileSource)
+        self._bodies = {}
+
+
+    def render(self, variables, deferred=()):
+        """
+        Get my params with their $vars replaced by values from C{variables}.
+
+        @param deferred: Names of params to leave as they are, except that
+            lists of actions are given as L{Template}s so that they're only
+            compiled once.
+        """
+        ret = dict(self._static)
+        for k, node in self._nodes:
+            if k in deferred:
+                ret[k] = self._deferred(k)
+            else:
+                ret[k] = node(variables)
+        return ret
+
+
+    def _deferred(self, key):
+        value = self.params[key]
+        if not _isSteps(value) and type(value) is not dict:
+            return value
+        body = self._bodies.get(key)
+        if body is None:
+            body = self._bodies[key] = _precompileBodies(value)
+        return body
+
+
+    def __getitem__(self, key):
+        return self.params[key]
+
+
+    def __repr__(self):
+        return '<Template %r>' % (self.params,)
+
+
+
+class Step(Template):
+    """
+    I am an action in a L{Plan}: a L{Template} whose handler has already been
+    looked up.  Nested lists of actions in my params are lists of L{Step}s,
+    which are rendered when they're run rather than when I am.
+    """
+
+    def __init__(self, params, handler, compileSource=compileExpression):
+        Template.__init__(self, params, compileSource)
+        self.handler = handler
+
+
+    def __repr__(self):
+        return '<Step %r>' % (self.params,)
+
+
+
+class Plan(list):
+    """
+    I am a checked and compiled list of L{Step}s, made by L{Runner.compile}.
+
+    @ivar actions: The list of actions I was compiled from.
+    @ivar expressions: Dict of the source of every $expression in me to its
+        code object.
+    """
+
+    def __init__(self, steps, actions, expressions):
+        list.__init__(self, steps)
+        self.actions = actions
+        self.expressions = expressions
+
+
+
+class PlanError(Exception):
+    """
+    A list of actions can't be compiled into a L{Plan}.
+
+    @ivar errors: List of descriptions of everything wrong with the actions.
+    """
+
+    def __init__(self, errors):
+        Exception.__init__(self, '\n'.join(errors))
+        self.errors = errors
+
+
+
+def _precompileBodies(value):
+    """
+    Precompile a list of actions, or the lists of actions in a dict.
+    """
+    if _isSteps(value):
+        return precompile(value)
+    elif type(value) is dict:
+        return dict([(k, _precompileBodies(v)) for k, v in value.items()])
+    return value
+
+
+def precompile(actions):
+    """
+    Compile a list of actions into a list of L{Template}s which can be passed
+    to L{Runner.runActions} in place of the original actions.
+    """
+    return [Template(action) for action in actions]
+
+
+
+class Scope(dict):
+    """
+    I am a set of variables layered over another set of variables.  Names I'm
+    created with are local to me; all others are read from and written to
+    my parent.
+    """
+
+    def __init__(self, parent, local):
+        dict.__init__(self, local)
+        self.parent = parent
+
+
+    def __missing__(self, key):
+        return self.parent[key]
+
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.parent
+
+
+    def __setitem__(self, key, value):
+        if dict.__contains__(self, key):
+            dict.__setitem__(self, key, value)
+        else:
+            self.parent[key] = value
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+
 
 class Context(object):
     """
@@ -164,18 +1226,73 @@ class Context(object):
     """
 
     runner = None
-    requests = None
+    pool = None
+    trace = _trace.NO_TRACE
+    deadline = None
 
 
-    def __init__(self, user_input_func=None):
-        import requests
-        self.results = []
+    def __init__(self, user_input_func=None, pool=None, documents=None,
+                 retention='all', summarize=False):
+        """
+        @param user_input_func: Function called by L{getUserInput}.
+        @param pool: A L{webpath.pool.ConnectionPool} for C{requests} to use
+            instead of the default (unshared) pool.
+        @param documents: A L{webpath.document.DocumentCache} for HTML
+            actions to use instead of a new one.  (Otherwise one is made
+            when it's first used, as is the C{requests} session, so that
+            runs which don't need them needn't import them.)
+        @param retention: Which results to keep in C{results}: C{'all'},
+            C{'named'} (only those of named actions), C{'none'} or a number
+            to keep only that many of the most recent.  Named results are
+            always available in C{named_results}.
+        @param summarize: If true, keep a summary (see L{summarizeResult})
+            of each HTTP response in C{results} instead of the response.
+        """
+        if retention in ('all', 'named', 'none'):
+            self.results = []
+        else:
+            self.results = collections.deque(maxlen=int(retention))
+        self.retention = retention
+        self.summarize = summarize
         self.named_results = {}
         self.variables = {
             '_R': self.named_results,
         }
         self._user_input_func = user_input_func
-        self.requests = requests.Session()
+        self.pool = pool
+        # shared by scopes, so they share what's made lazily
+        self._shared = {'documents': documents}
+
+
+    @property
+    def requests(self):
+        """
+        The C{requests.Session} for HTTP actions to use.
+        """
+        session = self._shared.get('requests')
+        if session is None:
+            import requests
+            session = self._shared['requests'] = requests.Session()
+            if self.pool is not None:
+                self.pool.mount(session)
+        return session
+
+
+    @requests.setter
+    def requests(self, session):
+        self._shared['requests'] = session
+
+
+    @property
+    def documents(self):
+        """
+        The L{webpath.document.DocumentCache} for HTML actions to use.
+        """
+        documents = self._shared.get('documents')
+        if documents is None:
+            from webpath.document import DocumentCache
+            documents = self._shared['documents'] = DocumentCache()
+        return documents
 
 
     def __repr__(self):
@@ -183,12 +1300,41 @@ class Context(object):
             self.runner, self.variables, self.results)
 
 
+    def scope(self, variables):
+        """
+        Make a child context which shares everything with me except that
+        C{variables} and C{_} (the last result) are local to it.
+
+        @param variables: Dict of variables local to the child.
+        """
+        child = copy.copy(self)
+        local = {'_': self.variables.get('_')}
+        local.update(variables)
+        child.variables = Scope(self.variables, local)
+        return child
+
+
+    def timeLeft(self):
+        """
+        Get the seconds left until the current action or run has to be done
+        (see L{Runner.runActions}), or C{None} if there's no limit.  Handlers
+        which block a thread should give up by then.
+        """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - self.runner.reactor.seconds(), 0)
+
+
     def saveResult(self, result, name=None):
         """
         @param result: Save a result.
         """
         self.variables['_'] = result
-        self.results.append(result)
+        if self.retention == 'none':
+            pass
+        elif self.retention != 'named' or name is not None:
+            self.results.append(summarizeResult(result) if self.summarize
+                                else result)
         if name is not None:
             self.named_results[name] = result
         return result
@@ -208,3 +1354,20 @@ class Context(object):
                                    key, prompt, kwargs)
 
 
+
+def summarizeResult(result):
+    """
+    Summarize a C{requests} Response as a dict of its C{url}, C{status_code},
+    C{reason}, C{headers} and body C{size}, so that the body needn't be kept.
+    Other results are returned as they are.
+    """
+    if not hasattr(result, 'status_code') or not hasattr(result, 'headers'):
+        return result
+    content = getattr(result, '_content', None)
+    return {
+        'url': result.url,
+        'status_code': result.status_code,
+        'reason': result.reason,
+        'headers': dict(result.headers),
+        'size': len(content) if isinstance(content, basestring) else None,
+    }
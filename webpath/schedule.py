@@ -0,0 +1,235 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Pacing HTTP requests per host: a token bucket for the rate, a limit on
+concurrent requests and retries with backoff, so that many scripts run at
+once don't get throttled (or blocked) by the institution they're all using.
+"""
+
+from twisted.internet import defer, error, task
+from twisted.web.client import ResponseFailed
+
+from collections import deque
+
+import itertools
+import random
+import urlparse
+
+import requests
+
+from webpath.runner import cancellable
+
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT',
+                                'DELETE'])
+
+RETRY_STATUS = frozenset([429, 502, 503, 504])
+
+RETRY_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    error.ConnectError,
+    error.ConnectionLost,
+    ResponseFailed,
+)
+
+
+class HostScheduler(object):
+    """
+    I queue HTTP requests per host and start them only as fast as C{rate}
+    (with bursts of up to C{burst}) allows and while fewer than
+    C{concurrency} are running.  Requests beyond that wait in order.
+
+    Idempotent requests which fail to connect or get a 429, 502, 503 or 504
+    response are retried up to C{retries} times after a random delay of up
+    to C{backoff * 2 ** attempt} seconds (capped at C{maxBackoff}), or as
+    long as the response's C{Retry-After} says.
+
+    Wrap HTTP handlers with L{wrap} to use me.
+    """
+
+    def __init__(self, rate=None, burst=1, concurrency=None, retries=0,
+                 backoff=0.5, maxBackoff=30.0, reactor=None,
+                 random=random.random):
+        """
+        @param rate: Requests per second per host, or C{None} for no limit.
+        @param burst: Requests a host may get at once after being idle.
+        @param concurrency: Requests at once per host, or C{None} for no
+            limit.
+        @param reactor: Provider of C{IReactorTime} to measure and wait with.
+        @param random: Function returning a random float in [0, 1) to jitter
+            backoff with.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.reactor = reactor
+        self.random = random
+        self.hosts = {}
+
+
+    def wrap(self, handler):
+        """
+        Make an HTTP handler which schedules the requests of C{handler}.
+        """
+        def request(params, context):
+            return self.request(handler, params, context)
+        return request
+
+
+    def stats(self):
+        """
+        Get the state of each host's queue.
+
+        @return: A dict of host to a dict of how many requests are
+            C{queued} and C{active}, how many were C{started} and
+            C{retried} and the total seconds they C{waited} in the queue.
+        """
+        return dict((name, host.stats()) for name, host in self.hosts.items())
+
+
+    @cancellable
+    def request(self, handler, params, context, waiting):
+        """
+        Make a request with C{handler} when the host it's for is ready,
+        retrying it if it's idempotent and fails.
+        """
+        kwargs = params['kwargs']
+        name = urlparse.urlsplit(kwargs['url']).netloc.lower()
+        host = self.hosts.get(name)
+        if host is None:
+            host = self.hosts[name] = _Host(self)
+        trace = context.trace
+        idempotent = kwargs.get('method', 'get').upper() in IDEMPOTENT_METHODS
+        for attempt in itertools.count():
+            waiting.check()
+            waited = yield waiting.on(host.acquire())
+            trace.add('queue_wait', waited)
+            try:
+                result = yield waiting.on(
+                    defer.maybeDeferred(handler, params, context))
+            except RETRY_ERRORS:
+                if not idempotent or attempt >= self.retries:
+                    raise
+                delay = self.delay(attempt)
+            else:
+                status = getattr(result, 'status_code', None)
+                if status not in RETRY_STATUS or not idempotent or \
+                        attempt >= self.retries:
+                    defer.returnValue(result)
+                delay = self.delay(attempt, result)
+                if hasattr(result, 'close'):
+                    result.close()
+            finally:
+                host.release()
+            host.retried += 1
+            trace.count('retries')
+            waiting.check()
+            yield waiting.on(task.deferLater(self.reactor, delay,
+                                             lambda: None))
+
+
+    def delay(self, attempt, response=None):
+        """
+        Get how long to wait before retrying a request for the C{attempt}th
+        time (from 0).
+        """
+        if response is not None:
+            try:
+                return min(float(response.headers['retry-after']),
+                           self.maxBackoff)
+            except (KeyError, TypeError, ValueError):
+                pass
+        return min(self.backoff * 2 ** attempt, self.maxBackoff) * \
+            self.random()
+
+
+
+class _Host(object):
+    """
+    I am the queue and token bucket of one host.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.tokens = scheduler.burst
+        self.updated = scheduler.reactor.seconds()
+        self.active = 0
+        self.queue = deque()
+        self.started = 0
+        self.retried = 0
+        self.waited = 0.0
+        self._call = None
+
+
+    def stats(self):
+        return {
+            'queued': len(self.queue),
+            'active': self.active,
+            'started': self.started,
+            'retried': self.retried,
+            'waited': self.waited,
+        }
+
+
+    def acquire(self):
+        """
+        Wait for my turn.
+
+        @return: A Deferred which fires with the seconds waited.
+        """
+        d = defer.Deferred(self._cancel)
+        self.queue.append((d, self.scheduler.reactor.seconds()))
+        self._pump()
+        return d
+
+
+    def release(self):
+        self.active -= 1
+        self._pump()
+
+
+    def _cancel(self, d):
+        for i, (queued, ignored) in enumerate(self.queue):
+            if queued is d:
+                del self.queue[i]
+                break
+
+
+    def _pump(self):
+        """
+        Start as many queued requests as I can now, and arrange to start the
+        rest when I'll have enough tokens for them.
+        """
+        scheduler = self.scheduler
+        now = scheduler.reactor.seconds()
+        rate = scheduler.rate
+        if rate is not None:
+            self.tokens = min(self.tokens + (now - self.updated) * rate,
+                              scheduler.burst)
+        self.updated = now
+        limit = scheduler.concurrency
+        while self.queue and (limit is None or self.active < limit):
+            if rate is not None:
+                if self.tokens < 1:
+                    if self._call is None:
+                        self._call = scheduler.reactor.callLater(
+                            (1 - self.tokens) / rate, self._wake)
+                    break
+                self.tokens -= 1
+            d, queued = self.queue.popleft()
+            self.active += 1
+            self.started += 1
+            self.waited += now - queued
+            d.callback(now - queued)
+
+
+    def _wake(self):
+        self._call = None
+        self._pump()
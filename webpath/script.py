@@ -1,10 +1,22 @@
 from twisted.internet import task, defer
 from twisted.python import usage
 
+import itertools
 import sys
 
-from webpath.runner import basicRunner, Context
-from webpath import http
+# Modules which import requests, lxml or twisted.web are imported when
+# they're needed, so that scripts which don't need them start faster (see
+# benchmarks/startup.py).
+from webpath.runner import basicRunner, Context, PlanError
+from webpath.pool import ConnectionPool
+from webpath.batch import Batch, ScriptCache
+from webpath.plan import PlanCache
+from webpath.trace import Profile
+
+
+# The actions installed by webpath.http.installHTTPHandlers.
+HTTP_ACTIONS = ['http', 'http.download', 'http.paginate', 'http.getForms',
+                'html.xpath', 'html.css', 'html.table', 'html.evict']
 
 
 def getUserInput(id, prompt, kwargs):
@@ -15,41 +27,385 @@ def getUserInput(id, prompt, kwargs):
     return raw_input(nice_prompt)
 
 
+def httpEngine(name, pool):
+    """
+    Get the engine for the C{http} action named C{name}, using C{pool}.
+    """
+    if name == 'agent':
+        from twisted.internet import reactor
+        from webpath.httpagent import AgentEngine
+        return AgentEngine(reactor, pool=pool.agentPool(reactor))
+    return name
+
+
+def scriptLoader(path):
+    """
+    Get the function which loads the steps in the file at C{path} from a
+    file-like object.  Files ending in C{.json} are JSON; all others are YAML.
+    """
+    fmt = 'json' if path.endswith('.json') else 'yaml'
+    return getattr(Serializer(), 'load_' + fmt)
+
+
+def loadScript(path):
+    """
+    Load the steps in the file at C{path}.
+    """
+    fh = open(path, 'rb')
+    try:
+        return scriptLoader(path)(fh)
+    finally:
+        fh.close()
+
+
 class Serializer(object):
+    """
+    I read and write steps and results.  YAML is handled by libyaml when
+    PyYAML was built with it.  Results are written a piece at a time so that
+    the whole output never has to be held as a string.
+    """
 
 
-    def load_yaml(self, fh):
+    def _yaml(self):
         import yaml
-        return yaml.load(fh.read())
+        return (yaml, getattr(yaml, 'CLoader', yaml.Loader),
+                getattr(yaml, 'CDumper', yaml.Dumper))
+
+
+    def load_yaml(self, fh):
+        yaml, Loader, Dumper = self._yaml()
+        return yaml.load(fh, Loader=Loader)
 
 
     def dump_yaml(self, data, fh):
-        import yaml
-        fh.write(yaml.dump(data, default_flow_style=False))
+        yaml, Loader, Dumper = self._yaml()
+        if isinstance(data, list) and data:
+            for item in data:
+                yaml.dump([item], fh, Dumper=Dumper, default_flow_style=False)
+        else:
+            yaml.dump(data, fh, Dumper=Dumper, default_flow_style=False)
         fh.flush()
 
 
     def load_json(self, fh):
         import json
-        return json.loads(fh.read())
+        return json.load(fh)
 
 
     def dump_json(self, data, fh):
         import json
-        fh.write(json.dumps(data, indent=2))
+        chunks = json.JSONEncoder(indent=2).iterencode(data)
+        while True:
+            chunk = ''.join(itertools.islice(chunks, 4096))
+            if not chunk:
+                break
+            fh.write(chunk)
+        fh.flush()
+
+
+    def load_jsonl(self, fh):
+        """
+        Load a list from a JSON Lines file, one element per line.
+        """
+        return list(self.iter_jsonl(fh))
+
+
+    def dump_jsonl(self, data, fh):
+        """
+        Write a result as JSON Lines: one line per element if it's a list or
+        else a single line.
+        """
+        import json
+        if not isinstance(data, list):
+            data = [data]
+        for item in data:
+            fh.write(json.dumps(item) + '\n')
         fh.flush()
 
 
+    def iter_yaml(self, fh):
+        """
+        Iterate through the documents in a YAML stream.  Documents that are
+        lists are iterated through too.
+        """
+        yaml, Loader, Dumper = self._yaml()
+        for doc in yaml.load_all(fh, Loader=Loader):
+            if isinstance(doc, list):
+                for item in doc:
+                    yield item
+            elif doc is not None:
+                yield doc
+
+
+    def iter_jsonl(self, fh):
+        """
+        Iterate through the lines of a JSON Lines file.
+        """
+        import json
+        for line in fh:
+            if line.strip():
+                yield json.loads(line)
+
+
 
-class RunOptions(usage.Options):
+class HTTPOptions(usage.Options):
+    """
+    Options for commands that run steps which make HTTP requests.
+    """
+
+    optParameters = [
+        ('http-engine', None, "requests",
+         "Engine for http actions: requests or agent"),
+        ('max-connections', None, 10,
+         "Maximum persistent connections per host", int),
+        ('keepalive-timeout', None, None,
+         "Seconds before idle connections are closed", float),
+        ('retries', None, 0, "Times to retry failed connections", int),
+        ('plan-cache', None, None,
+         "Directory to keep compiled scripts in between runs"),
+        ('http-cache-size', None, 256,
+         "HTTP responses to cache in memory with --http-cache", int),
+        ('http-cache-dir', None, None,
+         "Directory to cache HTTP responses in between runs (implies "
+         "--http-cache)"),
+        ('host-rate', None, None,
+         "Requests per second to send to each host", float),
+        ('host-burst', None, 1,
+         "Requests to send to an idle host at once with --host-rate", int),
+        ('host-concurrency', None, None,
+         "Requests to have in flight to each host at once", int),
+        ('request-retries', None, 0,
+         "Times to retry idempotent requests which fail or are throttled",
+         int),
+        ('retry-backoff', None, 0.5,
+         "Seconds to back off before the first retry (doubled for each "
+         "retry and jittered)", float),
+        ('record', None, None,
+         "Record all HTTP traffic to this archive"),
+        ('replay', None, None,
+         "Answer HTTP requests from this archive instead of the network"),
+        ('replay-latency', None, "0",
+         "Seconds to wait before each replayed response, or 'recorded'"),
+        ('replay-bandwidth', None, None,
+         "Bytes per second to replay response bodies at", float),
+        ('timeout', None, None,
+         "Seconds a script (or each job) may run for", float),
+        ('io-threads', None, None,
+         "Threads to make HTTP requests in (default: the reactor's thread "
+         "pool)", int),
+        ('cpu-workers', None, 0,
+         "Processes to parse HTML in (0 parses on the reactor thread; "
+         "-1 for one per CPU)", int),
+        ('keep-results', None, "all",
+         "Results to keep for the whole run: all, named, none or a number "
+         "of the most recent"),
+    ]
+
+    optFlags = [
+        ('pool-block', None, "Wait for a free connection rather than "
+         "opening more than --max-connections"),
+        ('pool-stats', None, "Write connection reuse and HTTP cache stats "
+         "to stderr"),
+        ('http-cache', None, "Cache HTTP responses as their headers allow"),
+        ('summarize-results', None, "Keep summaries of HTTP responses "
+         "rather than their bodies"),
+    ]
+
+
+    def postOptions(self):
+        keep = self['keep-results']
+        if keep not in ('all', 'named', 'none') and not keep.isdigit():
+            raise usage.UsageError('--keep-results must be all, named, none '
+                                   'or a number')
+        if self['record'] and self['replay']:
+            raise usage.UsageError('--record and --replay are exclusive')
+        if (self['record'] or self['replay']) and \
+                self['http-engine'] != 'requests':
+            raise usage.UsageError('--record and --replay only work with '
+                                   'the requests engine')
+        if self['replay-latency'] != 'recorded':
+            try:
+                self['replay-latency'] = float(self['replay-latency'])
+            except ValueError:
+                raise usage.UsageError("--replay-latency must be a number "
+                                       "or 'recorded'")
+
+
+    def makePool(self):
+        """
+        Make a L{ConnectionPool} as configured.
+        """
+        return ConnectionPool(maxPerHost=self['max-connections'],
+                              block=bool(self['pool-block']),
+                              idleTimeout=self['keepalive-timeout'],
+                              retries=self['retries'])
+
+
+    def makeTransport(self, pool):
+        """
+        Make the adapter which records or replays HTTP traffic as configured,
+        or C{None} if traffic should just go through C{pool}.
+        """
+        if self['record']:
+            from webpath.replay import RecordingAdapter
+            return RecordingAdapter(self['record'], pool.adapter)
+        if self['replay']:
+            from webpath.replay import ReplayAdapter
+            return ReplayAdapter(self['replay'],
+                                 latency=self['replay-latency'],
+                                 bandwidth=self['replay-bandwidth'])
+
+
+    def finishTransport(self, transport):
+        """
+        Finish writing the recording made by C{transport}, if it's recording.
+        """
+        if self['record']:
+            transport.finish()
+
+
+    def makeContext(self, user_input_func, pool, transport=None):
+        """
+        Make a L{Context} which uses C{pool} (or C{transport}, if given) and
+        keeps results as configured.
+        """
+        keep = self['keep-results']
+        context = Context(user_input_func, pool=pool,
+                          retention=int(keep) if keep.isdigit() else keep,
+                          summarize=bool(self['summarize-results']))
+        if transport is not None:
+            transport.mount(context.requests)
+        return context
+
+
+    def makeCache(self):
+        """
+        Make an L{HTTPCache} as configured, or C{None} if there should be no
+        cache.
+        """
+        if self['http-cache'] or self['http-cache-dir']:
+            from webpath.httpcache import HTTPCache
+            return HTTPCache(self['http-cache-size'], self['http-cache-dir'])
+
+
+    def makeScheduler(self):
+        """
+        Make a L{HostScheduler} as configured, or C{None} if requests needn't
+        be scheduled.
+        """
+        if self['host-rate'] or self['host-concurrency'] or \
+                self['request-retries']:
+            from webpath.schedule import HostScheduler
+            return HostScheduler(rate=self['host-rate'],
+                                 burst=self['host-burst'],
+                                 concurrency=self['host-concurrency'],
+                                 retries=self['request-retries'],
+                                 backoff=self['retry-backoff'])
+
+
+    def makeExecutors(self):
+        """
+        Make the executors for a runner as configured (see
+        L{webpath.runner.Runner.execute}).
+        """
+        executors = {}
+        if self['io-threads']:
+            from webpath.executor import ThreadExecutor
+            executors['io'] = ThreadExecutor(self['io-threads'])
+        if self['cpu-workers']:
+            from webpath.executor import ProcessExecutor
+            executors['cpu'] = ProcessExecutor(
+                None if self['cpu-workers'] < 0 else self['cpu-workers'])
+        return executors
+
+
+    def makeRunner(self, pool, cache=None, scheduler=None):
+        """
+        Make a runner which can do HTTP using C{pool}, C{cache} and
+        C{scheduler}.
+        """
+        runner = basicRunner()
+        runner.executors.update(self.makeExecutors())
+        def install():
+            from webpath import http
+            http.installHTTPHandlers(runner, httpEngine(self['http-engine'],
+                                                        pool),
+                                     cache, scheduler)
+        runner.registerLazyHandlers(HTTP_ACTIONS, install)
+        return runner
+
+
+    def stopRunner(self, runner):
+        """
+        Stop the threads and processes of C{runner}'s executors.
+        """
+        for executor in runner.executors.values():
+            executor.stop()
+
+
+    def compileScript(self, runner, fh, load):
+        """
+        Load steps from C{fh} with C{load} and compile them for C{runner},
+        using the plan cache if there is one.
+
+        @raise PlanError: If the steps aren't valid.
+        """
+        if self['plan-cache']:
+            return PlanCache(self['plan-cache']).get(fh.read(), load, runner)
+        return runner.compile(load(fh))
+
+
+    def makeScripts(self, runner):
+        """
+        Make a L{ScriptCache} of scripts compiled for C{runner}.
+        """
+        def load(path):
+            fh = open(path, 'rb')
+            try:
+                return self.compileScript(runner, fh, scriptLoader(path))
+            finally:
+                fh.close()
+        return ScriptCache(load, runner.compile)
+
+
+    def reportPool(self, pool, cache=None, scheduler=None):
+        """
+        Write C{pool}'s (and C{cache}'s and C{scheduler}'s) stats to stderr
+        if asked to.
+        """
+        if self['pool-stats']:
+            sys.stderr.write('connections: %(requests)d requests, '
+                             '%(opened)d opened, %(reused)d reused\n'
+                             % pool.stats())
+            if cache is not None:
+                sys.stderr.write('http cache: %(hits)d hits, %(misses)d '
+                                 'misses, %(revalidated)d revalidated, '
+                                 '%(stored)d stored\n' % cache.stats())
+            if scheduler is not None:
+                for host, stats in sorted(scheduler.stats().items()):
+                    sys.stderr.write('%s: %d requests, %d retried, %.3f s '
+                                     'queued\n' % (host, stats['started'],
+                                                   stats['retried'],
+                                                   stats['waited']))
+
+
+
+class RunOptions(HTTPOptions):
 
     synopsis = 'Run a set of steps'
 
     optParameters = [
         ('input', 'i', None, "Input filename (default stdin)"),
-        ('input-format', 'f', "yaml", "Input format"),
+        ('input-format', 'f', "yaml", "Input format: yaml, json or jsonl"),
         ('output', 'o', None, "Output filename (default stdout)"),
-        ('output-format', 'F', "yaml", "Output format"),
+        ('output-format', 'F', "yaml", "Output format: yaml, json or jsonl"),
+        ('profile-trace', None, None,
+         "Write a Chrome trace (JSON) of every action to this file"),
+    ]
+
+    optFlags = [
+        ('profile', None, "Write a summary of where time was spent to "
+         "stderr"),
     ]
 
 
@@ -67,23 +423,199 @@ class RunOptions(usage.Options):
         serializer = Serializer()
         load = getattr(serializer, 'load_' + options['input-format'])
 
-        actions = load(ifh)
-
-        context = Context(getUserInput)
-        runner = basicRunner()
-        http.installHTTPHandlers(runner)
-
-        result = yield runner.runActions(actions, context)
+        pool = options.makePool()
+        cache = options.makeCache()
+        scheduler = options.makeScheduler()
+        runner = options.makeRunner(pool, cache, scheduler)
+        actions = options.compileScript(runner, ifh, load)
+        transport = options.makeTransport(pool)
+        context = options.makeContext(getUserInput, pool, transport)
+
+        profile = None
+        if options['profile'] or options['profile-trace']:
+            profile = Profile()
+            runner.addObserver(profile.observe)
+
+        try:
+            result = yield runner.runActions(actions, context,
+                                             options['timeout'])
+        finally:
+            options.finishTransport(transport)
+            options.stopRunner(runner)
+            if profile is not None:
+                options.reportProfile(profile)
+        options.reportPool(pool, cache, scheduler)
 
         dump = getattr(serializer, 'dump_' + options['output-format'])
         dump(result, ofh)
 
 
 
+    def reportProfile(self, profile):
+        """
+        Write C{profile}'s summary and trace where asked to.
+        """
+        if self['profile']:
+            sys.stderr.write(profile.formatSummary())
+        if self['profile-trace']:
+            fh = open(self['profile-trace'], 'wb')
+            try:
+                profile.writeChromeTrace(fh)
+            finally:
+                fh.close()
+
+
+
+class BatchOptions(HTTPOptions):
+
+    synopsis = 'Run many scripts in one process'
+
+    longdesc = ('Read a stream of jobs and write the outcome of each one as '
+                'a line of JSON as soon as it finishes.  Each job is a dict '
+                'with "script" (a filename) or "steps" (a list of steps) and '
+                'optionally "id", "variables" (initial variables) and '
+                '"input" (answers to ask actions by key).')
+
+    optParameters = [
+        ('input', 'i', None, "Jobs filename (default stdin)"),
+        ('input-format', 'f', "jsonl", "Jobs format: jsonl or yaml"),
+        ('output', 'o', None, "Output filename (default stdout)"),
+        ('jobs', 'j', 4, "Number of jobs to run at once", int),
+    ]
+
+
+    @defer.inlineCallbacks
+    def doCommand(self, options, global_options):
+        import json
+        ifh = sys.stdin
+        if options['input']:
+            ifh = open(options['input'], 'rb')
+
+        ofh = sys.stdout
+        if options['output']:
+            ofh = open(options['output'], 'wb')
+
+        if options['input-format'] == 'jsonl':
+            # each line is parsed as its job starts, so that a bad one only
+            # fails that job
+            jobs = (line for line in ifh if line.strip())
+            parse = json.loads
+        else:
+            serializer = Serializer()
+            jobs = getattr(serializer, 'iter_' + options['input-format'])(ifh)
+            parse = None
+
+        def report(outcome):
+            ofh.write(json.dumps(outcome, default=repr) + '\n')
+            ofh.flush()
+
+        pool = options.makePool()
+        cache = options.makeCache()
+        scheduler = options.makeScheduler()
+        runner = options.makeRunner(pool, cache, scheduler)
+        transport = options.makeTransport(pool)
+        batch = Batch(runner,
+                      lambda user_input_func: options.makeContext(
+                          user_input_func, pool, transport),
+                      options.makeScripts(runner),
+                      concurrency=options['jobs'],
+                      timeout=options['timeout'])
+        try:
+            yield batch.run(jobs, report, parse)
+        finally:
+            options.finishTransport(transport)
+            options.stopRunner(runner)
+        options.reportPool(pool, cache, scheduler)
+
+
+
+class ServeOptions(HTTPOptions):
+
+    synopsis = 'Run jobs sent over HTTP'
+
+    longdesc = ('Accept jobs (see batch) as JSON POSTed to /runs.  Responses '
+                'are sent when the run is done or waiting for input, which '
+                'is given by POSTing {"value": ...} to /runs/<id>/input.  '
+                'Prometheus metrics are at /metrics.')
+
+    optParameters = [
+        ('listen', 'l', 'tcp:8080:interface=127.0.0.1',
+         "Endpoint to listen on (e.g. tcp:8080 or unix:/path/to/socket)"),
+        ('keep-runs', None, 600,
+         "Seconds to keep a run that's over or waiting for input before "
+         "forgetting (and cancelling) it", float),
+    ]
+
+
+    def doCommand(self, options, global_options):
+        from twisted.internet import reactor, endpoints
+        from twisted.web.resource import Resource
+        from twisted.web.server import Site
+        from webpath.server import Worker, RunsResource, MetricsResource
+        from webpath.metrics import Registry, RunnerMetrics, Callback
+
+        pool = options.makePool()
+        cache = options.makeCache()
+        scheduler = options.makeScheduler()
+        runner = options.makeRunner(pool, cache, scheduler)
+        transport = options.makeTransport(pool)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      options.finishTransport, transport)
+        reactor.addSystemEventTrigger('before', 'shutdown',
+                                      options.stopRunner, runner)
+        worker = Worker(runner,
+                        lambda user_input_func: options.makeContext(
+                            user_input_func, pool, transport),
+                        options.makeScripts(runner),
+                        timeout=options['timeout'],
+                        keep=options['keep-runs'])
+        registry = Registry()
+        runner.addObserver(RunnerMetrics(registry).observe)
+        registry.add(Callback('webpath_runs', 'Runs the server knows of.',
+                              'gauge', worker.states, ['state']))
+        for stat, help in [('requests', 'HTTP requests made.'),
+                           ('opened', 'HTTP connections opened.'),
+                           ('reused', 'HTTP requests on reused connections.')]:
+            registry.add(Callback('webpath_pool_%s_total' % (stat,), help,
+                                  'counter',
+                                  lambda stat=stat: pool.stats()[stat]))
+        if cache is not None:
+            registry.add(Callback(
+                'webpath_http_cache_total', 'HTTP cache lookups by result.',
+                'counter', lambda: dict(((result,), n) for result, n in
+                                        cache.stats().items()
+                                        if result != 'stored'),
+                ['result']))
+        if scheduler is not None:
+            def hostStats(name):
+                return lambda: dict(((host,), stats[name]) for host, stats in
+                                    scheduler.stats().items())
+            for name, metric, help, type in [
+                    ('queued', 'webpath_http_queued_requests',
+                     'HTTP requests waiting for their turn.', 'gauge'),
+                    ('active', 'webpath_http_active_requests',
+                     'HTTP requests in flight.', 'gauge'),
+                    ('waited', 'webpath_http_queue_wait_seconds_total',
+                     'Time HTTP requests spent waiting for their turn.',
+                     'counter')]:
+                registry.add(Callback(metric, help, type, hostStats(name),
+                                      ['host']))
+        root = Resource()
+        root.putChild('runs', RunsResource(worker))
+        root.putChild('metrics', MetricsResource(registry))
+        endpoint = endpoints.serverFromString(reactor, options['listen'])
+        d = endpoint.listen(Site(root))
+        d.addCallback(lambda ign: defer.Deferred())
+        return d
+
+
+
 class Options(usage.Options):
     
     subCommands = [
         ('run', None, RunOptions, RunOptions.synopsis),
+        ('batch', None, BatchOptions, BatchOptions.synopsis),
+        ('serve', None, ServeOptions, ServeOptions.synopsis),
     ]
 
 
@@ -91,7 +623,17 @@ def main(reactor, args):
     options = Options()
     options.parseOptions(args[1:])
     subOptions = options.subOptions
-    return defer.maybeDeferred(subOptions.doCommand, subOptions, options)
+    d = defer.maybeDeferred(subOptions.doCommand, subOptions, options)
+    d.addErrback(_reportPlanError)
+    return d
+
+
+def _reportPlanError(err):
+    err.trap(PlanError)
+    sys.stderr.write('Invalid steps:\n')
+    for error in err.value.errors:
+        sys.stderr.write('  %s\n' % (error,))
+    raise SystemExit(1)
 
 
 def run():
@@ -0,0 +1,344 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.internet import defer
+from twisted.web.resource import Resource, NoResource
+from twisted.web.server import NOT_DONE_YET
+
+import json
+import uuid
+
+from webpath.batch import startJob
+
+
+class Run(object):
+    """
+    I am one run of a job (see L{webpath.batch.Batch}) in a L{Worker}.
+
+    @ivar state: One of C{'running'}, C{'pending-input'}, C{'done'} or
+        C{'failed'}.
+    """
+
+    job = None
+
+
+    def __init__(self, id, answers=None):
+        self.id = id
+        self.state = 'running'
+        self.changes = 0
+        self.result = None
+        self.error = None
+        self.prompt = None
+        self._answers = dict(answers or {})
+        self._answer = None
+        self._waiting = []
+
+
+    def getUserInput(self, key, prompt, kwargs):
+        """
+        Answer an C{ask} action from the answers I was given, or else wait in
+        the C{'pending-input'} state until L{answer} is called.
+        """
+        if key in self._answers:
+            return self._answers.pop(key)
+        self.prompt = {'key': key, 'prompt': prompt, 'kwargs': kwargs}
+        self._answer = defer.Deferred()
+        self._setState('pending-input')
+        return self._answer
+
+
+    def answer(self, value):
+        """
+        Answer the pending C{ask} action.
+        """
+        if self.state != 'pending-input':
+            raise ValueError('Run %s is not waiting for input' % (self.id,))
+        d, self._answer = self._answer, None
+        self.prompt = None
+        self.state = 'running'
+        self.changes += 1
+        d.callback(value)
+
+
+    def finished(self, result):
+        self.result = result
+        self._setState('done')
+
+
+    def failed(self, err):
+        self.error = '%s: %s' % (err.type.__name__, err.getErrorMessage())
+        self._setState('failed')
+
+
+    def wait(self):
+        """
+        Wait until I'm not C{'running'}.
+
+        @return: A Deferred which fires with me.
+        """
+        if self.state != 'running':
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+
+    def cancel(self):
+        """
+        Stop my job if it's still going.
+        """
+        if self.state not in ('done', 'failed') and self.job is not None:
+            self.job.cancel()
+
+
+    def _setState(self, state):
+        self.state = state
+        self.changes += 1
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(self)
+
+
+    def toDict(self):
+        ret = {'id': self.id, 'state': self.state}
+        if self.state == 'done':
+            ret['result'] = self.result
+        elif self.state == 'failed':
+            ret['error'] = self.error
+        elif self.state == 'pending-input':
+            ret.update(self.prompt)
+        return ret
+
+
+
+class Worker(object):
+    """
+    I run jobs for as long as the process lives, keeping track of them so
+    that callers can check on them and answer their C{ask} actions.  Runs
+    which are over, or waiting for input, are forgotten (and cancelled) if
+    nobody asks after them for a while.
+    """
+
+    def __init__(self, runner, contextFactory, scripts, timeout=None,
+                 keep=600, reactor=None):
+        """
+        See L{webpath.batch.Batch} for a description of the other arguments.
+
+        @param keep: Seconds to keep a run that's done, failed or waiting for
+            input without changing before forgetting it.  (Runs are checked
+            every C{keep} seconds, so one may be kept up to twice as long.)
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.runner = runner
+        self.contextFactory = contextFactory
+        self.scripts = scripts
+        self.timeout = timeout
+        self.keep = keep
+        self.reactor = reactor
+        self.runs = {}
+        self._expiries = {}
+
+
+    def start(self, job):
+        """
+        Start a job.
+
+        @return: The L{Run} of the job.
+        """
+        run = Run(uuid.uuid4().hex, job.get('input'))
+        self.runs[run.id] = run
+        d = defer.maybeDeferred(startJob, self.runner, self.contextFactory,
+                                self.scripts, job, run.getUserInput,
+                                self.timeout)
+        run.job = d
+        d.addCallbacks(run.finished, run.failed)
+        self._expireWhenIdle(run)
+        return run
+
+
+    def forget(self, run):
+        """
+        Stop keeping track of a run, cancelling it if it isn't over.
+        """
+        self.runs.pop(run.id, None)
+        expiry = self._expiries.pop(run.id, None)
+        if expiry is not None and expiry.active():
+            expiry.cancel()
+        run.cancel()
+
+
+    def _expireWhenIdle(self, run):
+        """
+        Forget C{run} once it has been done, failed or waiting for input for
+        C{keep} seconds without changing.
+        """
+        def idle(run):
+            if run.id in self.runs:
+                self._expiries[run.id] = self.reactor.callLater(
+                    self.keep, expire, run.changes)
+        def expire(changes):
+            del self._expiries[run.id]
+            if run.changes == changes:
+                self.forget(run)
+            else:
+                self._expireWhenIdle(run)
+        run.wait().addCallback(idle)
+
+
+    def states(self):
+        """
+        Count my runs by state.
+
+        @return: A dict of 1-tuples of state to the number of runs in it, as
+            a L{webpath.metrics.Callback} expects.
+        """
+        counts = dict(((state,), 0) for state in
+                      ('running', 'pending-input', 'done', 'failed'))
+        for run in self.runs.values():
+            counts[(run.state,)] += 1
+        return counts
+
+
+    def report(self, run):
+        """
+        Get the state of a run as a dict, forgetting the run if it's over.
+        """
+        if run.state in ('done', 'failed'):
+            self.forget(run)
+        return run.toDict()
+
+
+
+class RunsResource(Resource):
+    """
+    I am the HTTP interface to a L{Worker}:
+
+        - C{POST /}: Start a job (given as JSON).
+        - C{GET /<id>}: Get the state of a run.
+        - C{POST /<id>/input}: Answer a run's pending C{ask} with the
+          C{value} in the JSON body.
+
+    Both C{POST}s respond once the run is done, has failed or is waiting for
+    input.  If the client goes away before then, the run is cancelled.
+    """
+
+    def __init__(self, worker):
+        Resource.__init__(self)
+        self.worker = worker
+
+
+    def getChild(self, name, request):
+        if not name:
+            return self
+        run = self.worker.runs.get(name)
+        if run is None:
+            return NoResource('No such run')
+        return RunResource(self.worker, run)
+
+
+    def render_POST(self, request):
+        job = _readJSON(request)
+        if job is None:
+            return _writeJSON(request, {'error': 'Invalid JSON'}, 400)
+        if not isinstance(job, dict):
+            return _writeJSON(request, {'error': 'Expected a JSON object'},
+                              400)
+        return _respondWhenReady(request, self.worker,
+                                 self.worker.start(job))
+
+
+
+class RunResource(Resource):
+
+
+    def __init__(self, worker, run):
+        Resource.__init__(self)
+        self.worker = worker
+        self.run = run
+
+
+    def getChild(self, name, request):
+        if name == 'input':
+            return InputResource(self.worker, self.run)
+        return NoResource()
+
+
+    def render_GET(self, request):
+        return _writeJSON(request, self.worker.report(self.run))
+
+
+
+class InputResource(Resource):
+
+    isLeaf = True
+
+
+    def __init__(self, worker, run):
+        Resource.__init__(self)
+        self.worker = worker
+        self.run = run
+
+
+    def render_POST(self, request):
+        body = _readJSON(request)
+        if not isinstance(body, dict) or 'value' not in body:
+            return _writeJSON(request, {'error': 'Expected {"value": ...}'},
+                              400)
+        try:
+            self.run.answer(body['value'])
+        except ValueError as e:
+            return _writeJSON(request, {'error': str(e)}, 409)
+        return _respondWhenReady(request, self.worker, self.run)
+
+
+
+class MetricsResource(Resource):
+    """
+    I expose a L{webpath.metrics.Registry} for Prometheus to scrape.
+    """
+
+    isLeaf = True
+
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self.registry = registry
+
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.expose()
+
+
+
+def _readJSON(request):
+    try:
+        return json.loads(request.content.read())
+    except ValueError:
+        return None
+
+
+def _writeJSON(request, data, code=200):
+    request.setResponseCode(code)
+    request.setHeader('Content-Type', 'application/json')
+    return json.dumps(data, default=repr)
+
+
+def _respondWhenReady(request, worker, run):
+    """
+    Write the state of C{run} to C{request} once it's no longer running, or
+    forget it if the client goes away first, since nobody's left to answer
+    it or take its result.
+    """
+    gone = []
+    def abandoned(reason):
+        gone.append(reason)
+        worker.forget(run)
+    request.notifyFinish().addErrback(abandoned)
+    def ready(run):
+        if not gone:
+            request.write(_writeJSON(request, worker.report(run)))
+            request.finish()
+    run.wait().addCallback(ready)
+    return NOT_DONE_YET
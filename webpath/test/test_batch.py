@@ -0,0 +1,132 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.python.filepath import FilePath
+
+import os
+
+
+from webpath.batch import Batch, ScriptCache
+from webpath.runner import basicRunner, Context, Template
+
+
+
+class ScriptCacheTest(TestCase):
+
+
+    def test_get(self):
+        """
+        Scripts are loaded once and precompiled until they change.
+        """
+        fp = FilePath(self.mktemp())
+        fp.setContent('script one')
+        loaded = []
+        def load(path):
+            loaded.append(path)
+            return [{'action': 'set', 'value': open(path).read()}]
+
+        cache = ScriptCache(load)
+        steps = cache.get(fp.path)
+        self.assertTrue(isinstance(steps[0], Template))
+        self.assertIdentical(cache.get(fp.path), steps)
+        self.assertEqual(loaded, [fp.path])
+
+        fp.setContent('script two')
+        os.utime(fp.path, (0, 0))
+        self.assertEqual(cache.get(fp.path)[0]['value'], 'script two')
+        self.assertEqual(loaded, [fp.path, fp.path])
+
+
+
+class BatchTest(TestCase):
+
+
+    def test_run(self):
+        """
+        Jobs run concurrently and each outcome is reported as soon as the
+        job is done.
+        """
+        pending = {}
+        def wait(params, context):
+            pending[params['key']] = d = defer.Deferred()
+            return d
+        runner = basicRunner({'wait': wait})
+        batch = Batch(runner, Context, None, concurrency=2)
+
+        steps = [{'action': 'wait', 'key': '$name'}]
+        jobs = [{'id': name, 'steps': steps, 'variables': {'name': name}}
+                for name in ['jim', 'john', 'joe']]
+        reported = []
+        d = batch.run(iter(jobs), reported.append)
+        self.assertEqual(sorted(pending), ['jim', 'john'])
+
+        pending.pop('john').callback('JOHN')
+        self.assertEqual(reported, [{'id': 'john', 'result': 'JOHN'}])
+        self.assertEqual(sorted(pending), ['jim', 'joe'])
+
+        pending.pop('joe').errback(ValueError('no joe'))
+        pending.pop('jim').callback('JIM')
+        self.assertEqual(reported[1:], [
+            {'id': 'joe', 'error': 'ValueError: no joe'},
+            {'id': 'jim', 'result': 'JIM'},
+        ])
+        self.successResultOf(d)
+
+
+    def test_badJobs(self):
+        """
+        A job that can't be parsed or isn't a dict fails on its own, and the
+        other jobs still run.
+        """
+        import json
+        batch = Batch(basicRunner(), Context, None, concurrency=2)
+        lines = [
+            '{"id": "a", "steps": [{"action": "set", "key": "x", "value": 1}]}',
+            '{"id": ',
+            '[1, 2]',
+            '{"steps": [{"action": "set", "key": "x", "value": 2}]}',
+        ]
+        reported = []
+        self.successResultOf(batch.run(iter(lines), reported.append,
+                                       json.loads))
+        outcomes = dict((o['id'], o) for o in reported)
+        self.assertEqual(sorted(outcomes), [1, 2, 3, 'a'])
+        self.assertEqual(outcomes['a'], {'id': 'a', 'result': 1})
+        self.assertTrue(outcomes[1]['error'].startswith('ValueError: '))
+        self.assertTrue(outcomes[2]['error'].startswith('TypeError: '))
+        self.assertEqual(outcomes[3], {'id': 3, 'result': 2})
+
+
+    def test_input(self):
+        """
+        Jobs provide the answers to C{ask} actions.
+        """
+        batch = Batch(basicRunner(), Context, None)
+        steps = [{'action': 'ask', 'key': 'user', 'prompt': 'Who?'}]
+        outcome = self.successResultOf(batch.runJob({
+            'steps': steps,
+            'input': {'user': 'joe'},
+        }, 0))
+        self.assertEqual(outcome, {'id': 0, 'result': 'joe'})
+
+        outcome = self.successResultOf(batch.runJob({'steps': steps}, 1))
+        self.assertEqual(outcome['id'], 1)
+        self.assertIn('KeyError', outcome['error'])
+
+
+    def test_script(self):
+        """
+        Jobs can name a script to run.
+        """
+        fp = FilePath(self.mktemp())
+        fp.setContent('')
+        cache = ScriptCache(lambda path: [
+            {'action': 'set', 'key': 'foo', 'value': '$foo + 1'}])
+        batch = Batch(basicRunner(), Context, cache)
+        outcome = self.successResultOf(batch.runJob({
+            'script': fp.path,
+            'variables': {'foo': 1},
+        }, 'x'))
+        self.assertEqual(outcome, {'id': 'x', 'result': 2})
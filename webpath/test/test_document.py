@@ -0,0 +1,201 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+
+from mock import MagicMock
+
+import yaml
+
+
+from webpath import document, http
+from webpath.document import DocumentCache
+from webpath.runner import Context
+
+
+PAGE = ('<html><body><h1 class="title">Accounts</h1>'
+        '<table id="accounts"><tr><th>Name</th><th>Balance</th></tr>'
+        '<tr><td>Checking</td><td> 10.00 </td></tr>'
+        '<tr><td>Savings</td><td>20.00</td></tr></table>'
+        '<form name="f"><input name="a" value="b"></form>'
+        '</body></html>')
+
+
+class DocumentCacheTest(TestCase):
+
+
+    def test_parse(self):
+        """
+        Parsing the same string twice only parses it once.
+        """
+        cache = DocumentCache()
+        root = cache.parse(PAGE)
+        self.assertEqual(root.xpath('//h1/text()'), ['Accounts'])
+        self.assertIdentical(cache.parse(PAGE[:] + ''), root)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+    def test_response(self):
+        """
+        Responses are cached by identity and parsed from their content.
+        """
+        response = MagicMock()
+        response.content = u'<p>caf\xe9</p>'.encode('iso-8859-1')
+        response.encoding = 'ISO-8859-1'
+        cache = DocumentCache()
+        root = cache.parse(response)
+        self.assertEqual(root.xpath('//p/text()'), [u'caf\xe9'])
+        self.assertIdentical(cache.peek(response), root)
+
+        other = MagicMock()
+        other.content = response.content
+        self.assertEqual(cache.peek(other), None)
+
+
+    def test_maxsize(self):
+        """
+        The least recently used documents are evicted first.
+        """
+        cache = DocumentCache(maxsize=2)
+        cache.parse('<p>1</p>')
+        cache.parse('<p>2</p>')
+        cache.parse('<p>1</p>')
+        cache.parse('<p>3</p>')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.peek('<p>2</p>'), None)
+        self.assertNotEqual(cache.peek('<p>1</p>'), None)
+
+
+    def test_maxbytes(self):
+        """
+        Documents are evicted when their total size is too big.
+        """
+        cache = DocumentCache(maxbytes=20)
+        cache.parse('<p>first one</p>')
+        cache.parse('<p>second</p>')
+        self.assertEqual(cache.peek('<p>first one</p>'), None)
+        self.assertNotEqual(cache.peek('<p>second</p>'), None)
+
+
+    def test_evict(self):
+        """
+        You can evict one or all documents.
+        """
+        cache = DocumentCache()
+        cache.parse('<p>1</p>')
+        cache.parse('<p>2</p>')
+        cache.evict('<p>1</p>')
+        self.assertEqual(cache.peek('<p>1</p>'), None)
+        self.assertEqual(len(cache), 1)
+        cache.evict()
+        self.assertEqual(len(cache), 0)
+
+
+
+class actionsTest(TestCase):
+
+
+    def test_xpath(self):
+        """
+        You can select text, attributes or elements with XPath.
+        """
+        context = Context()
+        self.assertEqual(document.xpath({
+            'html': PAGE,
+            'path': '//td[1]',
+        }, context), ['Checking', 'Savings'])
+        self.assertEqual(document.xpath({
+            'html': PAGE,
+            'path': '//h1',
+            'output': 'attrib',
+        }, context), [{'class': 'title'}])
+        self.assertEqual(document.xpath({
+            'html': PAGE,
+            'path': 'count(//tr)',
+        }, context), 3)
+        self.assertEqual(context.documents.misses, 1)
+
+
+    def test_table(self):
+        """
+        You can get the rows of a table.
+        """
+        context = Context()
+        self.assertEqual(document.table({'html': PAGE}, context), [
+            ['Name', 'Balance'],
+            ['Checking', '10.00'],
+            ['Savings', '20.00'],
+        ])
+        self.assertEqual(document.table({
+            'html': PAGE,
+            'path': '//table[@id="accounts"]',
+            'header': True,
+        }, context), [
+            {'Name': 'Checking', 'Balance': '10.00'},
+            {'Name': 'Savings', 'Balance': '20.00'},
+        ])
+
+
+    def test_css(self):
+        """
+        You can select elements with CSS selectors.
+        """
+        try:
+            import cssselect
+            cssselect
+        except ImportError:
+            raise self.skipTest('cssselect is not installed')
+        result = document.css({
+            'html': PAGE,
+            'selector': 'h1.title',
+        }, Context())
+        self.assertEqual(result, ['Accounts'])
+        self.assertEqual(yaml.safe_dump(result), '[Accounts]\n')
+
+
+    def test_plainStrings(self):
+        """
+        Text and attributes are given as plain strings which can be dumped
+        as YAML.
+        """
+        context = Context()
+        for path in ['//h1', '//h1/@class', 'string(//h1)']:
+            result = document.xpath({'html': PAGE, 'path': path}, context)
+            yaml.safe_dump(result)
+
+
+    def test_getForms(self):
+        """
+        getForms uses a document that's already been parsed.
+        """
+        context = Context()
+        document.xpath({'html': PAGE, 'path': '//h1'}, context)
+        def fail(*args, **kwargs):
+            self.fail("Should not parse the document again")
+        self.patch(http, 'extractForms', fail)
+        self.patch(http, 'iterForms', fail)
+        forms = http.getForms({'html': PAGE}, context)
+        self.assertEqual(forms[0]['data'], {'a': 'b'})
+        self.assertEqual(context.documents.hits, 0)
+        self.assertEqual(context.documents.misses, 1)
+
+
+    def test_getForms_cache(self):
+        """
+        getForms can parse and keep the whole document for other actions.
+        """
+        context = Context()
+        http.getForms({'html': PAGE, 'cache': True}, context)
+        document.xpath({'html': PAGE, 'path': '//h1'}, context)
+        self.assertEqual(context.documents.hits, 1)
+        self.assertEqual(context.documents.misses, 1)
+
+
+    def test_evict(self):
+        """
+        You can evict documents with an action.
+        """
+        context = Context()
+        document.xpath({'html': PAGE, 'path': '//h1'}, context)
+        document.evict({'html': PAGE}, context)
+        self.assertEqual(len(context.documents), 0)
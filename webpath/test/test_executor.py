@@ -0,0 +1,245 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+
+import cPickle as pickle
+import os
+import threading
+
+
+from webpath import http
+from webpath.executor import ThreadExecutor, ProcessExecutor, ExecutorError
+from webpath.executor import _deliver
+from webpath.runner import Runner, Context, deferredParams
+
+
+
+def whereAmI(*args):
+    return os.getpid(), threading.current_thread().name, args
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def unpicklable():
+    return lambda: None
+
+
+def exit():
+    raise SystemExit(3)
+
+
+def failUnloadably():
+    raise TwoArgumentError('a', 'b')
+
+
+
+class TwoArgumentError(Exception):
+    """
+    I can be pickled, but not unpickled because I'm pickled with only my
+    first argument.
+    """
+
+    def __init__(self, a, b):
+        Exception.__init__(self, a)
+        self.b = b
+
+
+
+class Unloadable(object):
+    """
+    I can be pickled but fail to be unpickled.
+    """
+
+    def __reduce__(self):
+        return fail, ('not here',)
+
+
+@deferredParams('actions')
+def cpuHandler(params):
+    return whereAmI(params)
+
+
+
+class ThreadExecutorTest(TestCase):
+
+
+    @defer.inlineCallbacks
+    def test_submit(self):
+        """
+        Functions are called in one of my threads.
+        """
+        executor = ThreadExecutor(2)
+        self.addCleanup(executor.stop)
+        pid, thread, args = yield executor.submit(whereAmI, 1, 2)
+        self.assertEqual(pid, os.getpid())
+        self.assertIn('webpath-io', thread)
+        self.assertEqual(args, (1, 2))
+
+
+
+class ProcessExecutorTest(TestCase):
+
+
+    def setUp(self):
+        self.executor = ProcessExecutor(1)
+        self.addCleanup(self.executor.stop)
+
+
+    @defer.inlineCallbacks
+    def test_submit(self):
+        """
+        Functions are called in another process.
+        """
+        pid, thread, args = yield self.executor.submit(whereAmI, 'a', [1])
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(args, ('a', [1]))
+
+
+    @defer.inlineCallbacks
+    def test_error(self):
+        """
+        Exceptions are sent back.
+        """
+        e = yield self.assertFailure(self.executor.submit(fail, 'oops'),
+                                     ValueError)
+        self.assertEqual(str(e), 'oops')
+
+
+    def test_unpicklableArgs(self):
+        """
+        Arguments which can't be sent to another process are refused.
+        """
+        self.assertRaises(pickle.PicklingError, self.executor.submit,
+                          whereAmI, lambda: None)
+
+
+    @defer.inlineCallbacks
+    def test_unloadableArgs(self):
+        """
+        A call which can't be unpickled in the worker process fails with the
+        error from unpickling it.
+        """
+        e = yield self.assertFailure(
+            self.executor.submit(whereAmI, Unloadable()), ValueError)
+        self.assertEqual(str(e), 'not here')
+
+
+    @defer.inlineCallbacks
+    def test_unpicklableResult(self):
+        """
+        Results which can't be sent back fail with L{ExecutorError}.
+        """
+        yield self.assertFailure(self.executor.submit(unpicklable),
+                                 ExecutorError)
+
+
+    @defer.inlineCallbacks
+    def test_unloadableError(self):
+        """
+        Exceptions which can be pickled but not unpickled fail with
+        L{ExecutorError} describing them.
+        """
+        e = yield self.assertFailure(self.executor.submit(failUnloadably),
+                                     ExecutorError)
+        self.assertIn('TwoArgumentError', str(e))
+
+
+    @defer.inlineCallbacks
+    def test_exit(self):
+        """
+        Exceptions that aren't Exceptions are sent back too.
+        """
+        e = yield self.assertFailure(self.executor.submit(exit), SystemExit)
+        self.assertEqual(e.code, 3)
+
+
+    def test_deliverUnloadable(self):
+        """
+        A result that can't be unpickled when it arrives fails with
+        L{ExecutorError}.
+        """
+        d = defer.Deferred()
+        _deliver(d, pickle.dumps((True, Unloadable()),
+                                 pickle.HIGHEST_PROTOCOL))
+        self.failureResultOf(d, ExecutorError)
+
+
+
+class RunnerExecutorTest(TestCase):
+
+
+    @defer.inlineCallbacks
+    def test_cpu(self):
+        """
+        CPU-bound handlers are called with just their params in a process of
+        the runner's C{'cpu'} executor.
+        """
+        executor = ProcessExecutor(1)
+        self.addCleanup(executor.stop)
+        runner = Runner(executors={'cpu': executor})
+        runner.registerHandler('work', cpuHandler, executor='cpu')
+        self.assertEqual(runner._handlers['work'].deferredParams,
+                         frozenset(['actions']))
+        context = Context()
+        context.variables['n'] = 3
+        pid, thread, args = yield runner.runActions([
+            {'action': 'work', 'n': '$n'}], context)
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(args, ({'action': 'work', 'n': 3},))
+
+
+    def test_cpuInline(self):
+        """
+        CPU-bound handlers are called right away if the runner has no
+        C{'cpu'} executor.
+        """
+        runner = Runner()
+        runner.registerHandlers({'work': cpuHandler}, executor='cpu')
+        d = runner.runActions([{'action': 'work'}], Context())
+        pid, thread, args = self.successResultOf(d)
+        self.assertEqual(pid, os.getpid())
+        self.assertEqual(thread, threading.current_thread().name)
+
+
+    @defer.inlineCallbacks
+    def test_io(self):
+        """
+        I/O-bound handlers are called with their params and context in a
+        thread of the runner's C{'io'} executor.
+        """
+        executor = ThreadExecutor(1)
+        self.addCleanup(executor.stop)
+        runner = Runner(executors={'io': executor})
+        runner.registerHandler('wait', whereAmI, executor='io')
+        context = Context()
+        pid, thread, args = yield runner.runActions([{'action': 'wait'}],
+                                                    context)
+        self.assertIn('webpath-io', thread)
+        self.assertIdentical(args[1], context)
+
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, Runner().registerHandler, 'x',
+                          whereAmI, executor='gpu')
+
+
+    @defer.inlineCallbacks
+    def test_getForms(self):
+        """
+        http.getForms parses forms in the C{'cpu'} executor.
+        """
+        executor = ProcessExecutor(1)
+        self.addCleanup(executor.stop)
+        runner = Runner(executors={'cpu': executor})
+        http.installHTTPHandlers(runner)
+        forms = yield runner.runActions([{
+            'action': 'http.getForms',
+            'html': '<form action="/login"><input name="user"></form>',
+            'include_html': False,
+        }], Context())
+        self.assertEqual(forms, [{'form': {'action': '/login'},
+                                  'data': {'user': None}}])
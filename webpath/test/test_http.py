@@ -2,26 +2,84 @@
 # See LICENSE for details.
 
 from twisted.trial.unittest import TestCase
-from twisted.internet import defer
+from twisted.internet import defer, reactor, task
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web.static import Data
 
 from mock import MagicMock
 
+from StringIO import StringIO
+import json
+import os
+
 
 from webpath import http
-from webpath.runner import Context
+from webpath.runner import Context, Runner, basicRunner
+
+
+
+class installHTTPHandlersTest(TestCase):
+
+
+    def test_default(self):
+        """
+        By default, requests are made with C{requests} in a thread.
+        """
+        runner = Runner()
+        http.installHTTPHandlers(runner)
+        self.assertEqual(runner._handlers['http'], http.request)
+        self.assertEqual(runner._handlers['http.getForms'], http.getForms)
+
+
+    def test_agent(self):
+        """
+        You can choose the Twisted Agent engine.
+        """
+        from webpath.httpagent import AgentEngine
+        runner = Runner()
+        http.installHTTPHandlers(runner, 'agent')
+        self.assertTrue(isinstance(runner._handlers['http'].im_self,
+                                   AgentEngine))
+
+
+    def test_engineInstance(self):
+        """
+        You can provide your own engine.
+        """
+        class Engine(object):
+            def request(self, params, context):
+                pass
+        engine = Engine()
+        runner = Runner()
+        http.installHTTPHandlers(runner, engine)
+        self.assertEqual(runner._handlers['http'], engine.request)
+
+
+    def test_unknown(self):
+        runner = Runner()
+        self.assertRaises(ValueError, http.installHTTPHandlers, runner, 'foo')
 
 
 
 class httpTest(TestCase):
 
 
+    def fakeSession(self):
+        fake = MagicMock()
+        response = fake.request.return_value
+        response.iter_content.return_value = iter(['fo', 'o'])
+        response.content = None
+        return fake
+
+
     @defer.inlineCallbacks
     def test_request(self):
         """
-        You can make HTTP requests using the requests api.
+        You can make HTTP requests using the requests api.  The body is read
+        a chunk at a time.
         """
-        fake = MagicMock()
-        fake.request.return_value = 'foo'
+        fake = self.fakeSession()
         context = Context()
         context.requests = fake
         result = yield http.request({
@@ -29,8 +87,31 @@ class httpTest(TestCase):
                 'method': 'get',
             },
         }, context)
-        fake.request.assert_called_once_with(**{'method': 'get'})
-        self.assertEqual(result, 'foo', "Should return result of request()")
+        fake.request.assert_called_once_with(**{'method': 'get',
+                                                'stream': True})
+        self.assertIdentical(result, fake.request.return_value,
+                             "Should return result of request()")
+        self.assertEqual(result._content, 'foo')
+
+
+    @defer.inlineCallbacks
+    def test_request_streamFalse(self):
+        """
+        Asking not to stream is allowed, and the body is still read a chunk
+        at a time.
+        """
+        fake = self.fakeSession()
+        context = Context()
+        context.requests = fake
+        result = yield http.request({
+            'kwargs': {
+                'method': 'get',
+                'stream': False,
+            },
+        }, context)
+        fake.request.assert_called_once_with(**{'method': 'get',
+                                                'stream': True})
+        self.assertEqual(result._content, 'foo')
 
 
     @defer.inlineCallbacks
@@ -38,8 +119,7 @@ class httpTest(TestCase):
         """
         The request should be asynchronous.
         """
-        fake = MagicMock()
-        fake.request.return_value = 'foo'
+        fake = self.fakeSession()
         context = Context()
         context.requests = fake
         d = http.request({
@@ -49,7 +129,64 @@ class httpTest(TestCase):
         }, context)
         self.assertFalse(d.called, "Should not be done yet")
         result = yield d
-        self.assertEqual(result, 'foo', "Should return result of request()")
+        self.assertIdentical(result, fake.request.return_value,
+                             "Should return result of request()")
+
+
+    @defer.inlineCallbacks
+    def test_request_cancel(self):
+        """
+        Cancelling a request (as a timeout does) stops reading its body and
+        closes its connection, so a slow server can't keep its thread busy.
+        """
+        lost = defer.Deferred()
+        class Trickle(Resource):
+            isLeaf = True
+            def render_GET(self, request):
+                call = [None]
+                def more():
+                    request.write('x')
+                    call[0] = reactor.callLater(0.01, more)
+                def stop(reason):
+                    call[0].cancel()
+                    lost.callback(None)
+                request.notifyFinish().addErrback(stop)
+                more()
+                return NOT_DONE_YET
+        port = reactor.listenTCP(0, Site(Trickle()), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        context = Context()
+        self.addCleanup(context.requests.close)
+        d = http.request({'kwargs': {
+            'method': 'get',
+            'url': 'http://127.0.0.1:%d/' % (port.getHost().port,),
+        }}, context)
+        reactor.callLater(0.1, d.cancel)
+        yield self.assertFailure(d, defer.CancelledError)
+        yield lost
+
+
+    def test_timeLeft(self):
+        """
+        Requests are given no longer than the action has left as their
+        timeout, so their threads are freed when it times out.
+        """
+        clock = task.Clock()
+        context = Context()
+        context.runner = Runner(reactor=clock)
+        self.assertEqual(http.limitTimeout({'url': 'x'}, context),
+                         {'url': 'x'})
+        context.deadline = 10
+        clock.advance(4)
+        self.assertEqual(http.limitTimeout({'url': 'x'}, context),
+                         {'url': 'x', 'timeout': 6})
+        self.assertEqual(http.limitTimeout({'timeout': 2}, context),
+                         {'timeout': 2})
+        self.assertEqual(http.limitTimeout({'timeout': 60}, context),
+                         {'timeout': 6})
+        clock.advance(10)
+        self.assertEqual(http.limitTimeout({}, context),
+                         {'timeout': http.MIN_TIMEOUT})
 
 
     @defer.inlineCallbacks
@@ -80,4 +217,435 @@ class httpTest(TestCase):
         })
 
 
+    def test_getForms_content(self):
+        """
+        You can extract forms from undecoded content.
+        """
+        html = (u'<html><body><form name="caf\xe9">'
+                u'<input name="name" value="\u2713">'
+                u'</form></body></html>')
+        forms = http.getForms({
+            'content': html.encode('utf-16'),
+            'encoding': 'utf-16',
+            'include_html': False,
+        }, Context())
+        self.assertEqual(forms, [{
+            'form': {'name': u'caf\xe9'},
+            'data': {'name': u'\u2713'},
+        }])
+
+
+    def test_getForms_file(self):
+        """
+        You can extract forms from a file.
+        """
+        fh = StringIO('<form name="a"><input name="b" value="c"></form>')
+        forms = http.getForms({'content': fh}, Context())
+        self.assertEqual(forms[0]['data'], {'b': 'c'})
+
+
+
+class downloadTest(TestCase):
+
+
+    def setUp(self):
+        root = self.root = Resource()
+        root.putChild('statement.csv', Data(
+            u'date,amount\r\n2014-06-01,-3.50\r\ncaf\xe9,1\r\n'.encode(
+                'utf-8'), 'text/csv; charset=utf-8'))
+        root.putChild('page', Data('<form><input name="a" value="b"></form>',
+                                   'text/html'))
+        self.port = reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+
+    def download(self, resource, kwargs=None, **params):
+        params['kwargs'] = {
+            'method': 'get',
+            'url': 'http://127.0.0.1:%d%s' % (self.port.getHost().port,
+                                              resource),
+        }
+        params['kwargs'].update(kwargs or {})
+        d = http.download(params, Context())
+        def closeLater(result):
+            self.addCleanup(result.close)
+            return result
+        return d.addCallback(closeLater)
+
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        """
+        Cancelling a download stops it and closes its connection.
+        """
+        lost = defer.Deferred()
+        class Endless(Resource):
+            isLeaf = True
+            def render_GET(self, request):
+                call = [None]
+                def more():
+                    request.write('x' * 1024)
+                    call[0] = reactor.callLater(0.01, more)
+                def stop(reason):
+                    call[0].cancel()
+                    lost.callback(None)
+                request.notifyFinish().addErrback(stop)
+                more()
+                return NOT_DONE_YET
+        self.root.putChild('endless', Endless())
+        d = self.download('/endless', chunk_size=1024)
+        reactor.callLater(0.1, d.cancel)
+        yield self.assertFailure(d, defer.CancelledError)
+        yield lost
+
+
+    @defer.inlineCallbacks
+    def test_lines(self):
+        """
+        The body is written to a temporary file and can be read a line at a
+        time, decoded with the encoding from the headers.
+        """
+        result = yield self.download('/statement.csv', chunk_size=5)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.size, 40)
+        self.assertEqual(list(result.lines()), [
+            u'date,amount',
+            u'2014-06-01,-3.50',
+            u'caf\xe9,1',
+        ])
+        self.assertEqual(result.mmap()[:4], 'date')
+        self.assertEqual(result.open().read(4), 'date')
+
+        path = result.path
+        self.assertTrue(os.path.exists(path))
+        result.close()
+        self.assertFalse(os.path.exists(path), "Should delete the temp file")
+
+
+    @defer.inlineCallbacks
+    def test_path(self):
+        """
+        The body can be written to a file that's kept.
+        """
+        path = self.mktemp()
+        result = yield self.download('/statement.csv', path=path)
+        result.close()
+        self.assertEqual(open(path, 'rb').read(4), 'date')
+
+
+    @defer.inlineCallbacks
+    def test_stream(self):
+        """
+        Passing C{stream} along with the request is allowed.
+        """
+        result = yield self.download('/statement.csv', {'stream': True})
+        self.assertEqual(result.size, 40)
+
+
+    @defer.inlineCallbacks
+    def test_getForms(self):
+        """
+        Forms can be extracted from a download without reading it all.
+        """
+        result = yield self.download('/page')
+        forms = http.getForms({'content': result.open()}, Context())
+        self.assertEqual(forms[0]['data'], {'a': 'b'})
+
+
+
+class Transactions(Resource):
+    """
+    Five transactions, a page at a time: by C{page} number with a C{Link}
+    to the next, or by C{offset}.
+    """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        transactions = range(5)
+        if 'page' in request.args:
+            page = int(request.args['page'][0])
+            offset = (page - 1) * 2
+            if offset + 2 < len(transactions):
+                request.setHeader('link', '</transactions?page=%d>; '
+                                  'rel="next"' % (page + 1,))
+        else:
+            offset = int(request.args['offset'][0])
+        request.setHeader('content-type', 'application/json')
+        return json.dumps({'offset': offset,
+                           'items': transactions[offset:offset + 2]})
+
+
+
+class PagesTest(TestCase):
+
+
+    def setUp(self):
+        self.requested = []
+
+
+    def fetch(self, kwargs):
+        d = defer.Deferred()
+        self.requested.append((kwargs, d))
+        return d
+
+
+    def following(self, page, kwargs):
+        if page < 3:
+            return {'n': page + 1}
+
+
+    def test_lazy(self):
+        """
+        Pages are only requested when they're asked for, and one asked for
+        before it's known whether there is one fails with C{StopIteration}
+        if there isn't.
+        """
+        pages = http.Pages(self.fetch, {'n': 1}, self.following)
+        self.assertEqual(self.requested, [])
+        first = next(pages)
+        second = next(pages)
+        third = next(pages)
+        self.assertEqual(len(self.requested), 1)
+        self.requested[0][1].callback(1)
+        self.assertEqual(self.successResultOf(first), 1)
+        self.assertEqual(self.requested[1][0], {'n': 2})
+        self.requested[1][1].callback(2)
+        self.assertEqual(self.successResultOf(second), 2)
+        self.requested[2][1].callback(3)
+        self.assertEqual(self.successResultOf(third), 3)
+        self.assertRaises(StopIteration, next, pages)
+        self.assertEqual(pages.fetched, 3)
+
+
+    def test_prefetch(self):
+        """
+        The next page is fetched while the one before is being used, but no
+        more than C{prefetch} ahead.
+        """
+        fetch = lambda kwargs: defer.succeed(kwargs['n'])
+        pages = http.Pages(fetch, {'n': 1}, self.following)
+        self.assertEqual(self.successResultOf(next(pages)), 1)
+        self.assertEqual(pages.fetched, 2)
+        pages = http.Pages(fetch, {'n': 1}, self.following, prefetch=0)
+        self.assertEqual(self.successResultOf(next(pages)), 1)
+        self.assertEqual(pages.fetched, 1)
+        self.assertEqual([self.successResultOf(d) for d in pages], [2, 3])
+
+
+    def test_maxPages(self):
+        fetch = lambda kwargs: defer.succeed(kwargs['n'])
+        pages = http.Pages(fetch, {'n': 1}, self.following, maxPages=2)
+        self.assertEqual([self.successResultOf(d) for d in pages], [1, 2])
+
+
+    def test_failed(self):
+        """
+        A page which fails to be fetched is the last.
+        """
+        pages = http.Pages(self.fetch, {'n': 1}, self.following)
+        first = next(pages)
+        second = next(pages)
+        self.requested[0][1].errback(ValueError())
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, StopIteration)
+
+
+    def test_nextRequest(self):
+        """
+        The next page's request is made from a URL relative to the page's,
+        or a dict of C{kwargs} whose C{params} are merged.
+        """
+        page = MagicMock()
+        page.url = 'http://bank.example.com/txns?page=1'
+        kwargs = {'method': 'get', 'url': page.url, 'params': {'size': 2}}
+        self.assertEqual(http.nextRequest('?page=2', page, kwargs), {
+            'method': 'get', 'url': 'http://bank.example.com/txns?page=2'})
+        self.assertEqual(http.nextRequest({'params': {'offset': 2}}, page,
+                                          kwargs),
+                         dict(kwargs, params={'size': 2, 'offset': 2}))
+        self.assertEqual(http.nextRequest(None, page, kwargs), None)
+
+
+
+class paginateTest(TestCase):
+
+
+    def setUp(self):
+        root = Resource()
+        root.putChild('transactions', Transactions())
+        self.port = reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.url = 'http://127.0.0.1:%d/transactions' % (
+            self.port.getHost().port,)
+        self.runner = basicRunner()
+        http.installHTTPHandlers(self.runner)
+
+
+    def paginate(self, **params):
+        """
+        Loop over the pages of a paginate action, collecting their items.
+        """
+        params['action'] = 'http.paginate'
+        context = Context()
+        self.addCleanup(context.requests.close)
+        d = self.runner.runActions([params, {
+            'action': 'loop',
+            'iterable': '$_',
+            'actions': [
+                {'action': 'append', 'key': 'items',
+                 'value': '$item.json()["items"]'},
+            ],
+        }], context)
+        return d.addCallback(lambda _: context)
+
+
+    @defer.inlineCallbacks
+    def test_link(self):
+        """
+        By default, pages are followed by their C{Link} headers, and aren't
+        kept in the results.
+        """
+        context = yield self.paginate(kwargs={
+            'method': 'get', 'url': self.url, 'params': {'page': 1}})
+        self.assertEqual(context.variables['items'], [[0, 1], [2, 3], [4]])
+        self.assertEqual([r for r in context.results
+                          if hasattr(r, 'status_code')], [])
+
+
+    @defer.inlineCallbacks
+    def test_next(self):
+        """
+        The next page can be made from the one before with an expression.
+        """
+        context = yield self.paginate(kwargs={
+            'method': 'get', 'url': self.url, 'params': {'offset': 0},
+        }, next='$page.json()["items"] and '
+                '{"params": {"offset": page.json()["offset"] + 2}}',
+           max_pages=10)
+        self.assertEqual(context.variables['items'],
+                         [[0, 1], [2, 3], [4], []])
+
+
+    def test_nextNotExpression(self):
+        """
+        A C{next} that isn't an C{$expression} is refused.
+        """
+        kwargs = {'method': 'get', 'url': self.url}
+        d1 = self.assertFailure(self.paginate(kwargs=kwargs, next='?page=2'),
+                                ValueError)
+        d2 = self.assertFailure(self.paginate(kwargs=kwargs, next=2),
+                                ValueError)
+        return defer.gatherResults([d1, d2])
+
+
+
+class iterFormsTest(TestCase):
+
 
+    def test_chunks(self):
+        """
+        Forms spread across many chunks are all found.
+        """
+        parts = ['<html><body>']
+        for i in xrange(20):
+            parts.append('<div><p>filler %d</p></div>' % (i,))
+            parts.append('<form name="f%d"><select name="s">'
+                         '<option>no</option>'
+                         '<option selected value="%d">yes</option>'
+                         '</select></form>after' % (i, i))
+        parts.append('</body></html>')
+        source = StringIO(''.join(parts))
+        forms = [http.formData(form, include_html=False)
+                 for form in http.iterForms(source, chunk_size=7)]
+        self.assertEqual(forms, [{
+            'form': {'name': 'f%d' % (i,)},
+            'data': {'s': str(i)},
+        } for i in xrange(20)])
+
+
+    def test_hidden(self):
+        """
+        Forms in comments and scripts are not forms.
+        """
+        html = ('<html><body><!-- <form name="comment"></form> -->'
+                '<script>document.write("<form name=script></form>");'
+                '</script><form name="real"><input name="a"></form>'
+                '<STYLE>form { }</STYLE><!-- <form name="unclosed">')
+        forms = [form.attrib['name'] for form in http.iterForms(html)]
+        self.assertEqual(forms, ['real'])
+
+
+    def test_closingTagInScript(self):
+        """
+        A C{</form>} in a script or comment inside a form doesn't end it,
+        however the document is split into chunks.
+        """
+        html = ('<html><body><form name="page"><input name="a" value="1">'
+                '<script>var s = "</form>";</script><!-- </form> -->'
+                + '<p>filler</p>' * 50 +
+                '<input name="b" value="2"></form>'
+                '<form name="next"><input name="c"></form></body></html>')
+        for chunk_size in [3, 7, 64, len(html)]:
+            forms = [http.formData(form, include_html=False)
+                     for form in http.iterForms(StringIO(html), None,
+                                                chunk_size)]
+            self.assertEqual(forms, [
+                {'form': {'name': 'page'}, 'data': {'a': '1', 'b': '2'}},
+                {'form': {'name': 'next'}, 'data': {'c': None}},
+            ], chunk_size)
+
+
+    def test_longForm(self):
+        """
+        Once a form is longer than L{http.FORM_LIMIT}, the rest of the
+        document is parsed by lxml.
+        """
+        self.patch(http, 'FORM_LIMIT', 100)
+        html = ('<html><body><form name="page"><input name="a" value="1">'
+                + '<p>filler</p>' * 50 +
+                '<script>var s = "</form>";</script>'
+                '<input name="b" value="2"></form>'
+                '<form name="next"><input name="c"></form></body></html>')
+        forms = [http.formData(form, include_html=False)
+                 for form in http.iterForms(StringIO(html), chunk_size=16)]
+        self.assertEqual(forms, [
+            {'form': {'name': 'page'}, 'data': {'a': '1', 'b': '2'}},
+            {'form': {'name': 'next'}, 'data': {'c': None}},
+        ])
+
+
+    def test_unclosed(self):
+        """
+        A form that is never closed ends with the document.
+        """
+        html = ('<html><body><FORM name="a"><input name="b" value="c">'
+                '</body></html>')
+        forms = [http.formData(form, include_html=False)
+                 for form in http.iterForms(StringIO(html), chunk_size=5)]
+        self.assertEqual(forms, [{'form': {'name': 'a'}, 'data': {'b': 'c'}}])
+
+
+    def test_metaCharset(self):
+        """
+        The encoding of undecoded content is taken from C{<meta>} tags.
+        """
+        html = (u'<html><head><meta http-equiv="Content-Type" '
+                u'content="text/html; charset=utf-8"></head><body>'
+                u'<form><input name="a" value="\u2713"></form>')
+        forms = list(http.iterForms(html.encode('utf-8')))
+        self.assertEqual(forms[0].fields['a'], u'\u2713')
+
+
+    def test_unknownCharset(self):
+        """
+        A C{<meta>} charset Python doesn't know is ignored, as is an unknown
+        C{encoding}.
+        """
+        html = ('<html><head><meta charset="x-bogus"></head><body>'
+                '<form><input name="a" value="b"></form>')
+        forms = list(http.iterForms(html))
+        self.assertEqual(forms[0].fields['a'], 'b')
+        forms = list(http.iterForms('<form><input name="a" value="b"></form>',
+                                    encoding='x-bogus'))
+        self.assertEqual(forms[0].fields['a'], 'b')
@@ -0,0 +1,195 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+from twisted.web.util import Redirect
+
+
+from webpath.httpagent import AgentEngine
+from webpath.runner import Context
+
+
+
+class Echo(Resource):
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+
+    def render(self, request):
+        self.requests.append(request)
+        request.setHeader('Content-Type', 'text/plain; charset=utf-8')
+        request.addCookie('visited', 'yes', path='/')
+        lines = [
+            request.method,
+            request.uri,
+            request.getHeader('cookie') or '',
+            request.content.read(),
+        ]
+        return '\n'.join(lines) + u'\n\u2713'.encode('utf-8')
+
+
+
+class SeeOther(Resource):
+
+    isLeaf = True
+
+    def __init__(self, location):
+        Resource.__init__(self)
+        self.location = location
+
+    def render(self, request):
+        request.setResponseCode(303)
+        request.setHeader('location', self.location)
+        return ''
+
+
+
+class Stall(Resource):
+    """
+    I send the headers and part of the body, and then nothing.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.lost = defer.Deferred()
+
+    def render(self, request):
+        request.setHeader('Content-Length', '10')
+        request.write('x')
+        request.notifyFinish().addErrback(lambda _: self.lost.callback(None))
+        return NOT_DONE_YET
+
+
+
+class AgentEngineTest(TestCase):
+
+
+    def setUp(self):
+        root = Resource()
+        self.echo = Echo()
+        root.putChild('echo', self.echo)
+        root.putChild('redirect', Redirect('/echo?redirected=1'))
+        root.putChild('seeother', SeeOther('/echo?seen=1'))
+        self.stall = Stall()
+        root.putChild('stall', self.stall)
+        self.port = reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.engine = AgentEngine(reactor)
+        self.addCleanup(self.engine.close)
+
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.port.getHost().port, path)
+
+
+    @defer.inlineCallbacks
+    def test_request(self):
+        """
+        The engine makes requests and returns something that looks like a
+        C{requests} Response.
+        """
+        context = Context()
+        response = yield self.engine.request({
+            'kwargs': {
+                'method': 'get',
+                'url': self.url('/echo'),
+                'params': {'foo': 'bar'},
+            },
+        }, context)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['content-type'],
+                         'text/plain; charset=utf-8')
+        self.assertEqual(response.url, self.url('/echo?foo=bar'))
+        self.assertEqual(response.text,
+                         u'GET\n/echo?foo=bar\n\n\n\u2713')
+        self.assertEqual(response.cookies['visited'], 'yes')
+
+
+    @defer.inlineCallbacks
+    def test_post(self):
+        """
+        Form data is encoded in the body, which is sent with a single
+        Content-Length header.
+        """
+        response = yield self.engine.send(Context().requests, 'post',
+                                          self.url('/echo'),
+                                          data={'name': 'joe'})
+        self.assertEqual(response.text.split('\n')[:4],
+                         ['POST', '/echo', '', 'name=joe'])
+        request, = self.echo.requests
+        self.assertEqual(
+            request.requestHeaders.getRawHeaders('content-length'), ['8'])
+
+
+    @defer.inlineCallbacks
+    def test_cookies(self):
+        """
+        Cookies are kept in the session's cookie jar between requests.
+        """
+        context = Context()
+        yield self.engine.send(context.requests, 'get', self.url('/echo'))
+        self.assertEqual(context.requests.cookies['visited'], 'yes')
+        response = yield self.engine.send(context.requests, 'get',
+                                          self.url('/echo'))
+        self.assertEqual(response.text.split('\n')[2], 'visited=yes')
+
+
+    @defer.inlineCallbacks
+    def test_redirect(self):
+        """
+        Redirects are followed unless told otherwise.
+        """
+        session = Context().requests
+        response = yield self.engine.send(session, 'get',
+                                          self.url('/redirect'))
+        self.assertEqual(response.url, self.url('/echo?redirected=1'))
+
+        response = yield self.engine.send(session, 'get',
+                                          self.url('/redirect'),
+                                          allow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+
+
+    @defer.inlineCallbacks
+    def test_postSeeOther(self):
+        """
+        A POST answered with a 303 is followed by a GET without a body or a
+        Content-Length header.
+        """
+        response = yield self.engine.send(Context().requests, 'post',
+                                          self.url('/seeother'),
+                                          data={'name': 'joe'}, timeout=5)
+        self.assertEqual(response.url, self.url('/echo?seen=1'))
+        self.assertEqual(response.text.split('\n')[:4],
+                         ['GET', '/echo?seen=1', '', ''])
+        request, = self.echo.requests
+        self.assertEqual(
+            request.requestHeaders.getRawHeaders('content-length'), None)
+
+
+    @defer.inlineCallbacks
+    def test_timeoutBody(self):
+        """
+        The timeout covers reading the body, and the connection is dropped
+        when it runs out.
+        """
+        d = self.engine.send(Context().requests, 'get', self.url('/stall'),
+                             timeout=0.2)
+        yield self.assertFailure(d, defer.CancelledError)
+        yield self.stall.lost
+
+
+    def test_unsupported(self):
+        """
+        Arguments that the engine can't handle are rejected.
+        """
+        self.assertRaises(TypeError, self.engine.send, Context().requests,
+                          'get', self.url('/echo'), stream=True)
@@ -0,0 +1,291 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+
+from webpath import http
+from webpath.httpcache import HTTPCache, cacheKey, freshness
+from webpath.runner import Context, Runner
+from webpath.test.test_trace import FakeClock
+import requests
+from requests.structures import CaseInsensitiveDict
+
+
+
+class Page(Resource):
+    """
+    I respond with C{body} and C{headers}, answering conditional requests
+    with a 304 if C{etag} matches, and count the requests I get.
+    """
+
+    isLeaf = True
+
+    def __init__(self, body, headers=None, etag=None):
+        Resource.__init__(self)
+        self.body = body
+        self.headers = headers or {}
+        self.etag = etag
+        self.requests = []
+
+
+    def render(self, request):
+        self.requests.append(request.getHeader('if-none-match'))
+        for name, value in self.headers.items():
+            request.setHeader(name, value)
+        if self.etag is not None:
+            request.setHeader('ETag', self.etag)
+            if request.getHeader('if-none-match') == self.etag:
+                request.setResponseCode(304)
+                return ''
+        return self.body
+
+
+
+class HTTPCacheTest(TestCase):
+
+
+    def setUp(self):
+        self.root = Resource()
+        self.port = reactor.listenTCP(0, Site(self.root),
+                                      interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.clock = FakeClock()
+        self.cache = HTTPCache(clock=self.clock)
+        self.runner = Runner()
+        http.installHTTPHandlers(self.runner, cache=self.cache)
+
+
+    def page(self, name, *args, **kwargs):
+        page = Page(*args, **kwargs)
+        self.root.putChild(name, page)
+        return page
+
+
+    def get(self, name, **params):
+        params.setdefault('kwargs', {})
+        params['kwargs'].setdefault('method', 'get')
+        params['kwargs']['url'] = 'http://127.0.0.1:%d/%s' % (
+            self.port.getHost().port, name)
+        params['action'] = 'http'
+        context = Context()
+        self.addCleanup(context.requests.close)
+        return self.runner.runActions([params], context)
+
+
+    @defer.inlineCallbacks
+    def test_maxAge(self):
+        """
+        Responses are reused until their max-age is up.
+        """
+        page = self.page('config', 'v1', {'Cache-Control': 'max-age=60'})
+        first = yield self.get('config')
+        page.body = 'v2'
+        self.clock.now += 59
+        second = yield self.get('config')
+        self.assertEqual((first.text, second.text), ('v1', 'v1'))
+        self.assertTrue(second.from_cache)
+        self.assertEqual(second.headers['cache-control'], 'max-age=60')
+        self.assertEqual(len(page.requests), 1)
+
+        self.clock.now += 1
+        third = yield self.get('config')
+        self.assertEqual(third.text, 'v2')
+        self.assertEqual(self.cache.stats(), {
+            'hits': 1, 'misses': 2, 'revalidated': 0, 'stored': 2})
+
+
+    @defer.inlineCallbacks
+    def test_revalidate(self):
+        """
+        Stale responses with an ETag are revalidated with a conditional
+        request, and a 304 makes them fresh again.
+        """
+        page = self.page('login', 'form', {'Cache-Control': 'max-age=10'},
+                         etag='"a"')
+        yield self.get('login')
+        self.clock.now += 20
+        second = yield self.get('login')
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.text, 'form')
+        self.assertEqual(page.requests, [None, '"a"'])
+        yield self.get('login')
+        self.assertEqual(len(page.requests), 2)
+
+        page.etag = '"b"'
+        page.body = 'new form'
+        self.clock.now += 20
+        fourth = yield self.get('login')
+        self.assertEqual(fourth.text, 'new form')
+        self.assertEqual(self.cache.stats(), {
+            'hits': 1, 'misses': 2, 'revalidated': 1, 'stored': 3})
+
+
+    @defer.inlineCallbacks
+    def test_notStored(self):
+        """
+        Responses which are private, set cookies, can't be revalidated or
+        answer requests which aren't GETs aren't stored.
+        """
+        self.page('private', 'x', {'Cache-Control': 'private, max-age=60'})
+        self.page('cookie', 'x', {'Cache-Control': 'max-age=60',
+                                  'Set-Cookie': 'session=1'})
+        self.page('plain', 'x')
+        for name in ['private', 'cookie', 'plain']:
+            yield self.get(name)
+        yield self.get('plain', kwargs={'method': 'post', 'data': 'a=1'})
+        self.assertEqual(self.cache.stored, 0)
+        self.assertEqual(len(self.cache.memory), 0)
+
+
+    @defer.inlineCallbacks
+    def test_force(self):
+        """
+        A step can say how long to cache a response for, or not to use the
+        cache at all.
+        """
+        page = self.page('meta', 'x', {'Cache-Control': 'no-store'})
+        yield self.get('meta', cache=30)
+        yield self.get('meta', cache=30)
+        yield self.get('meta', cache=False)
+        self.assertEqual(len(page.requests), 2)
+        self.clock.now += 30
+        yield self.get('meta', cache=30)
+        self.assertEqual(len(page.requests), 3)
+
+        page = self.page('other', 'x', {'Cache-Control': 'max-age=60'})
+        for cache in [0, True, True]:
+            yield self.get('other', cache=cache)
+        self.assertEqual(len(page.requests), 2)
+
+
+    @defer.inlineCallbacks
+    def test_cookies(self):
+        """
+        Responses are only reused for requests with the same cookies, so
+        that runs sharing a cache don't see each other's pages.
+        """
+        page = self.page('balance', 'x', {'Cache-Control': 'max-age=60'})
+        for user in ['alice', 'bob', 'alice']:
+            yield self.get('balance', kwargs={'cookies': {'session': user}})
+        self.assertEqual(len(page.requests), 2)
+
+
+    @defer.inlineCallbacks
+    def test_vary(self):
+        """
+        Responses which vary on request headers are only reused for requests
+        with the same values of those headers.
+        """
+        page = self.page('accounts', 'x', {'Cache-Control': 'max-age=60',
+                                           'Vary': 'Accept-Language'})
+        for language in ['en', 'fr', 'fr']:
+            yield self.get('accounts', kwargs={
+                'headers': {'Accept-Language': language}})
+        self.assertEqual(len(page.requests), 2)
+
+
+    @defer.inlineCallbacks
+    def test_directory(self):
+        """
+        Responses can be kept on disk for other processes.
+        """
+        directory = self.mktemp()
+        page = self.page('config', 'v1', {'Cache-Control': 'max-age=60'})
+        self.cache = HTTPCache(directory=directory, clock=self.clock)
+        self.runner = Runner()
+        http.installHTTPHandlers(self.runner, cache=self.cache)
+        yield self.get('config')
+
+        self.cache = HTTPCache(directory=directory, clock=self.clock)
+        self.runner = Runner()
+        http.installHTTPHandlers(self.runner, cache=self.cache)
+        response = yield self.get('config')
+        self.assertEqual(response.text, 'v1')
+        self.assertEqual(len(page.requests), 1)
+        self.assertEqual(self.cache.hits, 1)
+
+
+
+class cacheKeyTest(TestCase):
+
+
+    def test_params(self):
+        """
+        Query params are part of the key.
+        """
+        self.assertEqual(cacheKey({'method': 'get', 'url': 'http://a/b',
+                                   'params': {'q': 1}}),
+                         'GET http://a/b?q=1')
+
+
+    def test_uncacheable(self):
+        """
+        Requests with bodies or credentials have no key.
+        """
+        for kwargs in [{'method': 'post', 'url': 'http://a/'},
+                       {'method': 'get', 'url': 'http://a/', 'data': 'x'},
+                       {'method': 'get', 'url': 'http://a/',
+                        'auth': ['u', 'p']},
+                       {'method': 'get', 'url': 'http://a/',
+                        'headers': {'authorization': 'Bearer x'}}]:
+            self.assertEqual(cacheKey(kwargs), None)
+
+
+    def test_session(self):
+        """
+        The session's credentials count, and its cookies for the URL are
+        part of the key.
+        """
+        kwargs = {'method': 'get', 'url': 'http://a.example/b'}
+        session = requests.Session()
+        self.assertEqual(cacheKey(kwargs, session), 'GET http://a.example/b')
+        session.cookies.set('other', 'x', domain='c.example')
+        self.assertEqual(cacheKey(kwargs, session), 'GET http://a.example/b')
+
+        session.cookies.set('session', 'alice', domain='a.example')
+        alice = cacheKey(kwargs, session)
+        session.cookies.set('session', 'bob', domain='a.example')
+        bob = cacheKey(kwargs, session)
+        self.assertTrue(alice.startswith('GET http://a.example/b '))
+        self.assertNotEqual(alice, bob)
+        self.assertNotIn('bob', bob)
+        self.assertEqual(cacheKey(dict(kwargs, cookies={'session': 'bob'})),
+                         bob)
+
+        session.headers['Authorization'] = 'Bearer x'
+        self.assertEqual(cacheKey(kwargs, session), None)
+        del session.headers['Authorization']
+        session.auth = ('u', 'p')
+        self.assertEqual(cacheKey(kwargs, session), None)
+
+
+
+class freshnessTest(TestCase):
+
+
+    def fresh(self, **headers):
+        return freshness(CaseInsensitiveDict(
+            (k.replace('_', '-'), v) for k, v in headers.items()), 1000)
+
+
+    def test_maxAge(self):
+        self.assertEqual(self.fresh(cache_control='public, max-age=60'), 60)
+        self.assertEqual(self.fresh(cache_control='max-age=60, s-maxage=5'),
+                         5)
+        self.assertEqual(self.fresh(cache_control='max-age=60', age='20'), 40)
+
+
+    def test_expires(self):
+        self.assertEqual(self.fresh(date='Sun, 06 Nov 1994 08:49:37 GMT',
+                                    expires='Sun, 06 Nov 1994 08:59:37 GMT'),
+                         600)
+        self.assertEqual(self.fresh(expires='0'), 0)
+
+
+    def test_noCache(self):
+        self.assertEqual(self.fresh(cache_control='no-cache, max-age=60'), 0)
+        self.assertEqual(self.fresh(), 0)
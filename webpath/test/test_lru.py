@@ -0,0 +1,38 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+
+
+from webpath.lru import LRUCache
+
+
+
+class LRUCacheTest(TestCase):
+
+
+    def test_get(self):
+        """
+        You can store and retrieve things.
+        """
+        cache = LRUCache(2)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 'default'), 'default')
+        self.assertTrue('a' in cache)
+        self.assertEqual(len(cache), 1)
+
+
+    def test_evict(self):
+        """
+        The least recently used item is evicted when the cache is full.
+        """
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertFalse('b' in cache, "b was used least recently")
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
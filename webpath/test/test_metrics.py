@@ -0,0 +1,185 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import task
+
+
+from webpath import trace
+from webpath.metrics import (Registry, Counter, Gauge, Histogram, Callback,
+                             RunnerMetrics)
+from webpath.runner import basicRunner, Context
+from webpath.server import Worker
+from webpath.test.test_trace import FakeClock
+
+
+
+class RegistryTest(TestCase):
+
+
+    def test_counter(self):
+        """
+        Counters are exposed with their help, type and a line for each set
+        of labels.
+        """
+        registry = Registry()
+        c = registry.add(Counter('things_total', 'Things.', ['kind']))
+        c.inc(('a',))
+        c.inc(('b',), 3)
+        c.inc(('a',))
+        self.assertEqual(registry.expose(), '\n'.join([
+            '# HELP things_total Things.',
+            '# TYPE things_total counter',
+            'things_total{kind="a"} 2',
+            'things_total{kind="b"} 3',
+        ]) + '\n')
+
+
+    def test_gauge(self):
+        registry = Registry()
+        g = registry.add(Gauge('level', 'Level.'))
+        g.inc()
+        g.inc()
+        g.dec()
+        self.assertIn('\nlevel 1\n', registry.expose())
+        g.set(2.5)
+        self.assertIn('\nlevel 2.5\n', registry.expose())
+
+
+    def test_specialValues(self):
+        """
+        Infinities and NaN are written the way Prometheus spells them.
+        """
+        registry = Registry()
+        g = registry.add(Gauge('level', 'Level.', ['v']))
+        g.set(float('inf'), ('a',))
+        g.set(float('-inf'), ('b',))
+        g.set(float('nan'), ('c',))
+        exposed = registry.expose()
+        self.assertIn('\nlevel{v="a"} +Inf\n', exposed)
+        self.assertIn('\nlevel{v="b"} -Inf\n', exposed)
+        self.assertIn('\nlevel{v="c"} NaN\n', exposed)
+
+
+    def test_escape(self):
+        """
+        Label values and help are escaped.
+        """
+        registry = Registry()
+        c = registry.add(Counter('x', 'Back\\slash\nnewline', ['v']))
+        c.inc((u'a"b\\c\nd\xe9',))
+        self.assertEqual(registry.expose().splitlines(), [
+            '# HELP x Back\\\\slash\\nnewline',
+            '# TYPE x counter',
+            'x{v="a\\"b\\\\c\\nd\xc3\xa9"} 1',
+        ])
+
+
+    def test_histogram(self):
+        """
+        Histograms have cumulative buckets, a sum and a count.
+        """
+        registry = Registry()
+        h = registry.add(Histogram('t', 'T.', ['host'], buckets=[1, 0.1]))
+        h.observe(0.05, ('h',))
+        h.observe(0.1, ('h',))
+        h.observe(0.5, ('h',))
+        h.observe(3, ('h',))
+        self.assertEqual(registry.expose().splitlines()[2:], [
+            't_bucket{host="h",le="0.1"} 2',
+            't_bucket{host="h",le="1"} 3',
+            't_bucket{host="h",le="+Inf"} 4',
+            't_sum{host="h"} 3.65',
+            't_count{host="h"} 4',
+        ])
+
+
+    def test_callback(self):
+        """
+        Callbacks are called when metrics are exposed.
+        """
+        registry = Registry()
+        values = {('a',): 1}
+        registry.add(Callback('c', 'C.', 'gauge', lambda: values, ['k']))
+        registry.add(Callback('d', 'D.', 'counter', lambda: 7))
+        values[('b',)] = 2
+        self.assertEqual(registry.expose().splitlines(), [
+            '# HELP c C.',
+            '# TYPE c gauge',
+            'c{k="a"} 1',
+            'c{k="b"} 2',
+            '# HELP d D.',
+            '# TYPE d counter',
+            'd 7',
+        ])
+
+
+    def test_workerStates(self):
+        """
+        Workers count their runs by state for a callback.
+        """
+        worker = Worker(basicRunner(), Context, None, reactor=task.Clock())
+        worker.start({'steps': [{'action': 'ask', 'key': 'a',
+                                 'prompt': 'A?'}]})
+        worker.start({'steps': [{'action': 'set', 'key': 'a', 'value': 1}]})
+        worker.start({'steps': [{'action': 'nothing'}]})
+        self.assertEqual(worker.states(), {
+            ('running',): 0,
+            ('pending-input',): 1,
+            ('done',): 1,
+            ('failed',): 1,
+        })
+
+
+
+class RunnerMetricsTest(TestCase):
+
+
+    def test_observe(self):
+        """
+        Actions are counted by handler, errors by handler and exception and
+        HTTP requests timed by host and status (without the time they were
+        queued), with their retries.
+        """
+        clock = FakeClock()
+        self.patch(trace, 'clock', clock)
+
+        def fetch(params, context):
+            clock.now += 0.2
+            context.trace.tag('host', 'example.com')
+            context.trace.tag('status', params['status'])
+            if params.get('retried'):
+                clock.now += 5
+                context.trace.add('queue_wait', 5)
+                context.trace.count('retries', 2)
+
+        def fail(params, context):
+            raise ValueError('bad')
+
+        runner = basicRunner({'fetch': fetch, 'fail': fail})
+        registry = Registry()
+        metrics = RunnerMetrics(registry)
+        runner.addObserver(metrics.observe)
+        d = runner.runActions([
+            {'action': 'fetch', 'status': 200},
+            {'action': 'fetch', 'status': 503, 'retried': True},
+            {'action': 'set', 'key': 'a', 'value': 1},
+            {'action': 'fail'},
+        ], Context())
+        self.failureResultOf(d, ValueError)
+
+        self.assertEqual(metrics.actions.values, {
+            ('fetch',): 2, ('set',): 1, ('fail',): 1})
+        self.assertEqual(metrics.errors.values, {('fail', 'ValueError'): 1})
+        self.assertEqual(sorted(metrics.http.values), [
+            ('example.com', '200'), ('example.com', '503')])
+        self.assertEqual(metrics.retries.values, {('example.com',): 2})
+        exposed = registry.expose()
+        self.assertIn('webpath_http_request_duration_seconds_bucket'
+                      '{host="example.com",status="200",le="0.25"} 1',
+                      exposed)
+        self.assertIn('webpath_http_request_duration_seconds_bucket'
+                      '{host="example.com",status="503",le="0.25"} 1',
+                      exposed)
+        self.assertIn('webpath_action_duration_seconds_count'
+                      '{action="fetch"} 2', exposed)
@@ -0,0 +1,84 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+
+import json
+import os
+
+
+from webpath.plan import PlanCache
+from webpath.runner import basicRunner, Context, PlanError
+
+
+
+SCRIPT = json.dumps([
+    {'action': 'set', 'key': 'a', 'value': '$a * 2'},
+])
+
+
+class PlanCacheTest(TestCase):
+
+
+    def setUp(self):
+        self.parsed = []
+        self.cache = PlanCache(self.mktemp())
+
+
+    def parse(self, fh):
+        self.parsed.append(fh)
+        return json.load(fh)
+
+
+    @defer.inlineCallbacks
+    def test_get(self):
+        """
+        A script is only parsed the first time; after that its plan is read
+        from the cache, even by another L{PlanCache}.
+        """
+        runner = basicRunner()
+        self.cache.get(SCRIPT, self.parse, runner)
+        plan = PlanCache(self.cache.directory).get(SCRIPT, self.parse,
+                                                   runner)
+        self.assertEqual(len(self.parsed), 1)
+        self.assertEqual(plan.actions, json.loads(SCRIPT))
+
+        context = Context()
+        context.variables['a'] = 4
+        result = yield runner.runActions(plan, context)
+        self.assertEqual(result, 8)
+
+
+    def test_handlers(self):
+        """
+        Plans are compiled again for runners with different handlers.
+        """
+        self.cache.get(SCRIPT, self.parse, basicRunner())
+        self.cache.get(SCRIPT, self.parse, basicRunner({'other': None}))
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+        self.cache.get(SCRIPT, self.parse, basicRunner())
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+
+    def test_corrupt(self):
+        """
+        Unreadable cache files are ignored.
+        """
+        runner = basicRunner()
+        self.cache.get(SCRIPT, self.parse, runner)
+        path = os.path.join(self.cache.directory,
+                            self.cache.key(SCRIPT, runner) + '.plan')
+        open(path, 'wb').write('garbage')
+        self.cache.get(SCRIPT, self.parse, runner)
+        self.assertEqual(len(self.parsed), 2)
+
+
+    def test_invalid(self):
+        """
+        Invalid scripts aren't cached.
+        """
+        script = json.dumps([{'action': 'nothing'}])
+        self.assertRaises(PlanError, self.cache.get, script, self.parse,
+                          basicRunner())
+        self.assertFalse(os.path.exists(self.cache.directory))
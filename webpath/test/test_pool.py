@@ -0,0 +1,105 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, reactor, threads
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+
+from webpath.httpagent import AgentEngine
+from webpath.pool import ConnectionPool
+from webpath.runner import Context
+
+
+
+class Page(Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        return 'hello'
+
+
+
+class ConnectionPoolTest(TestCase):
+
+
+    def setUp(self):
+        self.port = reactor.listenTCP(0, Site(Page()), interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.url = 'http://127.0.0.1:%d/' % (self.port.getHost().port,)
+
+
+    def get(self, context):
+        return threads.deferToThread(context.requests.get, self.url)
+
+
+    def test_context(self):
+        """
+        A L{Context} can be given a pool for its session to use.
+        """
+        pool = ConnectionPool(maxPerHost=3, block=True, retries=2)
+        context = Context(pool=pool)
+        self.assertEqual(context.pool, pool)
+        adapter = context.requests.get_adapter('https://example.com')
+        self.assertEqual(adapter, pool.adapter)
+        self.assertEqual(adapter.max_retries, 2)
+        self.assertEqual(adapter._pool_maxsize, 3)
+        self.assertEqual(adapter._pool_block, True)
+
+
+    @defer.inlineCallbacks
+    def test_shared(self):
+        """
+        Connections are reused across contexts sharing a pool.
+        """
+        pool = ConnectionPool()
+        self.addCleanup(pool.adapter.close)
+        yield self.get(Context(pool=pool))
+        yield self.get(Context(pool=pool))
+        self.assertEqual(pool.stats(), {
+            'requests': 2,
+            'opened': 1,
+            'reused': 1,
+        })
+
+
+    @defer.inlineCallbacks
+    def test_idleTimeout(self):
+        """
+        Connections that have been idle too long aren't reused.
+        """
+        pool = ConnectionPool(idleTimeout=0)
+        self.addCleanup(pool.adapter.close)
+        context = Context(pool=pool)
+        yield self.get(context)
+        yield self.get(context)
+        self.assertEqual(pool.stats(), {
+            'requests': 2,
+            'opened': 2,
+            'reused': 0,
+        })
+
+
+    @defer.inlineCallbacks
+    def test_agentPool(self):
+        """
+        The agent engine can use a pool too.
+        """
+        pool = ConnectionPool(maxPerHost=4, idleTimeout=30)
+        agentPool = pool.agentPool(reactor)
+        self.assertIdentical(pool.agentPool(reactor), agentPool)
+        self.assertEqual(agentPool.maxPersistentPerHost, 4)
+        self.assertEqual(agentPool.cachedConnectionTimeout, 30)
+
+        engine = AgentEngine(reactor, pool=agentPool)
+        self.addCleanup(engine.close)
+        session = Context().requests
+        yield engine.send(session, 'get', self.url)
+        yield engine.send(session, 'get', self.url)
+        self.assertEqual(pool.stats(), {
+            'requests': 2,
+            'opened': 1,
+            'reused': 1,
+        })
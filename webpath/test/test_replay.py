@@ -0,0 +1,156 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, reactor
+from twisted.web.resource import Resource, EncodingResourceWrapper
+from twisted.web.server import Site, GzipEncoderFactory
+from twisted.web.static import Data
+
+from requests.exceptions import ConnectionError
+
+
+from webpath import http
+from webpath.replay import RecordingAdapter, ReplayAdapter
+from webpath.runner import Context
+
+
+
+class Login(Resource):
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        request.addCookie('session', request.args['user'][0])
+        request.addCookie('theme', 'dark')
+        return 'welcome'
+
+
+
+class Accounts(Resource):
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.count = 0
+
+    def render_GET(self, request):
+        self.count += 1
+        return 'accounts of %s (%d)' % (request.getCookie('session'),
+                                       self.count)
+
+
+
+class RecordReplayTest(TestCase):
+
+
+    def setUp(self):
+        root = Resource()
+        root.putChild('login', Login())
+        root.putChild('accounts', Accounts())
+        root.putChild('big', EncodingResourceWrapper(
+            Data('x' * 10000, 'text/plain'), [GzipEncoderFactory()]))
+        self.port = reactor.listenTCP(0, Site(root), interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:%d/' % (self.port.getHost().port,)
+        self.path = self.mktemp()
+
+
+    def context(self, adapter):
+        context = Context()
+        adapter.mount(context.requests)
+        self.addCleanup(context.requests.close)
+        return context
+
+
+    def request(self, context, method, path, **kwargs):
+        kwargs.update(method=method, url=self.url + path)
+        return http.request({'kwargs': kwargs}, context)
+
+
+    @defer.inlineCallbacks
+    def session(self, context):
+        """
+        Log in, look at the accounts twice and get a compressed page.
+        """
+        yield self.request(context, 'post', 'login', data={'user': 'joe'})
+        responses = []
+        for path in ['accounts', 'accounts', 'big']:
+            response = yield self.request(context, 'get', path)
+            responses.append(response)
+        defer.returnValue(responses)
+
+
+    @defer.inlineCallbacks
+    def test_replay(self):
+        """
+        Responses are replayed in the order they were recorded, with their
+        cookies and decoded bodies, without a network.
+        """
+        recorder = RecordingAdapter(self.path)
+        recorded = yield self.session(self.context(recorder))
+        recorder.finish()
+        self.assertEqual(recorder.recorded, 4)
+        yield self.port.stopListening()
+
+        replayer = ReplayAdapter(self.path)
+        context = self.context(replayer)
+        replayed = yield self.session(context)
+        self.assertEqual([r.content for r in replayed],
+                         [r.content for r in recorded])
+        self.assertEqual(replayed[0].text, 'accounts of joe (1)')
+        self.assertEqual(replayed[1].text, 'accounts of joe (2)')
+        self.assertEqual(replayed[2].text, 'x' * 10000)
+        self.assertEqual(replayed[2].headers['content-encoding'], 'gzip')
+        self.assertEqual(context.requests.cookies.get('session'), 'joe')
+        self.assertEqual(context.requests.cookies.get('theme'), 'dark')
+        self.assertEqual(replayer.replayed, 4)
+
+        # played again in turn
+        response = yield self.request(context, 'get', 'accounts')
+        self.assertEqual(response.text, 'accounts of joe (1)')
+
+
+    @defer.inlineCallbacks
+    def test_unrecorded(self):
+        """
+        Requests that weren't recorded fail like a connection error.
+        """
+        recorder = RecordingAdapter(self.path)
+        yield self.request(self.context(recorder), 'get', 'accounts')
+        recorder.finish()
+        yield self.port.stopListening()
+
+        context = self.context(ReplayAdapter(self.path))
+        yield self.assertFailure(
+            self.request(context, 'post', 'login', data={'user': 'joe'}),
+            ConnectionError)
+        yield self.assertFailure(
+            self.request(context, 'get', 'accounts', params={'a': 1}),
+            ConnectionError)
+
+
+    @defer.inlineCallbacks
+    def test_latency(self):
+        """
+        Replayed responses can be delayed by a fixed latency (or the time
+        they originally took) and by how long their bodies would take to
+        download at some bandwidth.
+        """
+        recorder = RecordingAdapter(self.path)
+        yield self.request(self.context(recorder), 'get', 'accounts')
+        recorder.finish()
+        yield self.port.stopListening()
+
+        sleeps = []
+        context = self.context(ReplayAdapter(
+            self.path, latency=0.05, bandwidth=100, sleep=sleeps.append))
+        response = yield self.request(context, 'get', 'accounts')
+        self.assertEqual(sleeps, [0.05 + len(response.content) / 100.0])
+
+        sleeps = []
+        context = self.context(ReplayAdapter(
+            self.path, latency='recorded', sleep=sleeps.append))
+        yield self.request(context, 'get', 'accounts')
+        self.assertEqual(len(sleeps), 1)
+        self.assertTrue(0 < sleeps[0] < 5, sleeps)
@@ -2,10 +2,14 @@
 # See LICENSE for details.
 
 from twisted.trial.unittest import TestCase
-from twisted.internet import defer
+from twisted.internet import defer, task
+
+import sys
 
 
 from webpath.runner import Runner, Context, basicRunner, interpolate
+from webpath.runner import compileExpression, Template, precompile
+from webpath.runner import Plan, PlanError, Step, deferredParams, Timeout
 
 
 
@@ -131,6 +135,61 @@ class RunnerTest(TestCase):
 
 
 
+def echo(params, context):
+    return params['value']
+
+
+
+class HandlersTest(TestCase):
+
+
+    def test_module(self):
+        """
+        Handlers can be given by module and name, and aren't imported until
+        they're first looked up.
+        """
+        runner = Runner()
+        runner.registerHandler('echo', 'webpath.test.test_runner:echo')
+        self.assertEqual(runner.actions(), set(['echo']))
+        self.assertNotIn('echo', dict(runner._handlers))
+        d = runner.runActions([{'action': 'echo', 'value': 3}], Context())
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertIdentical(runner._handlers['echo'], echo)
+
+
+    def test_lazyHandlers(self):
+        """
+        Handlers which need setting up are set up the first time one of them
+        is looked up.
+        """
+        runner = Runner()
+        installed = []
+        def install():
+            installed.append(True)
+            runner.registerHandlers({'a': echo, 'b': echo})
+        runner.registerLazyHandlers(['a', 'b'], install)
+        self.assertEqual(runner.actions(), set(['a', 'b']))
+        self.assertEqual(installed, [])
+        runner.compile([{'action': 'a'}, {'action': 'b'}])
+        self.assertEqual(installed, [True])
+
+
+    def test_entryPoints(self):
+        """
+        Actions a runner doesn't know are looked for among the
+        C{webpath.actions} entry points.
+        """
+        from webpath import runner as module
+        self.patch(module, '_ENTRY_POINTS',
+                   {'plugin.echo': 'webpath.test.test_runner:echo'})
+        runner = Runner()
+        d = runner.runActions([{'action': 'plugin.echo', 'value': 4}],
+                              Context())
+        self.assertEqual(self.successResultOf(d), 4)
+        self.assertRaises(PlanError, runner.compile, [{'action': 'nope'}])
+
+
+
 class basicRunnerTest(TestCase):
 
 
@@ -159,6 +218,369 @@ class basicRunnerTest(TestCase):
                          "Should replace $item with the item")
 
 
+    @defer.inlineCallbacks
+    def test_loop_nested(self):
+        """
+        A loop's actions are only interpolated when they're run for an item,
+        so nested loops run with runActions can use each loop's variables.
+        """
+        runner = basicRunner()
+        context = Context()
+        yield runner.runActions([
+            {'action': 'loop', 'iterable': [1, 2], 'actions': [
+                {'action': 'set', 'key': 'outer', 'value': '$item'},
+                {'action': 'loop', 'iterable': [10, 20], 'actions': [
+                    {'action': 'append', 'key': 'sums',
+                     'value': '$outer + item'},
+                ]},
+            ]},
+        ], context)
+        self.assertEqual(context.variables['sums'], [11, 21, 12, 22])
+
+
+    @defer.inlineCallbacks
+    def test_loop_actionsExpression(self):
+        """
+        A loop's actions can be given as an expression of a list of actions,
+        compiled or not.
+        """
+        runner = basicRunner()
+        steps = [
+            {'action': 'append', 'key': 'doubled', 'value': '$item * 2'},
+        ]
+        actions = [
+            {'action': 'loop', 'iterable': [1, 2], 'actions': '$steps'},
+        ]
+        for run in [actions, runner.compile(actions)]:
+            context = Context()
+            context.variables['steps'] = steps
+            yield runner.runActions(run, context)
+            self.assertEqual(context.variables['doubled'], [2, 4])
+
+
+    def test_loop_generator(self):
+        """
+        A loop only takes each item from its iterable when it gets to it, so
+        a generator makes items as they're needed.
+        """
+        made = []
+        def numbers():
+            for i in range(3):
+                made.append(i)
+                yield i
+        def func(params, context):
+            return made[:]
+
+        runner = basicRunner({'func': func})
+        context = Context()
+        self.successResultOf(runner.runSingleAction('loop', {
+                'action': 'loop',
+                'iterable': numbers(),
+                'actions': [
+                    {'action': 'func'},
+                    {'action': 'append', 'key': 'made', 'value': '$_'},
+                ],
+            }, context))
+        self.assertEqual(context.variables['made'], [[0], [0, 1], [0, 1, 2]])
+
+
+    def test_loop_deferredItems(self):
+        """
+        Items which are Deferreds are waited for, and one which fails with
+        C{StopIteration} ends the loop with the last result.
+        """
+        items = [defer.Deferred() for i in range(3)]
+        runner = basicRunner()
+        context = Context()
+        result = runner.runSingleAction('loop', {
+                'action': 'loop',
+                'iterable': iter(items),
+                'actions': [
+                    {'action': 'append', 'key': 'seen', 'value': '$item'},
+                ],
+            }, context)
+        self.assertNoResult(result)
+        items[0].callback('a')
+        items[1].callback('b')
+        self.assertEqual(context.variables['seen'], ['a', 'b'])
+        self.assertNoResult(result)
+        items[2].errback(StopIteration())
+        self.assertEqual(self.successResultOf(result), ['a', 'b'])
+
+
+    def test_loop_deferredItemFails(self):
+        """
+        An item which fails fails the loop.
+        """
+        runner = basicRunner()
+        result = runner.runSingleAction('loop', {
+                'action': 'loop',
+                'iterable': [defer.succeed(1), defer.fail(ValueError())],
+                'actions': [],
+            }, Context())
+        self.failureResultOf(result, ValueError)
+
+
+    def test_loop_concurrency_deferredItems(self):
+        """
+        Concurrent loops wait for items which are Deferreds too.
+        """
+        items = [defer.Deferred() for i in range(3)]
+        runner = basicRunner()
+        result = runner.runSingleAction('loop', {
+                'action': 'loop',
+                'iterable': iter(items),
+                'concurrency': 2,
+                'actions': [
+                    {'action': 'set', 'key': 'x', 'value': '$item * 2'},
+                ],
+            }, Context())
+        items[1].callback(2)
+        items[0].callback(1)
+        self.assertNoResult(result)
+        items[2].errback(StopIteration())
+        self.assertEqual(self.successResultOf(result), [2, 4])
+
+
+    def test_loop_concurrency(self):
+        """
+        You can run several iterations of a loop at once, each with its own
+        C{$item}, and get back all the results in order.
+        """
+        pending = {}
+        def func(params, context):
+            pending[params['arg']] = d = defer.Deferred()
+            d.addCallback(lambda _: context.variables['item'].upper())
+            return d
+
+        runner = basicRunner({'func': func})
+        context = Context()
+
+        result = runner.runSingleAction('loop', {
+                'action': 'loop',
+                'iterable': ['jim', 'john', 'joe'],
+                'concurrency': 2,
+                'actions': [
+                    {'action': 'func', 'arg': '$item'},
+                ],
+            }, context)
+        self.assertEqual(sorted(pending), ['jim', 'john'],
+                         "Should only run 2 at once")
+        pending.pop('john').callback(None)
+        self.assertEqual(sorted(pending), ['jim', 'joe'])
+        pending.pop('joe').callback(None)
+        pending.pop('jim').callback(None)
+        self.assertEqual(self.successResultOf(result), ['JIM', 'JOHN', 'JOE'],
+                         "Results should be in the order of the items")
+        self.assertFalse('item' in context.variables,
+                         "Should not set $item on the outer context")
+
+
+    def test_loop_concurrency_failFast(self):
+        """
+        By default, a failed iteration of a concurrent loop fails the loop and
+        no more iterations are started.
+        """
+        called = []
+        def func(params, context):
+            called.append(params['arg'])
+            if params['arg'] == 'john':
+                raise ValueError('bad john')
+            return defer.Deferred()
+
+        runner = basicRunner({'func': func})
+        result = runner.runSingleAction('loop', {
+                'action': 'loop',
+                'iterable': ['jim', 'john', 'joe'],
+                'concurrency': 2,
+                'actions': [
+                    {'action': 'func', 'arg': '$item'},
+                ],
+            }, Context())
+        self.failureResultOf(result, ValueError)
+        self.assertEqual(called, ['jim', 'john'])
+
+
+    def test_loop_concurrency_cancelSiblings(self):
+        """
+        When an iteration of a concurrent loop fails, the others still
+        running are cancelled rather than carrying on after the loop has
+        failed.
+        """
+        clock = task.Clock()
+        done = []
+        def sleep(params, context):
+            return task.deferLater(clock, params['seconds'], lambda: None)
+        def finish(params, context):
+            if params['item'] == 'bad':
+                raise ValueError('bad')
+            done.append(params['item'])
+
+        runner = basicRunner({'sleep': sleep, 'finish': finish})
+        result = runner.runSingleAction('loop', {
+                'action': 'loop',
+                'iterable': [('bad', 1), ('good', 6)],
+                'concurrency': 2,
+                'actions': [
+                    {'action': 'sleep', 'seconds': '$item[1]'},
+                    {'action': 'finish', 'item': '$item[0]'},
+                ],
+            }, Context())
+        clock.advance(1)
+        self.failureResultOf(result, ValueError)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        clock.advance(5)
+        self.assertEqual(done, [])
+
+
+    def test_loop_concurrency_collectErrors(self):
+        """
+        You can collect errors from a concurrent loop instead of failing.
+        """
+        def func(params, context):
+            if params['arg'] == 'john':
+                raise ValueError('bad john')
+            return params['arg']
+
+        runner = basicRunner({'func': func})
+        result = runner.runSingleAction('loop', {
+                'action': 'loop',
+                'iterable': ['jim', 'john', 'joe'],
+                'concurrency': 2,
+                'errors': 'collect',
+                'actions': [
+                    {'action': 'func', 'arg': '$item'},
+                ],
+            }, Context())
+        self.assertEqual(self.successResultOf(result), [
+            'jim', {'error': 'ValueError: bad john'}, 'joe'])
+
+
+    def test_parallel(self):
+        """
+        Branches run at the same time, each with its own C{$_}, and their
+        results are joined into a dict and put in C{$_R}.
+        """
+        pending = {}
+        def fetch(params, context):
+            pending[params['page']] = d = defer.Deferred()
+            return d
+
+        runner = basicRunner({'fetch': fetch})
+        context = Context()
+        context.saveResult('before')
+        result = runner.runActions([
+            {'action': 'parallel', 'branches': {
+                'balances': [
+                    {'action': 'fetch', 'page': 'balances'},
+                    {'action': 'set', 'key': 'balance', 'value': '$_ * 2'},
+                ],
+                'profile': [
+                    {'action': 'set', 'key': 'last', 'value': '$_'},
+                    {'action': 'fetch', 'page': 'profile'},
+                ],
+            }},
+        ], context)
+        self.assertEqual(sorted(pending), ['balances', 'profile'])
+        pending['profile'].callback('joe')
+        pending['balances'].callback(5)
+        self.assertEqual(self.successResultOf(result), {
+            'balances': 10,
+            'profile': 'joe',
+        })
+        self.assertEqual(context.variables['last'], 'before')
+        self.assertEqual(context.named_results['balances'], 10)
+        self.assertEqual(context.variables['_'], {
+            'balances': 10,
+            'profile': 'joe',
+        })
+
+
+    def test_parallel_loops(self):
+        """
+        Each branch has its own C{$item}, so loops in branches running at
+        the same time don't see each other's items.
+        """
+        pending = []
+        def wait(params, context):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        runner = basicRunner({'wait': wait})
+        context = Context()
+        context.variables['item'] = 'outer'
+        result = runner.runActions([
+            {'action': 'parallel', 'branches': dict([
+                (name, [
+                    {'action': 'loop', 'iterable': iterable, 'actions': [
+                        {'action': 'wait'},
+                        {'action': 'append', 'key': name, 'value': '$item'},
+                    ]},
+                ]) for name, iterable in [('a', ['x', 'y']), ('b', [1, 2])]
+            ])},
+        ], context)
+        while pending:
+            pending.pop(0).callback(None)
+        self.successResultOf(result)
+        self.assertEqual(context.variables['a'], ['x', 'y'])
+        self.assertEqual(context.variables['b'], [1, 2])
+        self.assertEqual(context.variables['item'], 'outer')
+
+
+    def test_parallel_concurrency(self):
+        """
+        You can limit how many branches run at once.
+        """
+        pending = []
+        def fetch(params, context):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        runner = basicRunner({'fetch': fetch})
+        result = runner.runSingleAction('parallel', {
+            'action': 'parallel',
+            'concurrency': 2,
+            'branches': dict([(name, [{'action': 'fetch'}])
+                              for name in 'abc']),
+        }, Context())
+        self.assertEqual(len(pending), 2)
+        pending[0].callback(1)
+        self.assertEqual(len(pending), 3)
+        pending[1].callback(2)
+        pending[2].callback(3)
+        self.assertEqual(self.successResultOf(result),
+                         {'a': 1, 'b': 2, 'c': 3})
+
+
+    def test_parallel_cancelSiblings(self):
+        """
+        When a branch fails, the others are cancelled and the parallel action
+        fails with the branch's error.
+        """
+        pending = []
+        called = []
+        cancelled = []
+        def fetch(params, context):
+            called.append(params['page'])
+            pending.append(defer.Deferred(
+                lambda d: cancelled.append(params['page'])))
+            return pending[-1]
+
+        runner = basicRunner({'fetch': fetch})
+        result = runner.runSingleAction('parallel', {
+            'action': 'parallel',
+            'branches': {
+                'a': [{'action': 'fetch', 'page': 'a1'},
+                      {'action': 'fetch', 'page': 'a2'}],
+                'b': [{'action': 'fetch', 'page': 'b1'}],
+            },
+        }, Context())
+        pending[1].errback(ValueError('b failed'))
+        self.failureResultOf(result, ValueError)
+        self.assertEqual(cancelled, ['a1'])
+        self.assertEqual(called, ['a1', 'b1'], "a2 should never start")
+
+
     @defer.inlineCallbacks
     def test_set(self):
         """
@@ -245,6 +667,245 @@ class basicRunnerTest(TestCase):
 
 
 
+class runActionsCancelTest(TestCase):
+
+
+    def test_cancel(self):
+        """
+        Cancelling runActions cancels the running action (even within a loop)
+        and runs no more.
+        """
+        pending = []
+        cancelled = []
+        def wait(params, context):
+            pending.append(defer.Deferred(cancelled.append))
+            return pending[-1]
+
+        runner = basicRunner({'wait': wait})
+        context = Context()
+        d = runner.runActions([
+            {'action': 'loop', 'iterable': [1, 2], 'actions': [
+                {'action': 'wait'},
+            ]},
+            {'action': 'set', 'key': 'after', 'value': True},
+        ], context)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(cancelled, pending)
+        self.assertEqual(len(pending), 1)
+        self.assertNotIn('after', context.variables)
+
+
+
+class runActionsInlineTest(TestCase):
+
+
+    def test_sync(self):
+        """
+        Synchronous handlers are run inline, and their result is returned
+        as it is.
+        """
+        runner = basicRunner()
+        context = Context()
+        result = runner.runActionsInline([
+            {'action': 'set', 'key': 'a', 'value': 1},
+            {'action': 'append', 'key': 'b', 'value': '$a'},
+        ], context)
+        self.assertEqual(result, [1])
+        self.assertEqual(context.results, [1, [1]])
+
+
+    def test_async(self):
+        """
+        When a handler returns a Deferred which hasn't fired, the rest of the
+        actions are run once it does.
+        """
+        pending = defer.Deferred()
+        runner = basicRunner({'wait': lambda params, context: pending,
+                              'now': lambda params, context:
+                              defer.succeed('now')})
+        context = Context()
+        d = runner.runActionsInline([
+            {'action': 'now'},
+            {'action': 'wait'},
+            {'action': 'set', 'key': 'a', 'value': '$_'},
+        ], context)
+        self.assertIsInstance(d, defer.Deferred)
+        self.assertNoResult(d)
+        self.assertEqual(context.results, ['now'])
+        pending.callback('later')
+        self.assertEqual(self.successResultOf(d), 'later')
+        self.assertEqual(context.results, ['now', 'later', 'later'])
+
+
+    def test_error(self):
+        """
+        Errors raised by synchronous handlers are raised, or failed with
+        by L{Runner.runActions}.
+        """
+        def fail(params, context):
+            raise ValueError()
+        runner = basicRunner({'fail': fail})
+        steps = [{'action': 'fail'}, {'action': 'set', 'key': 'a',
+                                      'value': 1}]
+        self.assertRaises(ValueError, runner.runActionsInline, steps,
+                          Context())
+        context = Context()
+        self.failureResultOf(runner.runActions(steps, context), ValueError)
+        self.assertNotIn('a', context.variables)
+
+
+    def test_longLoop(self):
+        """
+        A loop of synchronous actions runs in constant stack space, however
+        many iterations it has.
+        """
+        def depth(params, context):
+            frame, n = sys._getframe(), 0
+            while frame is not None:
+                frame, n = frame.f_back, n + 1
+            return n
+        runner = basicRunner({'depth': depth,
+                              'fired': lambda params, context:
+                              defer.succeed(None)})
+        context = Context()
+        d = runner.runActions([
+            {'action': 'loop', 'iterable': xrange(5000), 'actions': [
+                {'action': 'fired'},
+                {'action': 'depth'},
+                {'action': 'append', 'key': 'depths', 'value': '$_'},
+            ]},
+        ], context)
+        self.successResultOf(d)
+        self.assertEqual(len(set(context.variables['depths'])), 1)
+
+
+
+class timeoutTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pending = []
+        self.cancelled = []
+        self.left = []
+        self.runner = basicRunner({'wait': self.wait})
+        self.runner.reactor = self.clock
+
+
+    def wait(self, params, context):
+        """
+        Note the time left and wait until cancelled.
+        """
+        self.left.append(context.timeLeft())
+        self.pending.append(defer.Deferred(self.cancelled.append))
+        return self.pending[-1]
+
+
+    def test_action(self):
+        """
+        An action with a C{timeout} is cancelled if it isn't done in time
+        and fails with L{Timeout}.
+        """
+        context = Context()
+        d = self.runner.runActions([
+            {'action': 'wait', 'timeout': 5},
+            {'action': 'set', 'key': 'after', 'value': True},
+        ], context)
+        self.assertEqual(self.left, [5])
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        f = self.failureResultOf(d, Timeout)
+        self.assertEqual(f.getErrorMessage(),
+                         "action 'wait' timed out after 5 seconds")
+        self.assertEqual(self.cancelled, self.pending)
+        self.assertNotIn('after', context.variables)
+        self.assertEqual(context.deadline, None)
+
+
+    def test_inTime(self):
+        """
+        Actions done in time aren't affected, and their timers are stopped.
+        """
+        context = Context()
+        d = self.runner.runActions([
+            {'action': 'set', 'key': 'a', 'value': 1, 'timeout': 5},
+        ], context)
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_nested(self):
+        """
+        A timeout applies to the actions nested in a loop, which have only
+        as long as is left (or their own timeout if it's shorter).
+        """
+        context = Context()
+        d = self.runner.runActions([
+            {'action': 'loop', 'iterable': [1, 2], 'timeout': 10, 'actions': [
+                {'action': 'set', 'key': 'x', 'value': '$item'},
+                {'action': 'wait', 'timeout': 9},
+            ]},
+        ], context)
+        self.clock.advance(3)
+        self.pending[0].callback(None)
+        self.assertEqual(self.left, [9, 7])
+        self.clock.advance(7)
+        self.failureResultOf(d, Timeout)
+        self.assertEqual(len(self.cancelled), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(context.variables['x'], 2)
+
+
+    def test_run(self):
+        """
+        A whole run can be given a timeout.
+        """
+        context = Context()
+        d = self.runner.runActions([
+            {'action': 'set', 'key': 'a', 'value': 1},
+            {'action': 'wait'},
+        ], context, timeout=30)
+        self.assertEqual(self.left, [30])
+        self.clock.advance(30)
+        f = self.failureResultOf(d, Timeout)
+        self.assertEqual(f.getErrorMessage(),
+                         'run timed out after 30 seconds')
+        self.assertEqual(self.cancelled, self.pending)
+
+
+    def test_runReused(self):
+        """
+        A run's timeout doesn't limit later runs with the same context.
+        """
+        context = Context()
+        d = self.runner.runActions([
+            {'action': 'set', 'key': 'a', 'value': 1},
+        ], context, timeout=5)
+        self.successResultOf(d)
+        d = self.runner.runActions([{'action': 'wait'}], context, timeout=5)
+        self.clock.advance(5)
+        self.failureResultOf(d, Timeout)
+        self.assertEqual(context.deadline, None)
+
+        self.clock.advance(60)
+        self.runner.runActions([{'action': 'wait'}], context)
+        self.assertEqual(self.left[-1], None)
+
+
+    def test_cancelled(self):
+        """
+        Cancelling an action with a timeout isn't a timeout.
+        """
+        d = self.runner.runActions([{'action': 'wait', 'timeout': 5}],
+                                   Context())
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
 class ContextTest(TestCase):
 
 
@@ -272,6 +933,86 @@ class ContextTest(TestCase):
         self.assertEqual(self.successResultOf(result), 'foo')
 
 
+    def test_scope(self):
+        """
+        A scoped context has its own copy of some variables, shares the rest
+        and shares results.
+        """
+        context = Context()
+        context.saveResult('last')
+        context.variables['shared'] = 'a'
+        child = context.scope({'item': 'foo'})
+        self.assertEqual(child.variables['item'], 'foo')
+        self.assertEqual(child.variables['shared'], 'a')
+        self.assertEqual(child.variables['_'], 'last')
+
+        child.variables['shared'] = 'b'
+        child.variables.setdefault('new', []).append(1)
+        child.saveResult('child result', name='child')
+        self.assertEqual(context.variables['shared'], 'b')
+        self.assertEqual(context.variables['new'], [1])
+        self.assertEqual(context.variables['_'], 'last',
+                         "The last result is local to the scope")
+        self.assertEqual(context.named_results['child'], 'child result')
+        self.assertFalse('item' in context.variables)
+
+
+    def test_scope_interpolate(self):
+        """
+        Scoped variables can be used in $expressions.
+        """
+        context = Context()
+        context.variables['foo'] = 'foo'
+        child = context.scope({'item': 'bar'})
+        self.assertEqual(interpolate({'a': '$foo + item'}, child.variables),
+                         {'a': 'foobar'})
+
+
+    def test_retention(self):
+        """
+        By default every result is kept.  You can keep only the most recent
+        few, only named ones or none of them.
+        """
+        def save(context):
+            for i in xrange(5):
+                context.saveResult(i, name='three' if i == 3 else None)
+            return list(context.results)
+
+        self.assertEqual(save(Context()), [0, 1, 2, 3, 4])
+        self.assertEqual(save(Context(retention=2)), [3, 4])
+        self.assertEqual(save(Context(retention='named')), [3])
+        self.assertEqual(save(Context(retention='none')), [])
+
+        context = Context(retention='none')
+        save(context)
+        self.assertEqual(context.variables['_'], 4)
+        self.assertEqual(context.named_results, {'three': 3})
+
+
+    def test_summarize(self):
+        """
+        Responses can be kept as summaries rather than with their bodies.
+        """
+        from requests.models import Response
+        response = Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = 'http://example.com/'
+        response.headers['Content-Type'] = 'text/html'
+        response._content = 'hello'
+        context = Context(summarize=True)
+        context.saveResult(response)
+        context.saveResult('other')
+        self.assertEqual(context.results, [{
+            'url': 'http://example.com/',
+            'status_code': 200,
+            'reason': 'OK',
+            'headers': {'Content-Type': 'text/html'},
+            'size': 5,
+        }, 'other'])
+        self.assertIdentical(context.variables['_'], 'other')
+
+
     def test_requests(self):
         """
         It should use a requests session by default.
@@ -282,6 +1023,18 @@ class ContextTest(TestCase):
                         "Should have a .requests attr that is a Session")
 
 
+    def test_lazy(self):
+        """
+        The requests session and document cache are only made when they're
+        first used, and are shared with scopes made before then.
+        """
+        c = Context()
+        scope = c.scope({})
+        self.assertEqual(c._shared, {'documents': None})
+        self.assertIdentical(scope.requests, c.requests)
+        self.assertIdentical(scope.documents, c.documents)
+
+
 
 class interpolateTest(TestCase):
 
@@ -348,3 +1101,188 @@ class interpolateTest(TestCase):
         result = interpolate(original, variables)
         self.assertEqual(result, {'foo': 'apple'})
 
+
+    def test_template(self):
+        """
+        You can interpolate a precompiled L{Template}.
+        """
+        variables = {'foo': [1, 'apple'], 'bar': 'bar value'}
+        template = Template({'a': '$foo[1]', 'b': ['$bar', {'c': '$bar'}],
+                             'd': 5})
+        self.assertEqual(interpolate(template, variables), {
+            'a': 'apple',
+            'b': ['bar value', {'c': 'bar value'}],
+            'd': 5,
+        })
+        variables['bar'] = 'changed'
+        self.assertEqual(interpolate(template, variables)['b'],
+                         ['changed', {'c': 'changed'}])
+
+
+    def test_deferred(self):
+        """
+        Deferred params are left as they are.
+        """
+        variables = {'foo': 'foo value'}
+        params = {'a': '$foo', 'body': [{'b': '$undefined'}]}
+        expected = {'a': 'foo value', 'body': [{'b': '$undefined'}]}
+        self.assertEqual(interpolate(params, variables, ['body']), expected)
+        self.assertEqual(interpolate(Template(params), variables, ['body']),
+                         expected)
+
+
+    @defer.inlineCallbacks
+    def test_deferredParams(self):
+        """
+        Handlers can declare params that runActions shouldn't interpolate.
+        """
+        @deferredParams('later')
+        def handler(params, context):
+            return params
+        runner = Runner({'defer': handler})
+        self.assertEqual(handler.deferredParams, frozenset(['later']))
+        result = yield runner.runActions([
+            {'action': 'defer', 'now': '$1 + 1', 'later': '$1 + 1'},
+        ], Context())
+        self.assertEqual(result, {
+            'action': 'defer',
+            'now': 2,
+            'later': '$1 + 1',
+        })
+
+
+    def test_template_freshContainers(self):
+        """
+        Each rendering of a L{Template} should produce new lists and dicts so
+        that handlers can't change later renderings.
+        """
+        template = Template({'a': [1, 2], 'b': {'c': 3}})
+        first = template.render({})
+        first['a'].append(3)
+        first['b']['d'] = 4
+        self.assertEqual(template.render({}), {'a': [1, 2], 'b': {'c': 3}})
+
+
+
+class compileExpressionTest(TestCase):
+
+
+    def test_cached(self):
+        """
+        Compiling the same expression twice should return the same code.
+        """
+        code = compileExpression('foo["bar"] + 1')
+        self.assertIdentical(compileExpression('foo["bar"] + 1'), code)
+        self.assertEqual(eval(code, {}, {'foo': {'bar': 1}}), 2)
+
+
+    def test_syntaxError(self):
+        """
+        Malformed expressions raise SyntaxError.
+        """
+        self.assertRaises(SyntaxError, compileExpression, 'foo[')
+
+
+
+class precompileTest(TestCase):
+
+
+    @defer.inlineCallbacks
+    def test_runActions(self):
+        """
+        Precompiled actions can be run just like regular actions.
+        """
+        runner = basicRunner({
+            'speak': lambda params, context: params['word'],
+        })
+        context = Context()
+        actions = precompile([
+            {'action': 'set', 'key': 'foo', 'value': 'hello'},
+            {'action': 'speak', 'word': '$foo + " there"'},
+        ])
+        result = yield runner.runActions(actions, context)
+        self.assertEqual(result, 'hello there')
+
+
+
+class compileTest(TestCase):
+
+
+    def test_compile(self):
+        """
+        Compiling actions gives a L{Plan} of L{Step}s whose handlers have
+        been looked up.
+        """
+        speak = lambda params, context: params['word']
+        runner = basicRunner({'speak': speak})
+        plan = runner.compile([
+            {'action': 'speak', 'word': '$foo'},
+        ])
+        self.assertTrue(isinstance(plan, Plan))
+        self.assertTrue(isinstance(plan[0], Step))
+        self.assertIdentical(plan[0].handler, speak)
+        self.assertEqual(plan[0].render({'foo': 'hi'}),
+                         {'action': 'speak', 'word': 'hi'})
+        self.assertEqual(plan.expressions.keys(), ['foo'])
+        self.assertIdentical(runner.compile(plan), plan)
+
+
+    def test_errors(self):
+        """
+        Unknown actions and invalid expressions anywhere in the actions are
+        all reported at once.
+        """
+        runner = basicRunner()
+        exc = self.assertRaises(PlanError, runner.compile, [
+            {'action': 'set', 'key': 'a', 'value': '$1 +'},
+            {'action': 'nothing'},
+            {'key': 'a'},
+            {'action': 'loop', 'iterable': [1], 'actions': [
+                {'action': 'dump', 'keys': ['$)']},
+            ]},
+        ])
+        self.assertEqual(len(exc.errors), 4)
+        self.assertTrue(exc.errors[0].startswith(
+            "steps[0].value: invalid expression '$1 +'"))
+        self.assertEqual(exc.errors[1], "steps[1]: unknown action 'nothing'")
+        self.assertEqual(exc.errors[2],
+                         "steps[2]: not an action: {'key': 'a'}")
+        self.assertTrue(exc.errors[3].startswith(
+            "steps[3].actions[0].keys[0]: invalid expression '$)'"))
+
+
+    def test_actionsAsData(self):
+        """
+        Only params the handler defers are compiled as nested actions.
+        Anything else that looks like a list of actions is passed to the
+        handler as it's written.
+        """
+        runner = basicRunner()
+        context = Context()
+        value = [{'action': 'nothing', 'x': 1}]
+        plan = runner.compile([
+            {'action': 'set', 'key': 'a', 'value': value},
+        ])
+        self.assertEqual(plan[0]['value'], value)
+        self.successResultOf(runner.runActions(plan, context))
+        self.assertEqual(context.variables['a'],
+                         [{'action': 'nothing', 'x': 1}])
+
+
+    @defer.inlineCallbacks
+    def test_nested(self):
+        """
+        Nested actions are compiled too and only rendered when they're run,
+        so they can use variables set by the action they're nested in.
+        """
+        runner = basicRunner()
+        context = Context()
+        plan = runner.compile([
+            {'action': 'loop', 'iterable': [1, 2], 'actions': [
+                {'action': 'append', 'key': 'doubled', 'value': '$item * 2'},
+            ]},
+        ])
+        self.assertTrue(isinstance(plan[0]['actions'][0], Step))
+        result = yield runner.runActions(plan, context)
+        self.assertEqual(result, [2, 4])
+
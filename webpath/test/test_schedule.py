@@ -0,0 +1,183 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task
+
+from requests.exceptions import ConnectionError
+
+
+from webpath.runner import Context
+from webpath.schedule import HostScheduler
+from webpath.trace import ActionTrace
+
+
+
+class Response(object):
+
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+
+class HostSchedulerTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.calls = []
+        self.results = []
+
+
+    def handler(self, params, context):
+        """
+        Record the request and answer it with the next of C{self.results}
+        (a Deferred by default).
+        """
+        self.calls.append((params['kwargs']['url'], self.clock.seconds()))
+        if self.results:
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+
+    def request(self, scheduler, url='http://bank.example.com/',
+                method='get'):
+        context = Context()
+        context.trace = ActionTrace('http')
+        d = scheduler.request(self.handler,
+                              {'kwargs': {'method': method, 'url': url}},
+                              context)
+        d.trace = context.trace
+        return d
+
+
+    def test_rate(self):
+        """
+        Requests to a host are started no faster than its rate allows, after
+        an initial burst, while other hosts aren't held up.
+        """
+        scheduler = HostScheduler(rate=2, burst=2, reactor=self.clock)
+        self.results = [Response() for i in range(5)]
+        ds = [self.request(scheduler) for i in range(4)]
+        other = self.request(scheduler, 'http://other.example.com/')
+        self.assertEqual([t for url, t in self.calls], [0, 0, 0])
+        self.assertEqual(scheduler.stats()['bank.example.com']['queued'], 2)
+
+        self.clock.advance(0.5)
+        self.assertEqual(len(self.calls), 4)
+        self.clock.advance(0.5)
+        self.assertEqual([t for url, t in self.calls], [0, 0, 0, 0.5, 1.0])
+        for d in ds + [other]:
+            self.successResultOf(d)
+        self.assertEqual(ds[3].trace.timings['queue_wait'], 1.0)
+        self.assertEqual(scheduler.stats()['bank.example.com'], {
+            'queued': 0,
+            'active': 0,
+            'started': 4,
+            'retried': 0,
+            'waited': 1.5,
+        })
+
+
+    def test_concurrency(self):
+        """
+        Only so many requests to a host are in flight at once; the rest wait
+        in order.
+        """
+        self.pending = []
+        scheduler = HostScheduler(concurrency=2, reactor=self.clock)
+        ds = [self.request(scheduler) for i in range(3)]
+        self.assertEqual(len(self.pending), 2)
+        self.assertEqual(scheduler.stats()['bank.example.com']['queued'], 1)
+
+        self.pending[1].callback('second')
+        self.assertEqual(self.successResultOf(ds[1]), 'second')
+        self.assertEqual(len(self.pending), 3)
+        self.pending[0].callback('first')
+        self.pending[2].callback('third')
+        self.assertEqual(self.successResultOf(ds[2]), 'third')
+
+
+    def test_cancel(self):
+        """
+        Cancelling a queued request takes it out of the queue.
+        """
+        self.pending = []
+        scheduler = HostScheduler(concurrency=1, reactor=self.clock)
+        first = self.request(scheduler)
+        second = self.request(scheduler)
+        second.cancel()
+        self.failureResultOf(second, defer.CancelledError)
+        self.assertEqual(scheduler.stats()['bank.example.com']['queued'], 0)
+        self.pending[0].callback('done')
+        self.successResultOf(first)
+        self.assertEqual(len(self.calls), 1)
+
+
+    def test_retry(self):
+        """
+        Idempotent requests that fail to connect are retried with
+        exponential backoff.
+        """
+        scheduler = HostScheduler(retries=3, backoff=0.5, reactor=self.clock,
+                                  random=lambda: 0.5)
+        ok = Response()
+        self.results = [ConnectionError(), ConnectionError(), ok]
+        d = self.request(scheduler)
+        self.clock.advance(0.25)
+        self.clock.advance(0.5)
+        self.assertEqual(self.successResultOf(d), ok)
+        self.assertEqual([t for url, t in self.calls], [0, 0.25, 0.75])
+        self.assertEqual(d.trace.counts, {'retries': 2})
+        self.assertEqual(scheduler.stats()['bank.example.com']['retried'], 2)
+
+
+    def test_retryStatus(self):
+        """
+        Throttled responses are retried after their Retry-After, and the
+        last one is returned if they're all throttled.
+        """
+        scheduler = HostScheduler(retries=1, reactor=self.clock)
+        throttled = Response(429, {'retry-after': '7'})
+        again = Response(503)
+        self.results = [throttled, again]
+        d = self.request(scheduler)
+        self.assertTrue(throttled.closed)
+        self.clock.advance(7)
+        self.assertEqual(self.successResultOf(d), again)
+        self.assertFalse(again.closed)
+
+
+    def test_noRetry(self):
+        """
+        Requests that aren't idempotent, and errors that aren't about the
+        connection, aren't retried.
+        """
+        scheduler = HostScheduler(retries=3, reactor=self.clock)
+        self.results = [ConnectionError()]
+        self.failureResultOf(self.request(scheduler, method='post'),
+                             ConnectionError)
+        self.results = [ValueError()]
+        self.failureResultOf(self.request(scheduler), ValueError)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(scheduler.stats()['bank.example.com']['active'], 0)
+
+
+    def test_backoff(self):
+        """
+        Backoff doubles with each attempt up to a limit and is jittered.
+        """
+        scheduler = HostScheduler(backoff=1, maxBackoff=5,
+                                  random=lambda: 0.5)
+        self.assertEqual([scheduler.delay(i) for i in range(5)],
+                         [0.5, 1, 2, 2.5, 2.5])
@@ -0,0 +1,99 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+
+from StringIO import StringIO
+import json
+import yaml
+
+
+from webpath.script import Serializer, HTTP_ACTIONS
+from webpath.runner import Runner
+from webpath import http
+
+
+RESULTS = [
+    [],
+    {},
+    None,
+    'text',
+    [{'date': '2014-06-01', 'amount': '-3.50', 'memo': 'two\nlines'}, [], 4],
+    {'accounts': [{'id': 1, 'balance': None}], 'empty': {}},
+]
+
+
+class SerializerTest(TestCase):
+
+
+    def dump(self, fmt, data):
+        fh = StringIO()
+        getattr(Serializer(), 'dump_' + fmt)(data, fh)
+        return fh.getvalue()
+
+
+    def test_json(self):
+        """
+        Results are written as indented JSON an element at a time, exactly as
+        if they were written all at once.
+        """
+        for data in RESULTS:
+            self.assertEqual(self.dump('json', data),
+                             json.dumps(data, indent=2))
+            self.assertEqual(Serializer().load_json(
+                StringIO(self.dump('json', data))), data)
+
+
+    def test_yaml(self):
+        """
+        Results are written as YAML an element at a time.
+        """
+        for data in RESULTS:
+            self.assertEqual(yaml.safe_load(self.dump('yaml', data)), data)
+            self.assertEqual(Serializer().load_yaml(
+                StringIO(self.dump('yaml', data))), data)
+
+
+    def test_iterYaml(self):
+        """
+        Each document of a YAML stream is read with the same loader as
+        L{Serializer.load_yaml}, and lists are read an element at a time.
+        """
+        serializer = Serializer()
+        yaml, Loader, Dumper = serializer._yaml()
+        loaders = []
+        class RecordingLoader(Loader):
+            def __init__(self, stream):
+                loaders.append(self)
+                Loader.__init__(self, stream)
+        self.patch(serializer, '_yaml',
+                   lambda: (yaml, RecordingLoader, Dumper))
+        stream = StringIO('- a: 1\n- 2\n---\nb: 3\n---\n')
+        self.assertEqual(list(serializer.iter_yaml(stream)),
+                         [{'a': 1}, 2, {'b': 3}])
+        self.assertEqual(len(loaders), 1)
+
+
+    def test_jsonl(self):
+        """
+        Lists are written as one line of JSON per element; anything else as
+        a single line.
+        """
+        self.assertEqual(self.dump('jsonl', [{'a': 1}, 2]), '{"a": 1}\n2\n')
+        self.assertEqual(self.dump('jsonl', {'a': 1}), '{"a": 1}\n')
+        self.assertEqual(Serializer().load_jsonl(StringIO('{"a": 1}\n\n2\n')),
+                         [{'a': 1}, 2])
+
+
+
+class HTTPActionsTest(TestCase):
+
+
+    def test_installed(self):
+        """
+        The HTTP actions registered lazily are the ones
+        L{http.installHTTPHandlers} installs.
+        """
+        runner = Runner()
+        http.installHTTPHandlers(runner)
+        self.assertEqual(runner.actions(), set(HTTP_ACTIONS))
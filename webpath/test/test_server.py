@@ -0,0 +1,204 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, reactor, task
+from twisted.internet.protocol import ClientCreator, Protocol
+from twisted.web import error
+from twisted.web.client import getPage
+from twisted.web.server import Site
+
+import json
+
+
+from webpath.runner import basicRunner, Context
+from webpath.server import Worker, RunsResource
+
+
+
+ASK_STEPS = [
+    {'action': 'ask', 'key': 'user', 'prompt': 'Who?'},
+    {'action': 'ask', 'key': 'password', 'prompt': 'Password?'},
+    {'action': 'dump', 'keys': ['user', 'password']},
+]
+
+
+class WorkerTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+
+
+    def test_done(self):
+        """
+        Finished runs report their result and are then forgotten.
+        """
+        worker = Worker(basicRunner(), Context, None, reactor=self.clock)
+        run = worker.start({
+            'steps': [{'action': 'set', 'key': 'a', 'value': '$a * 2'}],
+            'variables': {'a': 4},
+        })
+        self.assertEqual(self.successResultOf(run.wait()), run)
+        self.assertEqual(worker.report(run), {
+            'id': run.id,
+            'state': 'done',
+            'result': 8,
+        })
+        self.assertEqual(worker.runs, {})
+
+
+    def test_failed(self):
+        """
+        Failed runs report their error.
+        """
+        worker = Worker(basicRunner(), Context, None, reactor=self.clock)
+        run = worker.start({'steps': [{'action': 'nothing'}]})
+        self.assertEqual(worker.report(run), {
+            'id': run.id,
+            'state': 'failed',
+            'error': "PlanError: steps[0]: unknown action 'nothing'",
+        })
+
+
+    def test_pendingInput(self):
+        """
+        C{ask} actions wait for input unless the answer was given when the
+        job was started.
+        """
+        worker = Worker(basicRunner(), Context, None, reactor=self.clock)
+        run = worker.start({'steps': ASK_STEPS, 'input': {'user': 'joe'}})
+        self.assertEqual(worker.report(run), {
+            'id': run.id,
+            'state': 'pending-input',
+            'key': 'password',
+            'prompt': 'Password?',
+            'kwargs': {},
+        })
+        self.assertEqual(worker.runs, {run.id: run})
+
+        run.answer('secret')
+        self.assertEqual(worker.report(run)['result'], {
+            'user': 'joe',
+            'password': 'secret',
+        })
+        self.assertRaises(ValueError, run.answer, 'again')
+
+
+    def test_expire(self):
+        """
+        Runs which are over are forgotten if they aren't reported within
+        C{keep} seconds.
+        """
+        worker = Worker(basicRunner(), Context, None, keep=10,
+                        reactor=self.clock)
+        run = worker.start({'steps': [{'action': 'nothing'}]})
+        self.clock.advance(9)
+        self.assertEqual(worker.runs, {run.id: run})
+        self.clock.advance(1)
+        self.assertEqual(worker.runs, {})
+
+
+    def test_expirePendingInput(self):
+        """
+        Runs left waiting for input are cancelled and forgotten; answering
+        in time starts the wait over.
+        """
+        worker = Worker(basicRunner(), Context, None, keep=10,
+                        reactor=self.clock)
+        run = worker.start({'steps': ASK_STEPS})
+        self.clock.advance(5)
+        run.answer('joe')
+        self.clock.advance(5)
+        self.assertEqual(run.state, 'pending-input')
+        self.assertEqual(worker.runs, {run.id: run})
+        self.clock.advance(9)
+        self.assertEqual(worker.runs, {run.id: run})
+        self.clock.advance(1)
+        self.assertEqual(worker.runs, {})
+        self.assertEqual(run.state, 'failed')
+        self.assertEqual(run.error, 'CancelledError: ')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+
+class RunsResourceTest(TestCase):
+
+
+    def setUp(self):
+        self.started = defer.Deferred()
+        self.cancelled = defer.Deferred()
+        self.worker = Worker(basicRunner({'wait': self.wait}), Context, None)
+        site = Site(RunsResource(self.worker))
+        self.port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+
+
+    def wait(self, params, context):
+        """
+        Wait until cancelled.
+        """
+        self.started.callback(None)
+        return defer.Deferred(lambda d: self.cancelled.callback(None))
+
+
+    def post(self, path, data):
+        url = 'http://127.0.0.1:%d%s' % (self.port.getHost().port, path)
+        d = getPage(url, method='POST', postdata=json.dumps(data))
+        return d.addCallback(json.loads)
+
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        """
+        You can start a run, answer its questions and get its result.
+        """
+        state = yield self.post('/', {'steps': ASK_STEPS})
+        self.assertEqual(state['state'], 'pending-input')
+        self.assertEqual(state['key'], 'user')
+
+        path = '/%s/input' % (str(state['id']),)
+        state = yield self.post(path, {'value': 'joe'})
+        self.assertEqual(state['key'], 'password')
+        state = yield self.post(path, {'value': 'secret'})
+        self.assertEqual(state['state'], 'done')
+        self.assertEqual(state['result'], {
+            'user': 'joe',
+            'password': 'secret',
+        })
+
+
+    @defer.inlineCallbacks
+    def test_badJob(self):
+        """
+        A job that isn't a JSON object is refused.
+        """
+        for data in [[1, 2], 'steps']:
+            try:
+                yield self.post('/', data)
+            except error.Error as e:
+                self.assertEqual(e.status, '400')
+                self.assertEqual(json.loads(e.response),
+                                 {'error': 'Expected a JSON object'})
+            else:
+                self.fail('Should have been refused')
+        self.assertEqual(self.worker.runs, {})
+
+
+    @defer.inlineCallbacks
+    def test_disconnect(self):
+        """
+        A run whose client goes away before it's ready is cancelled and
+        forgotten.
+        """
+        client = yield ClientCreator(reactor, Protocol).connectTCP(
+            '127.0.0.1', self.port.getHost().port)
+        body = json.dumps({'steps': [{'action': 'wait'}]})
+        client.transport.write('POST / HTTP/1.1\r\nHost: localhost\r\n'
+                               'Content-Length: %d\r\n\r\n%s'
+                               % (len(body), body))
+        yield self.started
+        self.assertEqual(len(self.worker.runs), 1)
+        client.transport.loseConnection()
+        yield self.cancelled
+        self.assertEqual(self.worker.runs, {})
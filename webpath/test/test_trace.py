@@ -0,0 +1,120 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+
+from mock import MagicMock
+
+
+from webpath import http, trace
+from webpath.runner import basicRunner, Context
+from webpath.trace import Profile
+
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+
+class ProfileTest(TestCase):
+
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patch(trace, 'clock', self.clock)
+
+
+    def test_observe(self):
+        """
+        Observers get a trace of every action, including nested ones, with
+        the time it took and any timings and counts added by its handler.
+        """
+        def fetch(params, context):
+            context.trace.add('thread_wait', 0.5)
+            context.trace.count('bytes', 10)
+            self.clock.now += 2
+            if params.get('fail'):
+                raise ValueError('bad')
+            return 'page'
+
+        runner = basicRunner({'fetch': fetch})
+        profile = Profile()
+        runner.addObserver(profile.observe)
+        runner.runActions([
+            {'action': 'loop', 'iterable': [1, 2], 'actions': [
+                {'action': 'fetch', 'name': 'page'},
+            ]},
+        ], Context())
+        self.failureResultOf(runner.runActions([
+            {'action': 'fetch', 'fail': True},
+        ], Context()), ValueError)
+
+        actions = [(t.action, t.name, t.duration, t.error)
+                   for t in profile.traces]
+        self.assertEqual(actions, [
+            ('fetch', 'page', 2.0, None),
+            ('fetch', 'page', 2.0, None),
+            ('loop', None, 4.0, None),
+            ('fetch', None, 2.0, 'ValueError'),
+        ])
+        self.assertEqual(profile.traces[0].timings, {'thread_wait': 0.5})
+        self.assertEqual(profile.traces[0].counts, {'bytes': 10})
+
+        rows = dict((row['key'], row) for row in profile.summary())
+        self.assertEqual(sorted(rows), ['fetch', 'fetch "page"', 'loop'])
+        self.assertEqual(rows['fetch']['count'], 3)
+        self.assertEqual(rows['fetch']['errors'], 1)
+        self.assertEqual(rows['fetch']['total'], 6.0)
+        self.assertEqual(rows['fetch']['thread_wait'], 1.5)
+        self.assertEqual(rows['fetch "page"']['bytes'], 20)
+        self.assertIn('fetch "page"', profile.formatSummary())
+
+        events = profile.chromeTrace()['traceEvents']
+        self.assertEqual(events[0]['name'], 'page')
+        self.assertEqual(events[0]['cat'], 'fetch')
+        self.assertEqual(events[0]['dur'], 2000000)
+        self.assertEqual(events[0]['args']['thread_wait_ms'], 500)
+        self.assertEqual(events[3]['args']['error'], 'ValueError')
+
+
+    def test_unobserved(self):
+        """
+        Handlers can use the context's trace even when nothing is observing.
+        """
+        def fetch(params, context):
+            context.trace.add('thread_wait', 0.5)
+            context.trace.count('bytes', 10)
+            return 'page'
+        d = basicRunner({'fetch': fetch}).runActions([{'action': 'fetch'}],
+                                                     Context())
+        self.assertEqual(self.successResultOf(d), 'page')
+
+
+
+class httpTraceTest(TestCase):
+
+
+    @defer.inlineCallbacks
+    def test_request(self):
+        """
+        The http action records the time it waited for a thread and the size
+        of the response.
+        """
+        fake = MagicMock()
+        fake.request.return_value.content = 'hello'
+        runner = basicRunner()
+        http.installHTTPHandlers(runner)
+        profile = Profile()
+        runner.addObserver(profile.observe)
+        context = Context()
+        context.requests = fake
+        yield runner.runActions([{'action': 'http', 'kwargs': {}}], context)
+        self.assertEqual(profile.traces[0].counts, {'bytes': 5})
+        self.assertIn('thread_wait', profile.traces[0].timings)
@@ -0,0 +1,167 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+from twisted.trial.unittest import TestCase
+
+from webpath.runner import basicRunner, Context, PlanError, Scope
+from webpath.runner import evaluator, renderer
+
+
+
+TRANSACTIONS = [
+    {'date': '2014-06-02', 'payee': 'Cafe', 'amount': '-3.50'},
+    {'date': '2014-06-01', 'payee': 'Employer', 'amount': '100'},
+    {'date': '2014-06-03', 'payee': 'Cafe', 'amount': '-4.25'},
+]
+
+
+
+class transformTest(TestCase):
+
+
+    def setUp(self):
+        self.runner = basicRunner()
+        self.context = Context()
+        self.context.variables['txns'] = TRANSACTIONS
+
+
+    def transform(self, action, **params):
+        params['action'] = action
+        params.setdefault('iterable', '$txns')
+        return self.successResultOf(self.runner.runActions([params],
+                                                           self.context))
+
+
+    def test_map(self):
+        """
+        C{value} is evaluated for each item, and can use other variables.
+        """
+        self.context.variables['suffix'] = '!'
+        self.assertEqual(self.transform('map',
+                                        value='$item["payee"] + suffix'),
+                         ['Cafe!', 'Employer!', 'Cafe!'])
+        self.assertEqual(self.transform('map', value='x'), ['x', 'x', 'x'])
+
+
+    def test_mapDict(self):
+        """
+        Expressions nested in a dict or list C{value} are evaluated too.
+        """
+        self.assertEqual(self.transform('map', value={
+            'who': '$item["payee"]',
+            'amounts': ['$item["amount"]', 0],
+            'kind': 'txn',
+        })[:2], [
+            {'who': 'Cafe', 'amounts': ['-3.50', 0], 'kind': 'txn'},
+            {'who': 'Employer', 'amounts': ['100', 0], 'kind': 'txn'},
+        ])
+        plan = self.runner.compile([{'action': 'map', 'iterable': '$txns',
+                                     'value': {'date': '$item["date"]'}}])
+        self.assertEqual(self.successResultOf(
+            self.runner.runActions(plan, self.context)),
+            [{'date': '2014-06-02'}, {'date': '2014-06-01'},
+             {'date': '2014-06-03'}])
+
+
+    def test_filter(self):
+        self.assertEqual(self.transform('filter',
+                                        where='$item["payee"] == "Cafe"'),
+                         [TRANSACTIONS[0], TRANSACTIONS[2]])
+
+
+    def test_sort(self):
+        self.assertEqual(self.transform('sort', by='$item["date"]',
+                                        reverse=True),
+                         [TRANSACTIONS[2], TRANSACTIONS[0], TRANSACTIONS[1]])
+        self.assertEqual(self.transform('sort', iterable=[3, 1, 2]), [1, 2, 3])
+
+
+    def test_group(self):
+        """
+        Items are grouped by C{by}, in their order.
+        """
+        self.assertEqual(self.transform('group', by='$item["payee"]'), {
+            'Cafe': [TRANSACTIONS[0], TRANSACTIONS[2]],
+            'Employer': [TRANSACTIONS[1]],
+        })
+
+
+    def test_sum(self):
+        self.assertEqual(self.transform('sum', iterable=[1, 2, 3]), 6)
+        self.assertEqual(self.transform('sum', iterable=[1, 2, 3],
+                                        value='$item * 10'), 60)
+
+
+    def test_columns(self):
+        """
+        Records can be turned into columns, with numeric ones as lists of
+        floats.
+        """
+        result = self.transform('columns', numeric=['amount'])
+        self.assertEqual(sorted(result), ['amount', 'date', 'payee'])
+        self.assertEqual(result['amount'], [-3.5, 100.0, -4.25])
+        self.assertEqual(result['payee'], ['Cafe', 'Employer', 'Cafe'])
+        result = self.transform('columns', fields=['payee', 'memo'])
+        self.assertEqual(result, {'payee': ['Cafe', 'Employer', 'Cafe'],
+                                  'memo': [None, None, None]})
+        self.assertEqual(self.transform('columns', iterable=[]), {})
+
+
+    def test_columnsSum(self):
+        self.context.variables['cols'] = self.transform('columns',
+                                                        numeric=['amount'])
+        self.assertEqual(self.transform('sum', iterable='$cols["amount"]'),
+                         92.25)
+
+
+    def test_compile(self):
+        """
+        Expressions are checked when a script is compiled.
+        """
+        self.assertRaises(PlanError, self.runner.compile, [
+            {'action': 'filter', 'iterable': [], 'where': '$item =='}])
+        plan = self.runner.compile([{'action': 'map', 'iterable': '$txns',
+                                     'value': '$item["payee"]'}])
+        self.assertEqual(self.successResultOf(
+            self.runner.runActions(plan, self.context)),
+            ['Cafe', 'Employer', 'Cafe'])
+
+
+
+class evaluatorTest(TestCase):
+
+
+    def test_evaluator(self):
+        """
+        The argument is a variable local to the expression.
+        """
+        variables = {'n': 10}
+        f = evaluator('item + n', variables)
+        self.assertEqual([f(1), f(2)], [11, 12])
+        self.assertEqual(variables, {'n': 10})
+
+
+    def test_scope(self):
+        """
+        Variables are read through L{Scope}s, innermost first.
+        """
+        variables = Scope(Scope({'n': 1, 'm': 2}, {'n': 10}), {'item': 'x'})
+        f = evaluator('item + n + m', variables)
+        self.assertEqual(f(3), 15)
+
+
+
+class rendererTest(TestCase):
+
+
+    def test_renderer(self):
+        """
+        C{$expressions} anywhere in the item are evaluated with the argument
+        as a variable, and each call gets a new copy.
+        """
+        variables = Scope({'n': 10}, {})
+        f = renderer({'a': '$item + n', 'b': ['$item', 'x']}, variables)
+        first = f(1)
+        self.assertEqual(first, {'a': 11, 'b': [1, 'x']})
+        self.assertEqual(f(2), {'a': 12, 'b': [2, 'x']})
+        self.assertEqual(first, {'a': 11, 'b': [1, 'x']})
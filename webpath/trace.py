@@ -0,0 +1,208 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+import json
+import time
+
+
+clock = time.time
+
+
+class ActionTrace(object):
+    """
+    I record where the time went while running one action.  Handlers find me
+    as C{context.trace} when they're called and can add their own timings
+    and counts (like time spent waiting for a thread or bytes downloaded).
+
+    @ivar action: Name of the action's handler.
+    @ivar name: The action's C{name}, if it has one.
+    @ivar start: When the handler was called.
+    @ivar end: When the handler's result was ready.
+    @ivar interpolate: Seconds spent interpolating the action's params.
+    @ivar timings: Dict of other labelled timings in seconds.
+    @ivar counts: Dict of labelled counts.
+    @ivar tags: Dict of other facts about the action, like the C{host} and
+        C{status} of an HTTP request.
+    @ivar error: Name of the exception the action failed with, if it did.
+    """
+
+    end = None
+    error = None
+
+    def __init__(self, action, name=None, interpolate=0.0):
+        self.action = action
+        self.name = name
+        self.interpolate = interpolate
+        self.timings = {}
+        self.counts = {}
+        self.tags = {}
+        self.start = clock()
+
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+    def add(self, label, seconds):
+        """
+        Add C{seconds} to the timing called C{label}.
+        """
+        self.timings[label] = self.timings.get(label, 0.0) + seconds
+
+
+    def count(self, label, n=1):
+        """
+        Add C{n} to the count called C{label}.
+        """
+        self.counts[label] = self.counts.get(label, 0) + n
+
+
+    def tag(self, key, value):
+        """
+        Note a fact about the action.
+        """
+        self.tags[key] = value
+
+
+    def finish(self, error=None):
+        """
+        Note that the action is done.
+
+        @param error: Name of the exception it failed with, if it did.
+        """
+        self.end = clock()
+        self.error = error
+
+
+
+class NullTrace(object):
+    """
+    I stand in for an L{ActionTrace} when nothing is observing a runner, so
+    that handlers needn't check.
+    """
+
+    def add(self, label, seconds):
+        pass
+
+
+    def count(self, label, n=1):
+        pass
+
+
+    def tag(self, key, value):
+        pass
+
+
+NO_TRACE = NullTrace()
+
+
+
+class Profile(object):
+    """
+    I collect the L{ActionTrace}s of a run (add me to a runner with
+    C{runner.addObserver(profile.observe)}) and summarize them per action and
+    per named step.
+    """
+
+    def __init__(self):
+        self.traces = []
+
+
+    def observe(self, trace):
+        self.traces.append(trace)
+
+
+    def summary(self):
+        """
+        Aggregate my traces.
+
+        @return: A list of rows (dicts) sorted by total time, one for every
+            action and one for every named step, with C{key}, C{count},
+            C{errors}, C{total}, C{mean}, C{max} and C{interpolate} and
+            totals of all other timings and counts by label.
+        """
+        rows = {}
+        for trace in self.traces:
+            keys = [trace.action]
+            if trace.name is not None:
+                keys.append('%s "%s"' % (trace.action, trace.name))
+            for key in keys:
+                row = rows.get(key)
+                if row is None:
+                    row = rows[key] = {'key': key, 'count': 0, 'errors': 0,
+                                       'total': 0.0, 'max': 0.0,
+                                       'interpolate': 0.0}
+                row['count'] += 1
+                row['errors'] += trace.error is not None
+                row['total'] += trace.duration
+                row['max'] = max(row['max'], trace.duration)
+                row['interpolate'] += trace.interpolate
+                for label, value in trace.timings.items() + \
+                        trace.counts.items():
+                    row[label] = row.get(label, 0) + value
+        for row in rows.values():
+            row['mean'] = row['total'] / row['count']
+        return sorted(rows.values(), key=lambda row: -row['total'])
+
+
+    def formatSummary(self):
+        """
+        Format L{summary} as a table.  Times are in milliseconds.  Time spent
+        in nested actions (like those in a loop) counts towards both the
+        nested action and the one it's nested in.
+        """
+        rows = self.summary()
+        extra = sorted(set(label for row in rows for label in row) -
+                       set(['key', 'count', 'errors', 'total', 'mean', 'max',
+                            'interpolate']))
+        columns = ['count', 'errors', 'total', 'mean', 'max',
+                   'interpolate'] + extra
+        width = max([len(row['key']) for row in rows] + [6])
+        lines = ['%-*s' % (width, 'action') +
+                 ''.join(' %12s' % (c,) for c in columns)]
+        for row in rows:
+            cells = []
+            for column in columns:
+                value = row.get(column)
+                if value is None:
+                    cells.append(' %12s' % ('-',))
+                elif isinstance(value, float):
+                    cells.append(' %12.1f' % (value * 1000,))
+                else:
+                    cells.append(' %12d' % (value,))
+            lines.append('%-*s' % (width, row['key']) + ''.join(cells))
+        return '\n'.join(lines) + '\n'
+
+
+    def chromeTrace(self):
+        """
+        Get my traces as Chrome trace events (for chrome://tracing or
+        Perfetto).
+
+        @return: A dict which can be written as JSON.
+        """
+        events = []
+        for trace in self.traces:
+            args = dict(trace.tags)
+            args.update(trace.counts)
+            args.update(('%s_ms' % (label,), seconds * 1000)
+                        for label, seconds in trace.timings.items())
+            args['interpolate_ms'] = trace.interpolate * 1000
+            if trace.error is not None:
+                args['error'] = trace.error
+            events.append({
+                'name': trace.action if trace.name is None else trace.name,
+                'cat': trace.action,
+                'ph': 'X',
+                'ts': trace.start * 1000000,
+                'dur': trace.duration * 1000000,
+                'pid': 1,
+                'tid': 1,
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+    def writeChromeTrace(self, fh):
+        json.dump(self.chromeTrace(), fh)
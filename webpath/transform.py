@@ -0,0 +1,106 @@
+# Copyright (c) The SimpleFIN Team
+# See LICENSE for details.
+
+"""
+Actions which transform a whole list of records in one step, evaluating an
+C{$expression} for each record as C{$item}, rather than running a C{loop} of
+actions (each interpolated and dispatched) per record.
+"""
+
+from webpath.runner import deferredParams, evaluator, renderer
+
+
+@deferredParams('value')
+def mapItems(params, context):
+    """
+    Get a list of C{value} for each item of C{iterable}.
+    """
+    return map(_itemFunction(params['value'], context), params['iterable'])
+
+
+@deferredParams('where')
+def filterItems(params, context):
+    """
+    Get a list of the items of C{iterable} for which C{where} is true.
+    """
+    return filter(_itemFunction(params['where'], context), params['iterable'])
+
+
+@deferredParams('by')
+def sortItems(params, context):
+    """
+    Sort the items of C{iterable} by C{by} (or by themselves), descending if
+    C{reverse} is true.
+    """
+    return sorted(params['iterable'],
+                  key=_itemFunction(params.get('by'), context),
+                  reverse=bool(params.get('reverse')))
+
+
+@deferredParams('by')
+def groupItems(params, context):
+    """
+    Group the items of C{iterable} by C{by}.
+
+    @return: A dict of each value of C{by} to a list of its items, in the
+        order of C{iterable}.
+    """
+    key = _itemFunction(params['by'], context)
+    groups = {}
+    for item in params['iterable']:
+        k = key(item)
+        group = groups.get(k)
+        if group is None:
+            groups[k] = [item]
+        else:
+            group.append(item)
+    return groups
+
+
+@deferredParams('value')
+def sumItems(params, context):
+    """
+    Add up C{value} for each item of C{iterable}, or the items themselves.
+    """
+    value = _itemFunction(params.get('value'), context)
+    if value is None:
+        return sum(params['iterable'])
+    return sum(map(value, params['iterable']))
+
+
+def columns(params, context):
+    """
+    Turn C{iterable}, a list of dicts, into a dict of C{fields} (by default
+    the first record's keys) to a list of each record's value for it
+    (C{None} where it's missing).  Fields listed in C{numeric} are converted
+    to floats, which are quick to C{sum}; every record must have them.
+    """
+    records = params['iterable']
+    fields = params.get('fields')
+    if fields is None:
+        fields = records[0].keys() if records else []
+    numeric = set(params.get('numeric', ()))
+    result = {}
+    for field in fields:
+        if field in numeric:
+            result[field] = [float(record[field]) for record in records]
+        else:
+            result[field] = [record.get(field) for record in records]
+    return result
+
+
+def _itemFunction(expression, context):
+    """
+    Make a function of an item from a param: an C{$expression} is evaluated
+    with the item as C{$item}, a dict or list is rendered with its
+    C{$expressions} evaluated that way, and anything else is a constant.
+
+    @return: The function, or C{None} if C{expression} is C{None}.
+    """
+    if expression is None:
+        return None
+    if isinstance(expression, basestring) and expression.startswith('$'):
+        return evaluator(expression[1:], context.variables)
+    if type(expression) not in (dict, tuple, list):
+        return lambda item: expression
+    return renderer(expression, context.variables)